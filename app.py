@@ -1,5 +1,6 @@
+from project import create_app
 
-from project import app
+app = create_app()
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
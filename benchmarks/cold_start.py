@@ -0,0 +1,81 @@
+"""Measure how long a fresh process takes to get the app ready.
+
+Each run starts a new interpreter, like a gunicorn worker or a test run
+would, and times importing the project, calling create_app and, with
+--request, serving a first request:
+
+    python -m benchmarks.cold_start --runs 10
+    python -m benchmarks.cold_start --runs 10 --request /explore
+
+Nothing in the timed part should touch the database or Elasticsearch
+unless a request is made.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Runs in the fresh interpreter, prints its timings as JSON
+PROBE = """
+import json, sys, time
+
+start = time.perf_counter()
+from project import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+
+timings = {"import": imported - start, "create_app": created - imported}
+
+if sys.argv[1]:
+    app.test_client().get(sys.argv[1])
+    timings["first_request"] = time.perf_counter() - created
+
+timings["modules"] = len(sys.modules)
+print(json.dumps(timings))
+"""
+
+
+def run_once(path):
+    """ Timings of one fresh interpreter """
+
+    output = subprocess.run([sys.executable, "-c", PROBE, path or ""],
+                            check=True, capture_output=True, text=True)
+
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def summarize(runs):
+    """ Median and best of each timing, in milliseconds """
+
+    summary = {}
+
+    for name in runs[0]:
+        values = [run[name] for run in runs]
+        if name == "modules":
+            summary[name] = max(values)
+            continue
+        summary[name] = {
+            "median_ms": round(statistics.median(values) * 1000, 1),
+            "best_ms": round(min(values) * 1000, 1),
+        }
+
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--request", metavar="PATH",
+                        help="Also time a first GET of this path")
+    args = parser.parse_args()
+
+    runs = [run_once(args.request) for _ in range(args.runs)]
+
+    print(json.dumps(summarize(runs), indent=2))
+
+
+if __name__ == "__main__":
+    main()
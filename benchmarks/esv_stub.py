@@ -0,0 +1,330 @@
+"""Stand-in for the ESV passage API, for tests, load tests and benchmarks.
+
+Answers /v3/passage/text/ like the real API, with made up but stable text,
+so the app can run without the real API, its key and its rate limits:
+
+    python -m benchmarks.esv_stub --port 5055
+
+and run the app with API_URL=http://localhost:5055/v3/passage/text/
+
+Latency, server errors and throttling can be added to see how the
+caching, batching and retries of the app behave, the same way on every
+run for the same --seed:
+
+    python -m benchmarks.esv_stub --latency 200 --jitter 50 \\
+        --error-rate 0.05 --throttle-rate 0.1 --rate-limit 20
+
+GET /stats returns the number of requests, passages, errors and throttled
+requests served so far, POST /stats resets them.
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+PASSAGE_PATH = "/v3/passage/text/"
+STATS_PATH = "/stats"
+
+# "Romans 8", "Romans 8:1", "Romans 8:1-3" or "Romans 8:1–3"
+REFERENCE_RE = re.compile(
+    r"^\s*(?P<book>\d?\s*[A-Za-z][A-Za-z. ]*?)\.?\s+(?P<chapter>\d+)"
+    r"(?::(?P<start>\d+)(?:\s*[-–]\s*(?P<end>\d+))?)?\s*$")
+
+# Short names the API expands, the rest are only title cased
+BOOK_NAMES = {
+    "gen": "Genesis", "ex": "Exodus", "ps": "Psalm", "psalms": "Psalm",
+    "prov": "Proverbs", "isa": "Isaiah", "matt": "Matthew", "mt": "Matthew",
+    "mk": "Mark", "lk": "Luke", "jn": "John", "rom": "Romans",
+    "1 cor": "1 Corinthians", "2 cor": "2 Corinthians", "gal": "Galatians",
+    "eph": "Ephesians", "phil": "Philippians", "col": "Colossians",
+    "heb": "Hebrews", "jas": "James", "rev": "Revelation",
+}
+
+WORDS = """
+    and the lord said unto them behold I am with you always even unto the
+    end of the age for God so loved the world that he gave his only son
+    grace mercy and peace be with you in truth and love
+""".split()
+
+
+def chapter_length(book, chapter):
+    """ Number of verses of a chapter, the same on every run """
+
+    return 10 + zlib.crc32(f"{book} {chapter}".encode()) % 20
+
+
+def verse_text(book, chapter, verse):
+    """ Made up text of a verse, the same on every run """
+
+    seed = zlib.crc32(f"{book} {chapter}:{verse}".encode())
+    length = 8 + seed % 16
+
+    return " ".join(WORDS[(seed >> 3) * (i + 1) % len(WORDS)]
+                    for i in range(length)).capitalize() + "."
+
+
+def book_name(book):
+    book = " ".join(book.replace(".", " ").split()).lower()
+    return BOOK_NAMES.get(book) or book.title()
+
+
+def parse_reference(reference):
+    """ (canonical reference, [(verse number, text), ...]) or None
+        - Verses past the end of the chapter are left out, a passage
+          without any verse is not found
+    """
+
+    match = REFERENCE_RE.match(reference)
+    if match is None:
+        return None
+
+    book = book_name(match["book"])
+    chapter = int(match["chapter"])
+    length = chapter_length(book, chapter)
+
+    if match["start"] is None:
+        start, end = 1, length
+    else:
+        start = int(match["start"])
+        end = min(int(match["end"] or start), length)
+
+    if not 1 <= start <= end:
+        return None
+
+    if match["start"] is None:
+        canonical = f"{book} {chapter}"
+    elif start == end:
+        canonical = f"{book} {chapter}:{start}"
+    else:
+        canonical = f"{book} {chapter}:{start}–{end}"
+
+    return canonical, [(verse, verse_text(book, chapter, verse))
+                       for verse in range(start, end + 1)]
+
+
+def passage_response(query, verse_numbers):
+    """ The JSON the API answers a query with
+        - Passages are separated by ";" and the ones that are not found
+          are left out, like the real API does
+        - "query" is normalized like the API does: found passages get
+          their full book name and an en dash in ranges, which the app
+          relies on to number the verses of a single passage
+    """
+
+    passages = []
+    meta = []
+    normalized = []
+
+    for reference in query.split(";"):
+        parsed = parse_reference(reference)
+        if parsed is None:
+            normalized.append(" ".join(reference.split()))
+            continue
+
+        canonical, verses = parsed
+
+        if verse_numbers:
+            text = "  ".join(f"[{verse}] {text}" for verse, text in verses)
+        else:
+            text = " ".join(text for verse, text in verses)
+
+        passages.append(text + "\n\n")
+        meta.append({"canonical": canonical})
+        normalized.append(canonical)
+
+    return {
+        "query": "; ".join(normalized),
+        "canonical": "; ".join(info["canonical"] for info in meta),
+        "passage_meta": meta,
+        "passages": passages,
+    }
+
+
+class Faults(object):
+    """ Latency, errors and throttling added to the answers
+        - latency and jitter are in milliseconds
+        - error_rate and throttle_rate are the share of requests answered
+          with a 500 or a 429
+        - rate_limit is the most requests answered per second, the rest
+          get a 429 with the seconds left in Retry-After
+        - Decisions come from one seeded generator, so the same requests
+          in the same order get the same answers
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, throttle_rate=0,
+                 rate_limit=0, retry_after=1, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = 0
+        self.window_count = 0
+
+    def decide(self):
+        """ (delay in seconds, status or None, Retry-After or None) """
+
+        with self.lock:
+            delay = max(self.latency + self.rng.uniform(-self.jitter,
+                                                        self.jitter), 0)
+            roll = self.rng.random()
+
+            now = time.monotonic()
+            if int(now) != self.window:
+                self.window = int(now)
+                self.window_count = 0
+            self.window_count += 1
+            limited = self.rate_limit and \
+                self.window_count > self.rate_limit
+
+        if limited:
+            return 0, 429, max(math.ceil(int(now) + 1 - now), 1)
+        if roll < self.throttle_rate:
+            return delay / 1000, 429, self.retry_after
+        if roll < self.throttle_rate + self.error_rate:
+            return delay / 1000, 500, None
+
+        return delay / 1000, None, None
+
+
+class ESVStubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path == STATS_PATH:
+            self.send_json(200, self.server.stats)
+            return
+
+        if url.path != PASSAGE_PATH:
+            self.send_json(404, {"detail": "Not found."})
+            return
+
+        self.count("requests")
+
+        delay, status, retry_after = self.server.faults.decide()
+        time.sleep(delay)
+
+        if status == 429:
+            self.count("throttled")
+            self.send_json(429, {
+                "detail": "Request was throttled. Expected available in "
+                          f"{retry_after} seconds."
+            }, {"Retry-After": str(retry_after)})
+            return
+
+        if status == 500:
+            self.count("errors")
+            self.send_json(500, {"detail": "Internal server error."})
+            return
+
+        params = parse_qs(url.query)
+        query = params.get("q", [""])[0]
+        verse_numbers = params.get(
+            "include-verse-numbers", ["true"])[0].lower() != "false"
+
+        data = passage_response(query, verse_numbers)
+        self.count("passages", len(data["passages"]))
+
+        self.send_json(200, data)
+
+    def do_POST(self):
+        if urlparse(self.path).path != STATS_PATH:
+            self.send_json(404, {"detail": "Not found."})
+            return
+
+        self.server.reset_stats()
+        self.send_json(200, self.server.stats)
+
+    def count(self, name, number=1):
+        with self.server.stats_lock:
+            self.server.stats[name] += number
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ESVStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, faults=None):
+        super().__init__(address, ESVStubHandler)
+        self.faults = faults or Faults()
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {"requests": 0, "passages": 0, "errors": 0,
+                          "throttled": 0}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{PASSAGE_PATH}"
+
+
+def make_server(host="127.0.0.1", port=0, faults=None):
+    """ The stub server, port 0 picks a free port """
+
+    return ESVStubServer((host, port), faults)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Milliseconds added to every answer")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="Milliseconds the latency varies by")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Share of requests answered with a 500")
+    parser.add_argument("--throttle-rate", type=float, default=0,
+                        help="Share of requests answered with a 429")
+    parser.add_argument("--rate-limit", type=int, default=0,
+                        help="Requests answered per second, 0 for no limit")
+    parser.add_argument("--retry-after", type=int, default=1,
+                        help="Retry-After of the --throttle-rate answers")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, Faults(
+        latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+        rate_limit=args.rate_limit, retry_after=args.retry_after,
+        seed=args.seed))
+    print(f"ESV stub on {server.url}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""Load a running app with virtual users following real journeys.
+
+Each virtual user registers, logs in, looks up long references and saves
+a set from them, then searches, favorites sets and plays the card game
+a few times before logging out and starting over as a new user.
+
+Run the ESV stub and the app against it, then the load:
+
+    python -m benchmarks.esv_stub --port 5055
+    FLASK_ENV=loadtest API_URL=http://localhost:5055/v3/passage/text/ \\
+        gunicorn app:app
+    python -m benchmarks.load --url http://localhost:8000 --users 50 \\
+        --duration 60 --output load.json
+
+The results hold the throughput and the p50, p95 and p99 latency of each
+step. The set is only ready once a worker has saved it, so run workers
+too, or JOBS_LOCAL_WORKERS in the app.
+"""
+
+import argparse
+import json
+import random
+import re
+import statistics
+import threading
+import time
+import uuid
+
+from datetime import datetime, timezone
+
+import requests
+
+# Every step, in journey order
+STEPS = ("register", "login", "lookup_references", "create_set",
+         "set_ready", "search", "favorite", "cards", "logout")
+
+# Chapters and long ranges, so saving a set needs several ESV batches
+LONG_REFERENCES = [
+    "Genesis 1", "Psalm 23", "Psalm 91", "Psalm 119:1-40",
+    "Proverbs 3:1-20", "Isaiah 40:1-31", "Isaiah 53", "Matthew 5:1-48",
+    "Matthew 6:5-34", "John 1:1-18", "John 3:1-21", "John 15:1-17",
+    "Romans 5:1-11", "Romans 8", "Romans 12:1-21", "1 Corinthians 13",
+    "2 Corinthians 5:11-21", "Galatians 5:16-26", "Ephesians 2:1-22",
+    "Philippians 2:1-18", "Colossians 3:1-17", "Hebrews 11:1-40",
+    "James 1:2-27", "1 Peter 1:3-25", "1 John 4:7-21", "Revelation 21",
+]
+
+SEARCH_TERMS = ["grace", "faith", "hope", "love", "psalm", "romans",
+                "peace", "prayer", "gospel", "john"]
+
+# Seconds between two polls of the set job, like the job page
+POLL_INTERVAL = 0.75
+
+# Seconds to wait for a set before counting the step as failed
+SET_READY_TIMEOUT = 60
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class StepFailed(Exception):
+    """ A step answered with an unexpected status, the session ends """
+
+
+class Recorder(object):
+    """ Latency and outcome of every step, from all the virtual users """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {step: [] for step in STEPS}
+        self.errors = {step: 0 for step in STEPS}
+
+    def add(self, step, elapsed, ok):
+        with self.lock:
+            if ok:
+                self.timings[step].append(elapsed)
+            else:
+                self.errors[step] += 1
+
+
+class VirtualUser(object):
+    """ One browser session going through the journeys """
+
+    def __init__(self, url, recorder, rng, set_ids, rounds):
+        self.url = url.rstrip("/")
+        self.recorder = recorder
+        self.rng = rng
+        self.set_ids = set_ids
+        self.rounds = rounds
+        self.http = requests.Session()
+
+    def run(self, deadline):
+        while time.monotonic() < deadline:
+            self.http.cookies.clear()
+            try:
+                self.session()
+            except (StepFailed, requests.RequestException):
+                # Start over as a new user, without hammering a failing app
+                time.sleep(POLL_INTERVAL)
+
+    def session(self):
+        username = f"lt{uuid.uuid4().hex[:16]}"
+        password = "load-test"
+
+        with self.step("register"):
+            token = self.csrf_token("/register")
+            self.expect(302, self.http.post(self.url + "/register", data={
+                "csrf_token": token,
+                "first_name": "Load",
+                "last_name": "Test",
+                "email": f"{username}@example.com",
+                "username": username,
+                "password": password,
+            }, allow_redirects=False))
+
+        with self.step("logout"):
+            self.expect(302, self.http.get(self.url + "/logout",
+                                           allow_redirects=False))
+
+        with self.step("login"):
+            token = self.csrf_token("/login")
+            self.expect(302, self.http.post(self.url + "/login", data={
+                "csrf_token": token,
+                "username": username,
+                "password": password,
+            }, allow_redirects=False))
+
+        self.create_set()
+
+        for _ in range(self.rounds):
+            with self.step("search"):
+                self.expect(200, self.http.get(
+                    self.url + "/search",
+                    params={"term": self.rng.choice(SEARCH_TERMS)}))
+
+            if self.set_ids:
+                set_id = self.rng.choice(self.set_ids)
+
+                with self.step("favorite"):
+                    self.expect(200, self.http.post(
+                        f"{self.url}/api/sets/{set_id}/favorite"))
+
+                with self.step("cards"):
+                    self.expect(200, self.http.get(
+                        f"{self.url}/api/sets/{set_id}"))
+
+        with self.step("logout"):
+            self.expect(302, self.http.get(self.url + "/logout",
+                                           allow_redirects=False))
+
+    def create_set(self):
+        """ Look up the references like the set editor, save the set
+            and wait for its job like the job page
+        """
+
+        references = self.rng.sample(LONG_REFERENCES, self.rng.randint(3, 6))
+
+        with self.step("lookup_references"):
+            self.expect(200, self.http.post(
+                self.url + "/api/verses", json={"references": references}))
+
+        with self.step("create_set"):
+            token = self.csrf_token("/sets/new")
+            response = self.http.post(self.url + "/sets/new", data={
+                "csrf_token": token,
+                "name": f"Load test {self.rng.choice(SEARCH_TERMS)}",
+                "description": "; ".join(references),
+                "refs": references,
+            }, allow_redirects=False)
+            self.expect(302, response)
+
+        status_url = response.headers["Location"].rstrip("/") + "/status"
+        if status_url.startswith("/"):
+            status_url = self.url + status_url
+
+        submitted = time.perf_counter()
+        job = {}
+
+        try:
+            while time.perf_counter() - submitted < SET_READY_TIMEOUT:
+                job = self.job_status(status_url)
+                if job["status"] in ("done", "failed"):
+                    break
+                time.sleep(POLL_INTERVAL)
+        except (StepFailed, requests.RequestException):
+            self.recorder.add("set_ready", time.perf_counter() - submitted,
+                              False)
+            raise
+
+        ok = job.get("status") == "done"
+        self.recorder.add("set_ready", time.perf_counter() - submitted, ok)
+
+        if not ok:
+            raise StepFailed(f"set job {job.get('id')} {job.get('status')}")
+
+        self.set_ids.append(job["set_id"])
+
+    def job_status(self, status_url):
+        """ The job shown by the status endpoint """
+
+        response = self.http.get(status_url)
+        self.expect(200, response)
+
+        try:
+            job = response.json()["job"]
+            job["status"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise StepFailed(f"GET {status_url} answered without a job: "
+                             f"{e!r}")
+
+        return job
+
+    def csrf_token(self, path):
+        response = self.http.get(self.url + path)
+        self.expect(200, response)
+
+        match = CSRF_RE.search(response.text)
+        return match.group(1) if match else ""
+
+    def expect(self, status, response):
+        if response.status_code != status:
+            raise StepFailed(f"{response.request.method} {response.url} "
+                             f"answered {response.status_code}")
+
+    def step(self, name):
+        return TimedStep(self.recorder, name)
+
+
+class TimedStep(object):
+    """ Record how long a step took and whether it failed """
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.recorder.add(self.name, time.perf_counter() - self.start,
+                          exc_type is None)
+
+
+def percentile(values, pct):
+    """ Nearest rank percentile of sorted values """
+
+    index = max(int(round(pct / 100 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(timings, errors, wall):
+    timings = sorted(timings)
+
+    summary = {
+        "count": len(timings),
+        "errors": errors,
+        "throughput_rps": round(len(timings) / wall, 2),
+    }
+
+    if timings:
+        summary.update({
+            "p50_ms": round(percentile(timings, 50) * 1000, 2),
+            "p95_ms": round(percentile(timings, 95) * 1000, 2),
+            "p99_ms": round(percentile(timings, 99) * 1000, 2),
+            "mean_ms": round(statistics.mean(timings) * 1000, 2),
+        })
+
+    return summary
+
+
+def run(url, users, duration, rounds, seed, ramp_up):
+    """ Run the virtual users for duration seconds, return the results """
+
+    recorder = Recorder()
+    set_ids = []
+
+    threads = []
+    start = time.perf_counter()
+    deadline = time.monotonic() + duration
+
+    for number in range(users):
+        user = VirtualUser(url, recorder, random.Random(seed + number),
+                           set_ids, rounds)
+        thread = threading.Thread(target=user.run, args=(deadline,),
+                                  name=f"virtual-user-{number}",
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(ramp_up / users)
+
+    for thread in threads:
+        thread.join()
+
+    wall = time.perf_counter() - start
+
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "url": url,
+        "users": users,
+        "duration": round(wall, 2),
+        "rounds": rounds,
+        "seed": seed,
+        "steps": {step: summarize(recorder.timings[step],
+                                  recorder.errors[step], wall)
+                  for step in STEPS},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=60,
+                        help="Seconds to keep starting new sessions")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Searches, favorites and card games per session")
+    parser.add_argument("--ramp-up", type=float, default=5,
+                        help="Seconds over which the users are started")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON results here")
+    args = parser.parse_args()
+
+    results = run(args.url, args.users, args.duration, args.rounds,
+                  args.seed, args.ramp_up)
+    output = json.dumps(results, indent=2)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
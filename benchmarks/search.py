@@ -0,0 +1,305 @@
+"""Benchmark the set search backends on synthetic sets.
+
+Generate the sets once, with a fixed seed so every run searches the same
+data, then run the query workload against each backend:
+
+    python -m benchmarks.search generate --sets 100000 --seed 1
+    python -m benchmarks.search run --queries 2000 --concurrency 8 \\
+        --output search-100k.json
+    python -m benchmarks.search clean
+
+The results hold the p50, p95 and p99 latency and the throughput of each
+backend, overall on the mixed workload and for each kind of query run on
+its own.
+"""
+
+import argparse
+import json
+import random
+import statistics
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from project import create_app
+from project.models import db, User, Set
+from project.search import bulk, bulk_remove_from_index
+from project.helpers.plans import reserve_ids, copy_rows
+
+# Owner of the generated sets, so they can be told apart and removed
+BENCH_USERNAME = "search-benchmark"
+
+# Sets inserted and indexed together
+CHUNK_SIZE = 10000
+
+VOCABULARY = """
+    abide anchor ark armor battle beloved bless blood bread bride brother
+    burden call captive chosen church comfort command compassion courage
+    covenant creation cross crown darkness david dawn deliver desert disciple
+    door dove dream dust eagle earth elder enemy eternal exile faith father
+    fear feast fire flesh flock forgive fountain freedom fruit garden gate
+    gift glory goodness grace grain guard harvest heart heaven heir holy
+    honey hope house humble israel jerusalem joy judge justice king kingdom
+    lamb lamp law light lion living lord love mercy mountain nation night
+    oil olive patience peace people pilgrim praise prayer promise prophet
+    psalm purpose redeem refuge rejoice rest river rock sabbath salt
+    salvation sanctuary seed servant shepherd shield sin song sorrow spirit
+    storm strength stone sword temple thanks throne treasure tree trust
+    truth valley vine voice walk water way wilderness wind wine wisdom
+    witness word worship yoke zion
+""".split()
+
+# Share of each kind of query in the workload
+WORKLOAD = {
+    "common_word": 0.5,
+    "rare_word": 0.2,
+    "two_words": 0.2,
+    "no_match": 0.1,
+}
+
+BACKENDS = {
+    "elasticsearch": lambda term: Set.search(term, 1, 10),
+    "database": lambda term: Set.search_db(term, 1, 10),
+}
+
+
+def zipf_weights(count):
+    """ Word weights falling off like natural text, rank 1 most common """
+
+    return [1 / rank for rank in range(1, count + 1)]
+
+
+def make_text(rng, weights, low, high):
+    words = rng.choices(VOCABULARY, weights, k=rng.randint(low, high))
+    return " ".join(words)
+
+
+def generate_sets(rng, count):
+    """ (name, description) of count synthetic sets """
+
+    weights = zipf_weights(len(VOCABULARY))
+
+    for _ in range(count):
+        yield (make_text(rng, weights, 2, 5).title()[:50],
+               make_text(rng, weights, 8, 25))
+
+
+def make_queries(rng, count):
+    """ (kind, term) pairs following the WORKLOAD mix """
+
+    weights = zipf_weights(len(VOCABULARY))
+    common = VOCABULARY[:len(VOCABULARY) // 10]
+    rare = VOCABULARY[-len(VOCABULARY) // 4:]
+    kinds = rng.choices(list(WORKLOAD), list(WORKLOAD.values()), k=count)
+
+    queries = []
+
+    for kind in kinds:
+        if kind == "common_word":
+            term = rng.choice(common)
+        elif kind == "rare_word":
+            term = rng.choice(rare)
+        elif kind == "two_words":
+            term = " ".join(rng.choices(VOCABULARY, weights, k=2))
+        else:
+            term = f"zq{rng.randrange(10 ** 6)}x"
+        queries.append((kind, term))
+
+    return queries
+
+
+def bench_user():
+    """ The owner of the generated sets, made on first use """
+
+    user = User.query.filter_by(username=BENCH_USERNAME).first()
+
+    if user is None:
+        # "!" is never a valid bcrypt hash, so no one can log in as it
+        user = User(username=BENCH_USERNAME, password="!",
+                    email="search-benchmark@example.com",
+                    first_name="Search", last_name="Benchmark")
+        db.session.add(user)
+        db.session.commit()
+
+    return user
+
+
+def generate(app, count, seed):
+    """ Insert count sets with COPY and index them in bulk """
+
+    rng = random.Random(seed)
+    user_id = bench_user().id
+    sets = generate_sets(rng, count)
+    done = 0
+
+    while done < count:
+        chunk = [next(sets) for _ in range(min(CHUNK_SIZE, count - done))]
+        ids = reserve_ids("sets_id_seq", len(chunk))
+
+        copy_rows("sets", ("id", "name", "description", "user_id"),
+                  ((set_id, name, description, user_id)
+                   for set_id, (name, description) in zip(ids, chunk)))
+        db.session.commit()
+
+        if app.elasticsearch:
+            bulk(app.elasticsearch, ({
+                '_index': Set.__tablename__,
+                '_id': set_id,
+                '_source': {'name': name, 'description': description},
+            } for set_id, (name, description) in zip(ids, chunk)))
+
+        done += len(chunk)
+        print(f"{done} of {count} sets")
+
+    if app.elasticsearch:
+        app.elasticsearch.indices.refresh(index=Set.__tablename__)
+
+
+def clean(app):
+    """ Delete the generated sets from the database and the index """
+
+    user = User.query.filter_by(username=BENCH_USERNAME).first()
+    if user is None:
+        return
+
+    ids = [row[0] for row in db.session.query(Set.id).filter_by(
+        user_id=user.id)]
+
+    for i in range(0, len(ids), CHUNK_SIZE):
+        bulk_remove_from_index(Set.__tablename__, ids[i:i + CHUNK_SIZE])
+
+    Set.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+    db.session.commit()
+
+    print(f"Deleted {len(ids)} sets")
+
+
+def percentile(values, pct):
+    """ Nearest rank percentile of sorted values """
+
+    index = max(int(round(pct / 100 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(latencies, wall):
+    latencies = sorted(latencies)
+
+    return {
+        "queries": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "throughput_qps": round(len(latencies) / wall, 1),
+    }
+
+
+def run_backend(app, search, queries, concurrency):
+    """ Latency of each query and the wall time of the whole workload """
+
+    def timed(query):
+        kind, term = query
+        with app.app_context():
+            start = time.perf_counter()
+            sets, total = search(term)
+            sets.all()
+            elapsed = time.perf_counter() - start
+            db.session.remove()
+        return kind, elapsed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        timings = list(executor.map(timed, queries))
+    wall = time.perf_counter() - start
+
+    return timings, wall
+
+
+def run(app, backends, count, concurrency, seed, warmup):
+    """ Run the workload against each backend and return the results """
+
+    rng = random.Random(seed + 1)
+    queries = make_queries(rng, count)
+
+    results = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "sets": Set.query.count(),
+        "seed": seed,
+        "concurrency": concurrency,
+        "workload": WORKLOAD,
+        "backends": {},
+    }
+
+    for name in backends:
+        if name == "elasticsearch" and not app.elasticsearch:
+            print("Skipping elasticsearch, it is not configured")
+            continue
+
+        search = BACKENDS[name]
+        run_backend(app, search, queries[:warmup], concurrency)
+        timings, wall = run_backend(app, search, queries, concurrency)
+
+        result = summarize([elapsed for kind, elapsed in timings], wall)
+
+        # Each kind runs again on its own, so its throughput is not
+        # spread over the time the other kinds took
+        result["by_kind"] = {}
+        for kind in WORKLOAD:
+            kind_queries = [query for query in queries if query[0] == kind]
+            if kind_queries:
+                kind_timings, kind_wall = run_backend(
+                    app, search, kind_queries, concurrency)
+                result["by_kind"][kind] = summarize(
+                    [elapsed for k, elapsed in kind_timings], kind_wall)
+
+        results["backends"][name] = result
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser(
+        "generate", help="Add synthetic sets to the database and index")
+    generate_parser.add_argument("--sets", type=int, default=10000)
+    generate_parser.add_argument("--seed", type=int, default=1)
+
+    run_parser = commands.add_parser(
+        "run", help="Run the query workload against the backends")
+    run_parser.add_argument("--queries", type=int, default=2000)
+    run_parser.add_argument("--concurrency", type=int, default=4)
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--warmup", type=int, default=100)
+    run_parser.add_argument("--backend", dest="backends", action="append",
+                            choices=list(BACKENDS),
+                            help="Backend to run, all of them by default")
+    run_parser.add_argument("--output", help="Write the JSON results here")
+
+    commands.add_parser("clean", help="Delete the synthetic sets")
+
+    args = parser.parse_args()
+
+    app = create_app()
+
+    with app.app_context():
+        if args.command == "generate":
+            generate(app, args.sets, args.seed)
+        elif args.command == "clean":
+            clean(app)
+        else:
+            results = run(app, args.backends or list(BACKENDS),
+                          args.queries, args.concurrency, args.seed,
+                          args.warmup)
+            output = json.dumps(results, indent=2)
+
+            if args.output:
+                with open(args.output, "w") as f:
+                    f.write(output)
+            print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Compare the cost of the /api/sets/<id> payload.
+
+Run against a database with at least one set, like:
+
+    python -m benchmarks.set_payload --set-id 1 --repeat 200
+
+The old pipeline loads Verse instances and calls jsonify, the new one
+selects (reference, verse) tuples and uses the compact encoder, with
+and without compression.
+"""
+
+import argparse
+import json
+import time
+
+from flask import jsonify
+
+from project import create_app
+from project.models import db, Set
+from project.helpers.http import dumps_json, json_response
+
+
+def old_payload(set_id):
+    current_set = Set.query.get(set_id)
+    cards = [verse.serialize() for verse in current_set.verses]
+    return jsonify(cards=cards).get_data()
+
+
+def new_payload(set_id, encoding=None):
+    rows = Set.card_rows(set_id)
+    cards = [{"reference": reference, "verse": verse}
+             for reference, verse in rows]
+    if encoding is None:
+        return dumps_json({"cards": cards})
+    return json_response({"cards": cards}, encoding).get_data()
+
+
+def measure(fn, repeat):
+    """ CPU seconds per call and size of the body """
+
+    body = b""
+    start = time.process_time()
+
+    for i in range(repeat):
+        body = fn()
+        db.session.remove()
+
+    return {
+        "cpu_ms": (time.process_time() - start) / repeat * 1000,
+        "bytes": len(body),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--set-id", type=int, required=True)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    app = create_app()
+
+    with app.app_context():
+        results = {
+            "cards": len(Set.card_rows(args.set_id)),
+            "old": measure(lambda: old_payload(args.set_id), args.repeat),
+            "new": measure(lambda: new_payload(args.set_id), args.repeat),
+            "new_gzip": measure(lambda: new_payload(args.set_id, "gzip"),
+                                args.repeat),
+        }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""Gunicorn settings, read by `gunicorn app:app`."""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# "gevent" lets each worker serve many requests waiting on the ESV API
+# or the database at once, "sync" handles one request at a time
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'sync')
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 1000))
+
+if worker_class == 'gevent':
+    # Patch before the app is preloaded, so the sockets, ssl and
+    # threads it imports are cooperative, and let psycopg2 yield to
+    # other greenlets while it waits on Postgres
+    from gevent import monkey
+    monkey.patch_all()
+
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+# Import the app once in the master so workers fork with it ready
+preload_app = True
+
+
+def post_fork(server, worker):
+    """ Drop the database connections inherited from the master, each
+        worker opens its own
+    """
+
+    from app import app
+    from project.models import db
+
+    with app.app_context():
+        db.engine.dispose()
+        for bind in app.config.get('SQLALCHEMY_BINDS') or {}:
+            db.get_engine(app, bind=bind).dispose()
@@ -1,115 +1,93 @@
-import os
-import re
-
 from flask import Flask, render_template
-from flask_debugtoolbar import DebugToolbarExtension
 
 from flask_login import LoginManager
 
-from flask_admin import Admin
-
-from project.admin import MyAdminIndexView, MTWordModelView
-
 from flask_bootstrap import Bootstrap
 
-from elasticsearch import Elasticsearch
-
+from project.config import default_config
 from project.search import connect_app_to_search
-from project.models import db, connect_db, User, Set, Verse
+from project.replica import connect_replica
+from project.cache import connect_cache
+from project.helpers.fragments import connect_fragments
+from project.helpers.page_cache import connect_page_cache
+from project.jobs import connect_jobs
+from project.tracing import connect_tracing
+from project.metrics import connect_metrics
+from project.profiling import connect_profiling
+from project.slow_queries import connect_slow_queries
+from project.passwords import connect_passwords
+from project.rate_limit import connect_rate_limits
+from project.helpers.mail import connect_mail
+from project.admin import connect_admin
+from project.models import connect_db, User
+from project.commands import register_commands
 
 from .api.views import api
-from .login.views import login, connect_mail
+from .login.views import login
 from .sets.views import sets
 from .users.views import users
 from .homepage.views import homepage
 
-app = Flask(__name__)
+# Register the search tasks with the job queue
+from .helpers import search_jobs  # noqa: F401
 
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///mtword'))
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
-app.config['SQLALCHEMY_ECHO'] = False
+login_manager = LoginManager()
+login_manager.login_view = "login.handle_login"
+login_manager.login_message = "Please log in!"
 
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
 
-app.config['RECAPTCHA_PUBLIC_KEY'] = os.environ.get(
-    'RECAPTCHA_PUBLIC_KEY',
-    "6LeYIbsSAAAAACRPIllxA7wvXjIE411PfdB2gt2J")
-app.config['RECAPTCHA_PRIVATE_KEY'] = os.environ.get(
-    'RECAPTCHA_PRIVATE_KEY',
-    "6LeYIbsSAAAAAJezaIq3Ft_hSTo0YtyeFG-JgRtu")
+def create_app(config=None, **overrides):
+    """ Make the MTWord app
+        - config: settings class, the one matching FLASK_ENV by default,
+          overrides are applied after it
+        - Nothing connects to the database or Elasticsearch here, so
+          the app can be made before gunicorn forks its workers
+        - The debug toolbar is only installed in debug mode
+    """
 
-bonsai = None
+    app = Flask(__name__)
 
-if os.environ.get('FLASK_ENV', None) == 'production':
-    # Parse the auth and host from env:
-    bonsai = os.environ['ELASTICSEARCH_URL']
-    auth = re.search('https\:\/\/(.*)\@', bonsai).group(1).split(':')
-    host = bonsai.replace('https://%s:%s@' % (auth[0], auth[1]), '')
+    app.config.from_object(config or default_config())
+    app.config.update(overrides)
 
-    app.config['ELASTICSEARCH_URL'] = bonsai
+    connect_app_to_search(app)
 
-    # Connect to cluster over SSL using auth for best security:
-    es_header = [{
-        'host': host,
-        'port': 443,
-        'use_ssl': True,
-        'http_auth': (auth[0], auth[1])
-    }]
+    if app.debug:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
 
-    # Instantiate the new Elasticsearch connection:
-    app.elasticsearch = Elasticsearch(es_header) if bonsai else None
-else:
-    app.config['ELASTICSEARCH_URL'] = "http://localhost:9200"
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
-        if app.config['ELASTICSEARCH_URL'] else None
+    connect_db(app)
+    connect_replica(app)
+    connect_cache(app)
+    connect_fragments(app)
+    connect_page_cache(app)
+    connect_jobs(app)
+    connect_tracing(app)
+    connect_metrics(app)
+    connect_profiling(app)
+    connect_slow_queries(app)
+    connect_passwords(app)
+    connect_rate_limits(app)
 
-connect_app_to_search(app)
+    Bootstrap(app)
 
-debug = DebugToolbarExtension(app)
+    login_manager.init_app(app)
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    connect_admin(app)
+    connect_mail(app)
 
-connect_db(app)
+    app.register_blueprint(api)
+    app.register_blueprint(homepage)
+    app.register_blueprint(login)
+    app.register_blueprint(sets)
+    app.register_blueprint(users)
 
-Bootstrap(app)
+    register_commands(app)
 
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = "login.handle_login"
-login_manager.login_message = "Please log in!"
+    app.register_error_handler(404, show_404_page)
+    app.register_error_handler(401, show_401_page)
 
-admin = Admin(app,
-              name='MTWord',
-              template_mode='bootstrap3',
-              index_view=MyAdminIndexView())
-app.config['FLASK_ADMIN_SWATCH'] = 'journal'
-
-# Administrative views
-admin.add_view(MTWordModelView(User, db.session))
-admin.add_view(MTWordModelView(Set, db.session))
-admin.add_view(MTWordModelView(Verse, db.session))
-
-app.config.update(
-    {
-        "MAIL_SERVER": os.environ.get("MAIL_SERVER"),
-        "MAIL_PORT": os.environ.get("MAIL_PORT"),
-        "MAIL_USE_TLS": os.environ.get("MAIL_USE_TLS"),
-        "MAIL_USE_SSL": os.environ.get("MAIL_USE_SSL"),
-        "MAIL_USERNAME": os.environ.get("MAIL_USERNAME"),
-        "MAIL_DEFAULT_SENDER": os.environ.get("MAIL_DEFAULT_SENDER"),
-        "MAIL_PASSWORD": os.environ.get("MAIL_PASSWORD")
-    }
-)
-connect_mail(app)
-
-db.create_all()
-
-app.register_blueprint(api)
-app.register_blueprint(homepage)
-app.register_blueprint(login)
-app.register_blueprint(sets)
-app.register_blueprint(users)
+    return app
 
 
 ####################################################################
@@ -117,18 +95,15 @@ app.register_blueprint(users)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    return User.get_cached(int(user_id))
 
 ####################################################################
 # Error Pages
 
 
-@app.errorhandler(404)
 def show_404_page(err):
     return render_template('errors/404.html'), 404
 
 
-@app.errorhandler(401)
 def show_401_page(err):
     return render_template('errors/401.html'), 401
-
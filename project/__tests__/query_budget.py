@@ -0,0 +1,60 @@
+"""Count the SQL statements a request issues.
+
+Use QueryBudgetMixin in a TestCase with a `client`:
+
+    response = self.assertQueryBudget(3, "/explore")
+
+The test fails when the request issues more statements than its budget,
+listing the statements, so an N+1 query shows up in the failure.
+"""
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryRecorder(object):
+    """ Statements run on any engine while the recorder is active """
+
+    def __init__(self):
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(Engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(Engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        self.statements.append((statement, parameters))
+
+    def report(self):
+        """ The statements, numbered, with their parameters """
+
+        return "\n\n".join(
+            f"{number}. {' '.join(statement.split())}\n   {parameters!r}"
+            for number, (statement, parameters)
+            in enumerate(self.statements, 1))
+
+
+class QueryBudgetMixin(object):
+    """ Assertions on the SQL statements of a test client request """
+
+    def assertQueryBudget(self, budget, path, method="GET", **kwargs):
+        """ Make the request and fail if it goes over budget
+            - Returns the response
+        """
+
+        with QueryRecorder() as recorder:
+            response = self.client.open(path, method=method, **kwargs)
+            # Streamed bodies can query while they are read
+            response.get_data()
+
+        count = len(recorder.statements)
+
+        if count > budget:
+            self.fail(f"{method} {path} issued {count} SQL statements, "
+                      f"its budget is {budget}:\n\n{recorder.report()}")
+
+        return response
@@ -0,0 +1,63 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest project.__tests__.test_cache
+
+
+import os
+import stat
+import tempfile
+import time
+from unittest import TestCase
+
+from ..cache import FileSystemCache, MemoryCache
+
+
+class FileSystemCacheTestCase(TestCase):
+    """Test that the cache directory is private and stays bounded."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_new_directory_is_private(self):
+        path = os.path.join(self.tmp.name, "cache")
+
+        FileSystemCache(path)
+
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o700)
+
+    def test_directory_others_can_write_to_is_refused(self):
+        path = os.path.join(self.tmp.name, "cache")
+        os.mkdir(path)
+        os.chmod(path, 0o777)
+
+        with self.assertRaises(RuntimeError):
+            FileSystemCache(path)
+
+    def test_oldest_entries_are_pruned_every_few_writes(self):
+        path = os.path.join(self.tmp.name, "cache")
+        cache = FileSystemCache(path, max_entries=20)
+
+        for i in range(41):
+            cache.set(f"key:{i}", i)
+
+        # Pruned every 2 writes, back to 20 entries
+        self.assertLessEqual(len(os.listdir(path)), 21)
+        self.assertEqual(cache.get("key:40"), 40)
+
+
+class UnboundedCacheTestCase(TestCase):
+    """Test that unbounded stores only drop expired entries."""
+
+    def test_memory_cache_keeps_live_entries(self):
+        cache = MemoryCache(default_timeout=0.01, max_entries=None)
+
+        cache.set("old", 1, timeout=0.01)
+        time.sleep(0.02)
+        for i in range(5000):
+            cache.set(f"tag:{i}", i, timeout=60)
+
+        self.assertEqual(cache.get("tag:0"), 0)
+        self.assertNotIn("old", cache._entries)
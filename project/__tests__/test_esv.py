@@ -0,0 +1,78 @@
+"""ESV API client tests, against the stub in benchmarks/."""
+
+# run these tests like:
+#
+#    python -m unittest project.__tests__.test_esv
+
+
+import threading
+from unittest import TestCase
+
+import requests
+
+from benchmarks.esv_stub import make_server, Faults
+from ..helpers import sets
+from ..helpers.sets import fetch_esv_texts, split_passage
+
+
+class ESVClientTestCase(TestCase):
+    """Test looking up passages and retrying failed requests."""
+
+    def start_stub(self, faults=None):
+        self.server = make_server(faults=faults)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        api_url, backoff = sets.API_URL, sets.ESV_RETRY_BACKOFF
+        sets.API_URL, sets.ESV_RETRY_BACKOFF = self.server.url, 0
+
+        def restore():
+            sets.API_URL, sets.ESV_RETRY_BACKOFF = api_url, backoff
+        self.addCleanup(restore)
+
+    def test_passages_split_into_cards(self):
+        """ A batch is one request and each range becomes its verses """
+
+        self.start_stub()
+
+        romans, psalm = fetch_esv_texts(["Rom 8:1-3", "Psalm 23"])
+
+        self.assertEqual(self.server.stats["requests"], 1)
+        self.assertEqual(
+            [ref for ref, text in split_passage(romans, True)],
+            ["Romans 8:1", "Romans 8:2", "Romans 8:3"])
+        self.assertTrue(split_passage(psalm, True))
+
+    def test_missing_passage_is_looked_up_alone(self):
+        """ A batch with a missing passage falls back to one by one """
+
+        self.start_stub()
+
+        found, missing = fetch_esv_texts(["John 3:1-4", "Nowhere"])
+
+        self.assertEqual(found["reference"], "John 3:1–4")
+        self.assertEqual(missing["passages"], "Error: Passage not found")
+        self.assertEqual(self.server.stats["requests"], 3)
+
+    def test_throttled_requests_are_retried(self):
+        """ A throttled request is tried again, then fails """
+
+        self.start_stub(Faults(throttle_rate=1, retry_after=0))
+
+        with self.assertRaises(requests.HTTPError):
+            fetch_esv_texts(["John 3:1-4", "John 4:1-4"])
+
+        self.assertEqual(self.server.stats["throttled"],
+                         sets.ESV_RETRIES + 1)
+
+    def test_long_retry_after_is_not_waited_for(self):
+        """ The lookup fails right away when asked to wait too long """
+
+        self.start_stub(Faults(throttle_rate=1, retry_after=60))
+
+        with self.assertRaises(requests.HTTPError):
+            fetch_esv_texts(["John 3:1-4", "John 4:1-4"])
+
+        self.assertEqual(self.server.stats["requests"], 1)
@@ -0,0 +1,117 @@
+"""Background job queue tests."""
+
+# These tests need a Postgres database, run them like:
+#
+#    JOBS_TEST_DATABASE_URL=postgresql:///mtword_test \
+#    python -m unittest project.__tests__.test_jobs
+
+
+import os
+import unittest
+from unittest import TestCase
+
+DATABASE_URL = os.environ.get('JOBS_TEST_DATABASE_URL')
+
+if DATABASE_URL:
+    from .. import create_app
+    from ..config import TestingConfig
+    from ..models import db, Job
+    from ..jobs import task, enqueue, claim_job, Worker
+
+    app = create_app(TestingConfig, SQLALCHEMY_DATABASE_URI=DATABASE_URL)
+
+    calls = []
+
+    @task("test.record")
+    def record(value):
+        calls.append(value)
+
+    @task("test.fail", max_attempts=2, on_dead=lambda value: calls.append(
+        f"dead {value}"))
+    def fail(value):
+        raise RuntimeError(value)
+
+
+@unittest.skipUnless(DATABASE_URL, "needs a database")
+class JobQueueTestCase(TestCase):
+    """Test claiming, running and retrying jobs."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+        calls.clear()
+
+        self.worker = Worker(app)
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_job_runs_once(self):
+        """ A queued job runs and is marked done """
+
+        enqueue("test.record", "hello")
+        db.session.commit()
+
+        self.worker.run(burst=True)
+
+        self.assertEqual(calls, ["hello"])
+        self.assertEqual(Job.query.one().status, "done")
+
+    def test_job_waits_for_delay(self):
+        """ A delayed job is not claimed before it is due """
+
+        enqueue("test.record", "later", delay=3600)
+        db.session.commit()
+
+        self.worker.run(burst=True)
+
+        self.assertEqual(calls, [])
+
+    def test_claims_skip_locked_jobs(self):
+        """ Two claims in open transactions get different jobs """
+
+        enqueue("test.record", 1)
+        enqueue("test.record", 2)
+        db.session.commit()
+
+        other = db.engine.connect()
+        transaction = other.begin()
+        try:
+            locked = other.execute(
+                "SELECT id FROM jobs ORDER BY id LIMIT 1 FOR UPDATE"
+            ).scalar()
+
+            row = claim_job("test")
+
+            self.assertNotEqual(row.id, locked)
+        finally:
+            transaction.rollback()
+            other.close()
+
+    def test_failed_job_is_retried_then_dead(self):
+        """ A failing job is retried, then dead after its last attempt """
+
+        enqueue("test.fail", "boom")
+        db.session.commit()
+
+        self.worker.run(burst=True)
+
+        job = Job.query.one()
+        self.assertEqual(job.status, "queued")
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("RuntimeError: boom", job.last_error)
+
+        # Make the retry due right away
+        job.run_at = db.func.now()
+        db.session.commit()
+
+        self.worker.run(burst=True)
+
+        job = Job.query.one()
+        self.assertEqual(job.status, "dead")
+        self.assertEqual(calls, ["dead boom"])
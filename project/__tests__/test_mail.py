@@ -0,0 +1,187 @@
+"""Background mail delivery tests."""
+
+# Mail is sent to a small SMTP stand-in listening on a local socket.
+# The tests need a Postgres database for the job queue, run them like:
+#
+#    TEST_DATABASE_URL=postgresql:///mtword_test \
+#    python -m unittest project.__tests__.test_mail
+
+
+import email
+import os
+import socketserver
+import threading
+import unittest
+from unittest import TestCase
+
+DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+
+class SMTPStandIn(socketserver.StreamRequestHandler):
+    """ Just enough SMTP for smtplib, refusing recipients named
+        "refused" and hanging up after drop_after messages
+    """
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        recipients = []
+        sent = 0
+
+        self.reply("220 stand-in ready")
+
+        for line in self.rfile:
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 stand-in")
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                if "refused" in command:
+                    self.reply("550 No such user")
+                else:
+                    recipients.append(command.split(":", 1)[1])
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = b"".join(iter(self.rfile.readline, b".\r\n"))
+                server.messages.append((recipients, data.decode()))
+                self.reply("250 OK")
+                sent += 1
+                if sent == server.drop_after:
+                    return
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def reset(self):
+        self.connections = 0
+        self.messages = []
+        self.drop_after = None
+
+
+if DATABASE_URL:
+    smtp_server = StandInServer(("127.0.0.1", 0), SMTPStandIn)
+    smtp_server.reset()
+    threading.Thread(target=smtp_server.serve_forever, daemon=True).start()
+
+    from flask_mail import Message
+
+    from .. import create_app
+    from ..config import TestingConfig
+    from ..models import db, User, Job
+    from ..jobs import Worker, PermanentFailure
+    from ..helpers.mail import smtp_pool
+
+    app = create_app(TestingConfig,
+                     SQLALCHEMY_DATABASE_URI=DATABASE_URL,
+                     MAIL_SERVER="127.0.0.1",
+                     MAIL_PORT=smtp_server.server_address[1],
+                     MAIL_DEFAULT_SENDER="mtword@example.com",
+                     MAIL_SUPPRESS_SEND=False)
+
+
+@unittest.skipUnless(DATABASE_URL, "needs a database")
+class MailDeliveryTestCase(TestCase):
+    """Test sending queued mail over the pooled connection."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+        smtp_server.reset()
+
+    def tearDown(self):
+        smtp_pool.close()
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def message(self, recipient):
+        return Message("Hello", recipients=[recipient], body="Hi!")
+
+    def test_batch_uses_one_connection(self):
+        """ A batch of messages is sent over a single connection """
+
+        errors = smtp_pool.send([self.message("a@example.com"),
+                                 self.message("b@example.com")])
+
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(len(smtp_server.messages), 2)
+        self.assertEqual(smtp_server.connections, 1)
+
+    def test_refused_recipient_only_fails_its_message(self):
+        """ A refused message does not stop the rest of the batch """
+
+        errors = smtp_pool.send([self.message("a@example.com"),
+                                 self.message("refused@example.com"),
+                                 self.message("b@example.com")])
+
+        self.assertIsNone(errors[0])
+        self.assertIn("550", errors[1])
+        self.assertIsInstance(errors[1], PermanentFailure)
+        self.assertIsNone(errors[2])
+        self.assertEqual(smtp_server.connections, 1)
+
+    def test_reconnects_when_server_hangs_up(self):
+        """ A connection closed by the server is opened again """
+
+        smtp_server.drop_after = 1
+
+        errors = smtp_pool.send([self.message("a@example.com"),
+                                 self.message("b@example.com")])
+
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(smtp_server.connections, 2)
+
+    def test_reset_password_mail_is_queued(self):
+        """ The reset page returns before the email is sent """
+
+        user = User(first_name="fn", last_name="ln", email="t@example.com",
+                    username="test", password="HASHED")
+        db.session.add(user)
+        db.session.commit()
+        # The worker removes the session, which detaches the user
+        user_id = user.id
+
+        resp = app.test_client().post("/reset/pw",
+                                      data={"email": "t@example.com"})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(smtp_server.messages, [])
+        self.assertEqual(Job.query.one().task, "mail.send")
+
+        Worker(app).run(burst=True)
+
+        token = User.query.get(user_id).password_reset_token
+        self.assertEqual(len(smtp_server.messages), 1)
+
+        sent = email.message_from_string(smtp_server.messages[0][1])
+        html = next(part.get_payload(decode=True).decode()
+                    for part in sent.walk()
+                    if part.get_content_type() == "text/html")
+        self.assertIn(f"/reset/pw/{token}", html)
+
+    def test_reset_password_does_not_tell_who_has_an_account(self):
+        """ An unknown email gets the same answer and no email """
+
+        resp = app.test_client().post("/reset/pw",
+                                      data={"email": "nobody@example.com"})
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Job.query.count(), 0)
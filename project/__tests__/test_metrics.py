@@ -0,0 +1,81 @@
+"""Request metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest project.__tests__.test_metrics
+
+
+from unittest import TestCase
+
+from ..metrics import Metrics, to_prometheus, summarize, bucket_percentile, \
+    LATENCY_BUCKETS, BACKGROUND
+
+
+class MetricsTestCase(TestCase):
+    """Test recording and exporting the counters."""
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def record(self, endpoint, elapsed, sql=0):
+        self.metrics.start_request()
+        for _ in range(sql):
+            self.metrics.add_dependency("sql", 0.001)
+        self.metrics.add_cache_lookup("cache", hit=True)
+        self.metrics.end_request(endpoint, elapsed)
+
+    def test_dependencies_count_towards_the_request(self):
+        """ Calls made during a request are added to its endpoint """
+
+        self.record("api.lookup_verse", 0.02, sql=3)
+
+        entry = self.metrics.snapshot()["api.lookup_verse"]
+        self.assertEqual(entry["count"], 1)
+        self.assertEqual(entry["deps"]["sql"][0], 3)
+        self.assertEqual(entry["cache"]["cache"], [1, 0])
+
+    def test_calls_outside_requests_are_background(self):
+        """ Calls made by jobs go to the background endpoint """
+
+        self.metrics.add_dependency("esv", 0.2)
+
+        self.assertEqual(self.metrics.snapshot()[BACKGROUND]["deps"]["esv"][0],
+                         1)
+
+    def test_prometheus_histogram_is_cumulative(self):
+        """ The buckets count every request at or below their bound """
+
+        self.record("sets.show_set", 0.003)
+        self.record("sets.show_set", 0.3)
+
+        text = to_prometheus(self.metrics.snapshot())
+
+        self.assertIn('mtword_request_duration_seconds_bucket'
+                      '{endpoint="sets.show_set",le="0.005"} 1', text)
+        self.assertIn('mtword_request_duration_seconds_bucket'
+                      '{endpoint="sets.show_set",le="+Inf"} 2', text)
+        self.assertIn('mtword_request_duration_seconds_count'
+                      '{endpoint="sets.show_set"} 2', text)
+
+    def test_summary_rows(self):
+        """ The admin page gets averages per request """
+
+        self.record("homepage.explore", 0.04, sql=2)
+        self.record("homepage.explore", 0.06, sql=4)
+
+        row, = summarize(self.metrics.snapshot())
+
+        self.assertEqual(row["count"], 2)
+        self.assertAlmostEqual(row["mean_ms"], 50)
+        self.assertEqual(row["sql_calls"], 3)
+        self.assertEqual(row["cache_hit_rate"], 1)
+
+    def test_bucket_percentile(self):
+        """ The percentile is the bound of the bucket reaching it """
+
+        buckets = [0] * len(LATENCY_BUCKETS)
+        buckets[0] = 90
+        buckets[4] = 10
+
+        self.assertEqual(bucket_percentile(buckets, 0.5), LATENCY_BUCKETS[0])
+        self.assertEqual(bucket_percentile(buckets, 0.95), LATENCY_BUCKETS[4])
@@ -0,0 +1,55 @@
+"""Password hashing tests."""
+
+# run these tests like:
+#
+#    python -m unittest project.__tests__.test_passwords
+
+
+import threading
+from unittest import TestCase
+
+from ..passwords import PasswordHasher, calibrate, hash_cost
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test hashing in the pool and rehashing weaker hashes."""
+
+    def make_hasher(self, workers=0, rounds=4):
+        hasher = PasswordHasher()
+        hasher.workers = workers
+        hasher.rounds = rounds
+        return hasher
+
+    def test_hash_and_check(self):
+        hasher = self.make_hasher()
+
+        hashed = hasher.generate("newPWd1")
+
+        self.assertEqual(hash_cost(hashed), 4)
+        self.assertTrue(hasher.check(hashed, "newPWd1"))
+        self.assertFalse(hasher.check(hashed, "wrong"))
+        self.assertFalse(hasher.check("!", "newPWd1"))
+
+    def test_hashing_in_the_pool(self):
+        """ Hashes made by the pool check the same as local ones """
+
+        hasher = self.make_hasher(workers=1)
+        hasher.slots = threading.BoundedSemaphore(2)
+        self.addCleanup(lambda: hasher.executor and
+                        hasher.executor.shutdown())
+
+        hashed = hasher.generate("newPWd1")
+
+        self.assertIsNotNone(hasher.executor)
+        self.assertTrue(self.make_hasher().check(hashed, "newPWd1"))
+
+    def test_weaker_hashes_need_rehash(self):
+        old = self.make_hasher(rounds=4).generate("newPWd1")
+
+        self.assertTrue(self.make_hasher(rounds=5).needs_rehash(old))
+        self.assertFalse(self.make_hasher(rounds=4).needs_rehash(old))
+        self.assertFalse(self.make_hasher(rounds=5).needs_rehash("!"))
+
+    def test_calibration_stays_in_bounds(self):
+        self.assertEqual(calibrate(0, 4, 6), 4)
+        self.assertEqual(calibrate(10 ** 9, 4, 6), 6)
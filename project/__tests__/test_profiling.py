@@ -0,0 +1,87 @@
+"""On demand profiling tests."""
+
+# run these tests like:
+#
+#    python -m unittest project.__tests__.test_profiling
+
+
+import threading
+import time
+from unittest import TestCase, skipUnless
+
+from ..profiling import Sampler, flame_graph, fold, function_stats
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
+
+STACKS = {
+    "dispatch;show_set;render": 6,
+    "dispatch;show_set;query": 3,
+    "dispatch;explore": 1,
+}
+
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+
+class ProfilingTestCase(TestCase):
+    """Test sampling stacks and summarizing the samples."""
+
+    def test_sampler_sees_the_busy_function(self):
+        """ Samples land in the function the thread is running """
+
+        sampler = Sampler(interval=0.001)
+        sampler.start()
+        spin(0.2)
+        stacks = sampler.stop()
+
+        self.assertTrue(stacks)
+        busiest = max(stacks, key=stacks.get)
+        self.assertTrue(busiest.split(";")[-1].startswith("spin "))
+
+    @skipUnless(greenlet, "greenlet is not installed")
+    def test_sampler_follows_the_switched_out_greenlet(self):
+        """ A request waiting while other greenlets run is sampled where
+            it waits, not in whatever runs on the thread
+        """
+
+        main = greenlet.getcurrent()
+
+        def waiting():
+            main.switch()
+
+        waiter = greenlet.greenlet(waiting)
+        waiter.switch()
+
+        sampler = Sampler()
+        sampler.thread_id = threading.get_ident()
+        sampler.greenlet = waiter
+
+        self.assertTrue(fold(sampler.frame()).split(";")[-1]
+                        .startswith("waiting "))
+
+        waiter.switch()
+
+    def test_flame_graph_adds_up_the_stacks(self):
+        flame = flame_graph(STACKS)
+
+        self.assertEqual(flame["value"], 10)
+        dispatch, = flame["children"]
+        show_set, explore = dispatch["children"]
+        self.assertEqual((show_set["name"], show_set["value"]),
+                         ("show_set", 9))
+        self.assertEqual([child["name"] for child in show_set["children"]],
+                         ["render", "query"])
+
+    def test_function_stats_sorted_by_self_samples(self):
+        rows = function_stats(STACKS)
+
+        self.assertEqual(rows[0]["name"], "render")
+        self.assertEqual(rows[0]["self_pct"], 60)
+        show_set = next(row for row in rows if row["name"] == "show_set")
+        self.assertEqual((show_set["self"], show_set["total"]), (0, 9))
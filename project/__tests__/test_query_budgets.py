@@ -0,0 +1,157 @@
+"""SQL query budget tests."""
+
+# These tests need a Postgres database, run them like:
+#
+#    TEST_DATABASE_URL=postgresql:///mtword_test \
+#    python -m unittest project.__tests__.test_query_budgets
+#
+# Each view gets a budget of SQL statements. The budgets do not grow with
+# the number of sets or verses on the page, so an N+1 query fails here.
+
+
+import os
+import unittest
+from unittest import TestCase
+
+from .query_budget import QueryBudgetMixin
+
+DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+if DATABASE_URL:
+    from .. import create_app
+    from ..config import TestingConfig
+    from ..models import db, User, Set, Verse, SetVerse, Favorite
+    from ..helpers.fragments import fragment_cache
+
+    app = create_app(TestingConfig, SQLALCHEMY_DATABASE_URI=DATABASE_URL)
+
+# Most SQL statements each view may issue, the logged in budgets include
+# loading the user
+BUDGETS = {
+    "homepage.index": 0,
+    "homepage.explore": 2,
+    "homepage.search": 2,
+    "sets.show_set": 3,
+    "sets.show_set (logged in)": 5,
+    "sets.show_set_cards": 2,
+    "api.lookup_set": 2,
+    "users.show_user_profile": 3,
+    "users.show_user_favorites": 3,
+    "api.toggle_favorite": 5,
+}
+
+# Sets on the seeded pages, each by another user with its own verses
+SETS = 12
+VERSES_PER_SET = 5
+
+
+@unittest.skipUnless(DATABASE_URL, "needs a database")
+class QueryBudgetTestCase(QueryBudgetMixin, TestCase):
+    """Test the number of SQL statements of each view."""
+
+    def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        db.drop_all()
+        db.create_all()
+
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password="HASHED", first_name="fn", last_name=f"ln{i}")
+                 for i in range(SETS)]
+        db.session.add_all(users)
+        db.session.flush()
+
+        sets = []
+        for i, user in enumerate(users):
+            the_set = Set(name=f"grace {i}", description="grace and peace",
+                          user_id=user.id)
+            db.session.add(the_set)
+            db.session.flush()
+            for position in range(VERSES_PER_SET):
+                verse = Verse(reference=f"John {i + 1}:{position + 1}",
+                              verse="In the beginning was the Word")
+                db.session.add(verse)
+                db.session.flush()
+                db.session.add(SetVerse(set_id=the_set.id, verse_id=verse.id,
+                                        position=position))
+            sets.append(the_set)
+
+        self.user_id = users[0].id
+        self.set_id = sets[0].id
+        self.other_set_id = sets[1].id
+
+        db.session.add_all([Favorite(user_id=self.user_id, set_id=s.id)
+                            for s in sets[1:]])
+        db.session.commit()
+        db.session.remove()
+
+        # Render every fragment, as on a cold cache
+        fragment_cache.clear()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(self.user_id)
+
+    def test_homepage(self):
+        resp = self.assertQueryBudget(BUDGETS["homepage.index"], "/")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_explore(self):
+        resp = self.assertQueryBudget(BUDGETS["homepage.explore"],
+                                      "/explore")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"ln11", resp.data)
+
+    def test_search(self):
+        resp = self.assertQueryBudget(BUDGETS["homepage.search"],
+                                      "/search?term=grace")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"ln9", resp.data)
+
+    def test_show_set(self):
+        resp = self.assertQueryBudget(BUDGETS["sets.show_set"],
+                                      f"/sets/{self.set_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"John 1:5", resp.data)
+
+    def test_show_set_logged_in(self):
+        self.login()
+        resp = self.assertQueryBudget(BUDGETS["sets.show_set (logged in)"],
+                                      f"/sets/{self.other_set_id}")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_show_set_cards(self):
+        resp = self.assertQueryBudget(BUDGETS["sets.show_set_cards"],
+                                      f"/sets/{self.set_id}/cards")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_lookup_set(self):
+        resp = self.assertQueryBudget(BUDGETS["api.lookup_set"],
+                                      f"/api/sets/{self.set_id}")
+        self.assertEqual(len(resp.get_json()["cards"]), VERSES_PER_SET)
+
+    def test_user_profile(self):
+        resp = self.assertQueryBudget(BUDGETS["users.show_user_profile"],
+                                      f"/users/{self.user_id}")
+        self.assertEqual(resp.status_code, 200)
+
+    def test_user_favorites(self):
+        resp = self.assertQueryBudget(BUDGETS["users.show_user_favorites"],
+                                      f"/users/{self.user_id}/favorites")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"ln10", resp.data)
+
+    def test_toggle_favorite(self):
+        self.login()
+        resp = self.assertQueryBudget(BUDGETS["api.toggle_favorite"],
+                                      f"/api/sets/{self.set_id}/favorite",
+                                      method="POST")
+        self.assertEqual(resp.get_json(), {"message": "Added"})
@@ -0,0 +1,68 @@
+"""Rate limit tests."""
+
+# run these tests like:
+#
+#    python -m unittest project.__tests__.test_rate_limit
+
+
+import threading
+from unittest import TestCase
+
+from ..cache import MemoryCache
+from ..rate_limit import take_token
+
+
+class TokenBucketTestCase(TestCase):
+    """Test taking tokens and getting them back over time."""
+
+    def test_burst_then_wait(self):
+        """ A full bucket allows a burst, then one token per refill """
+
+        bucket = None
+        for _ in range(5):
+            bucket, wait = take_token(bucket, 5, 60, now=0)
+            self.assertEqual(wait, 0)
+
+        bucket, wait = take_token(bucket, 5, 60, now=0)
+        self.assertEqual(wait, 12)
+
+        bucket, wait = take_token(bucket, 5, 60, now=12)
+        self.assertEqual(wait, 0)
+
+    def test_checking_takes_nothing(self):
+        """ A cost of 0 tells whether a token is left without taking it """
+
+        bucket, wait = take_token(None, 1, 60, now=0, cost=0)
+        self.assertEqual((bucket, wait), ((1, 0), 0))
+
+        bucket, wait = take_token(bucket, 1, 60, now=0)
+        bucket, wait = take_token(bucket, 1, 60, now=0, cost=0)
+        self.assertEqual(wait, 60)
+
+    def test_bucket_never_overflows(self):
+        bucket, _ = take_token(None, 5, 60, now=0)
+        bucket, _ = take_token(bucket, 5, 60, now=3600)
+
+        self.assertEqual(bucket, (4, 3600))
+
+
+class CacheUpdateTestCase(TestCase):
+    """Test that concurrent updates are not lost."""
+
+    def test_memory_cache(self):
+        backend = MemoryCache()
+
+        def add_one(count):
+            return (count or 0) + 1, None
+
+        def hit():
+            for _ in range(50):
+                backend.update("count", add_one)
+
+        threads = [threading.Thread(target=hit) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(backend.get("count"), 200)
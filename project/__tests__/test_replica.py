@@ -0,0 +1,101 @@
+"""Read replica routing tests."""
+
+# These tests need two local Postgres instances, one acting as the
+# primary and one as the replica, run them like:
+#
+#    PRIMARY_TEST_DATABASE_URL=postgresql://localhost:5432/mtword_test \
+#    REPLICA_TEST_DATABASE_URL=postgresql://localhost:5433/mtword_test \
+#    python -m unittest project.__tests__.test_replica
+#
+# The instances do not have to replicate: each one gets its own data
+# so we can tell which one answered a request.
+
+
+import os
+import unittest
+from unittest import TestCase
+
+PRIMARY_URL = os.environ.get('PRIMARY_TEST_DATABASE_URL')
+REPLICA_URL = os.environ.get('REPLICA_TEST_DATABASE_URL')
+
+if PRIMARY_URL and REPLICA_URL:
+    from .. import create_app
+    from ..config import TestingConfig
+    from ..models import db, User, Set
+    from ..replica import replica_state
+
+    app = create_app(TestingConfig,
+                     SQLALCHEMY_DATABASE_URI=PRIMARY_URL,
+                     SQLALCHEMY_BINDS={'replica': REPLICA_URL})
+
+
+@unittest.skipUnless(PRIMARY_URL and REPLICA_URL,
+                     "needs a primary and a replica database")
+class ReplicaRoutingTestCase(TestCase):
+    """Test which database answers each request."""
+
+    def setUp(self):
+        """ Create the same set on both databases with different names """
+
+        self.ctx = app.app_context()
+        self.ctx.push()
+
+        self.replica = db.get_engine(app, bind='replica')
+
+        for engine in (db.engine, self.replica):
+            db.Model.metadata.drop_all(bind=engine)
+            db.Model.metadata.create_all(bind=engine)
+
+        for engine, name in ((db.engine, "primary"),
+                             (self.replica, "replica")):
+            with engine.begin() as conn:
+                conn.execute(User.__table__.insert(), id=1,
+                             first_name="fn", last_name="ln",
+                             email="test@test.com", username="test",
+                             password="HASHED")
+                conn.execute(Set.__table__.insert(), id=1,
+                             name=name, user_id=1)
+
+        replica_state['checked_at'] = 0
+        app.config['REPLICA_MAX_LAG'] = 10
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """ Clean up the session """
+
+        db.session.rollback()
+        db.session.remove()
+        self.ctx.pop()
+
+    def test_get_reads_from_replica(self):
+        """ GET requests are answered by the replica """
+
+        resp = self.client.get("/sets/1")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("replica", resp.get_data(as_text=True))
+        self.assertEqual(replica_state['lag'], 0)
+
+    def test_lagging_replica_is_skipped(self):
+        """ The primary is used when the replica is too far behind """
+
+        app.config['REPLICA_MAX_LAG'] = -1
+
+        resp = self.client.get("/sets/1")
+
+        self.assertIn("primary", resp.get_data(as_text=True))
+        self.assertFalse(replica_state['healthy'])
+
+    def test_reads_after_write_use_primary(self):
+        """ After a POST the user reads their own writes from the primary """
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['_user_id'] = "1"
+
+            resp = c.post("/api/sets/1/favorite")
+            self.assertEqual(resp.json["message"], "Added")
+
+            resp = c.get("/sets/1")
+            self.assertIn("primary", resp.get_data(as_text=True))
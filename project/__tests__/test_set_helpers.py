@@ -0,0 +1,68 @@
+"""Set helper tests."""
+
+# run these tests like:
+#
+#    python -m unittest project.__tests__.test_set_helpers
+
+
+from unittest import TestCase
+
+from ..helpers.sets import diff_set_verses
+
+
+class DiffSetVersesTestCase(TestCase):
+    """Test the diff used to update the verses of a set."""
+
+    def setUp(self):
+        """ A set with 150 cards in order """
+
+        self.rows = [(i + 1, 100 + i, i) for i in range(150)]
+        self.verse_ids = [100 + i for i in range(150)]
+
+    def test_no_changes(self):
+        """ Nothing is touched when the verses are the same """
+
+        self.assertEqual(diff_set_verses(self.rows, self.verse_ids),
+                         ([], [], []))
+
+    def test_replace_one_card(self):
+        """ Replacing one card only touches one row """
+
+        self.verse_ids[70] = 999
+
+        inserts, updates, deletes = diff_set_verses(self.rows,
+                                                    self.verse_ids)
+
+        self.assertEqual(inserts, [])
+        self.assertEqual(deletes, [])
+        self.assertEqual(updates,
+                         [{"id": 71, "verse_id": 999, "position": 70}])
+
+    def test_swap_two_cards(self):
+        """ Swapping cards only updates their positions """
+
+        self.verse_ids[0], self.verse_ids[1] = \
+            self.verse_ids[1], self.verse_ids[0]
+
+        inserts, updates, deletes = diff_set_verses(self.rows,
+                                                    self.verse_ids)
+
+        self.assertEqual((inserts, deletes), ([], []))
+        self.assertCountEqual(updates, [
+            {"id": 1, "verse_id": 100, "position": 1},
+            {"id": 2, "verse_id": 101, "position": 0},
+        ])
+
+    def test_add_and_remove_cards(self):
+        """ New cards are inserted and removed cards are deleted """
+
+        inserts, updates, deletes = diff_set_verses(
+            [(1, 10, 0), (2, 20, 1)], [10, 20, 30])
+
+        self.assertEqual(inserts, [{"verse_id": 30, "position": 2}])
+        self.assertEqual((updates, deletes), ([], []))
+
+        inserts, updates, deletes = diff_set_verses(
+            [(1, 10, 0), (2, 20, 1)], [10])
+
+        self.assertEqual((inserts, updates, deletes), ([], [], [2]))
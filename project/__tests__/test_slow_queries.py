@@ -0,0 +1,49 @@
+"""Slow query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest project.__tests__.test_slow_queries
+
+
+from unittest import TestCase
+
+from ..slow_queries import normalize, fingerprint, can_explain
+
+SEARCH = """SELECT sets.id AS sets_id, sets.name AS sets_name
+FROM sets
+WHERE sets.id IN (%(id_1)s, %(id_2)s, %(id_3)s)
+ORDER BY CASE sets.id WHEN %(param_1)s THEN %(param_2)s
+WHEN %(param_3)s THEN %(param_4)s WHEN %(param_5)s THEN %(param_6)s END"""
+
+
+class NormalizeTestCase(TestCase):
+    """Test that the same query with other values looks the same."""
+
+    def test_search_with_any_number_of_results(self):
+        """ The ids and their CASE are one statement, whatever their count """
+
+        shorter = SEARCH.replace(", %(id_3)s", "").replace(
+            " WHEN %(param_5)s THEN %(param_6)s", "")
+
+        self.assertEqual(normalize(SEARCH), normalize(shorter))
+        self.assertEqual(
+            normalize(SEARCH),
+            "SELECT sets.id AS sets_id, sets.name AS sets_name FROM sets "
+            "WHERE sets.id IN (?, ...) ORDER BY CASE sets.id "
+            "WHEN ? THEN ? ... END")
+
+    def test_literals_are_taken_out(self):
+        self.assertEqual(
+            normalize("SELECT * FROM sets WHERE name ILIKE '%it''s%' "
+                      "LIMIT 10 OFFSET 20"),
+            "SELECT * FROM sets WHERE name ILIKE ? LIMIT ? OFFSET ?")
+
+    def test_other_statements_differ(self):
+        self.assertNotEqual(
+            fingerprint(normalize("SELECT * FROM sets WHERE id = 1")),
+            fingerprint(normalize("SELECT * FROM verses WHERE id = 1")))
+
+    def test_only_reads_are_explained(self):
+        self.assertTrue(can_explain("SELECT 1", False))
+        self.assertFalse(can_explain("UPDATE sets SET name = 'a'", False))
+        self.assertFalse(can_explain("SELECT * FROM jobs FOR UPDATE", False))
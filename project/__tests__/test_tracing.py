@@ -0,0 +1,145 @@
+"""Tracing tests."""
+
+# run these tests like:
+#
+#    python -m unittest project.__tests__.test_tracing
+
+
+from unittest import TestCase
+
+from ..tracing import Tracer, TracingMiddleware, parse_traceparent
+
+TRACEPARENT = "00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01"
+
+
+class ListExporter(object):
+    """ Keep the exported spans """
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans += spans
+
+
+class TracerTestCase(TestCase):
+    """Test recording spans and carrying traces to jobs."""
+
+    def setUp(self):
+        self.tracer = Tracer()
+        self.exporter = self.tracer.exporter = ListExporter()
+
+    def by_name(self):
+        return {span['name']: span for span in self.exporter.spans}
+
+    def test_spans_nest_under_the_root(self):
+        """ Stages are children of the span they run in """
+
+        with self.tracer.start_trace("job sets.save"):
+            with self.tracer.span("get_all_verses"):
+                with self.tracer.span("esv", "CLIENT"):
+                    pass
+            with self.tracer.span("update_set_verses"):
+                pass
+
+        spans = self.by_name()
+
+        self.assertEqual(len(spans), 4)
+        self.assertEqual(spans["esv"]['parentId'],
+                         spans["get_all_verses"]['id'])
+        self.assertEqual(spans["update_set_verses"]['parentId'],
+                         spans["job sets.save"]['id'])
+        self.assertNotIn('parentId', spans["job sets.save"])
+        self.assertEqual({span['traceId'] for span in spans.values()},
+                         {spans["esv"]['traceId']})
+
+    def test_job_continues_the_trace_that_queued_it(self):
+        """ The traceparent saved with a job links it to the request """
+
+        with self.tracer.start_trace("POST sets.create_new_set"):
+            with self.tracer.span("start_set_job"):
+                trace_parent = self.tracer.traceparent()
+
+        with self.tracer.start_trace("job sets.save", parent=trace_parent):
+            pass
+
+        spans = self.by_name()
+
+        self.assertEqual(spans["job sets.save"]['traceId'],
+                         spans["POST sets.create_new_set"]['traceId'])
+        self.assertEqual(spans["job sets.save"]['parentId'],
+                         spans["start_set_job"]['id'])
+
+    def test_nothing_is_recorded_outside_a_trace(self):
+        """ Spans without a trace, or of unsampled traces, are dropped """
+
+        with self.tracer.span("sql"):
+            pass
+
+        self.tracer.sample_rate = 0
+        with self.tracer.start_trace("GET homepage.index"):
+            with self.tracer.span("sql"):
+                self.assertIsNone(self.tracer.traceparent())
+
+        self.assertEqual(self.exporter.spans, [])
+
+    def test_callers_cannot_force_sampling(self):
+        """ A request's traceparent is continued but the local rate
+            decides whether it is recorded
+        """
+
+        self.tracer.sample_rate = 0
+        with self.tracer.start_trace("GET homepage.index",
+                                     parent=TRACEPARENT, trusted=False):
+            self.assertEqual(self.tracer.headers(), {})
+
+        self.tracer.sample_rate = 1
+        with self.tracer.start_trace("GET homepage.index",
+                                     parent=TRACEPARENT, trusted=False):
+            with self.tracer.span("esv", "CLIENT") as esv:
+                self.assertEqual(
+                    self.tracer.headers(),
+                    {'traceparent': f"00-{esv.trace_id}-{esv.span_id}-01"})
+
+        self.assertEqual(self.by_name()["esv"]['traceId'],
+                         TRACEPARENT.split("-")[1])
+
+    def test_streamed_response_ends_when_closed(self):
+        """ The request span lasts until the server closes the body """
+
+        def stream(environ, start_response):
+            start_response("200 OK", [])
+            yield b"first"
+            with self.tracer.span("export_rows"):
+                yield b"second"
+
+        app = TracingMiddleware(stream, self.tracer)
+        body = app({'REQUEST_METHOD': "GET", 'PATH_INFO': "/export"},
+                   lambda status, headers, exc_info=None: None)
+
+        self.assertEqual(list(body), [b"first", b"second"])
+        self.assertEqual(self.exporter.spans, [])
+
+        body.close()
+
+        spans = self.by_name()
+        self.assertEqual(spans["export_rows"]['parentId'],
+                         spans["GET /export"]['id'])
+        self.assertEqual(spans["GET /export"]['tags']['http.status_code'],
+                         "200")
+
+    def test_errors_are_tagged(self):
+        """ A failing stage is marked on its span """
+
+        with self.assertRaises(ValueError):
+            with self.tracer.start_trace("job search.index"):
+                with self.tracer.span("index_models"):
+                    raise ValueError("no index")
+
+        self.assertEqual(self.by_name()["index_models"]['tags']['error'],
+                         "ValueError")
+
+    def test_malformed_traceparent_starts_a_new_trace(self):
+        self.assertEqual(parse_traceparent("00-abc-def-01"),
+                         (None, None, None))
+        self.assertEqual(parse_traceparent(None), (None, None, None))
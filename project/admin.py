@@ -1,7 +1,17 @@
-from flask import redirect, url_for, flash
+import os
+
+from flask import redirect, url_for, flash, abort, jsonify, Response
+from markupsafe import Markup
 from flask_login import current_user
 from flask_admin.contrib.sqla import ModelView
-from flask_admin import AdminIndexView
+from flask_admin import Admin, AdminIndexView, BaseView, expose
+
+from project.models import db, User, Set, Verse, PlanImport, Job, \
+    ProfileRecord, SlowQuery
+from project.forms import ImportPlanForm
+from project.helpers.plans import start_plan_import
+from project.metrics import metrics, summarize
+from project.profiling import flame_graph, function_stats
 
 
 class MTWordModelView(ModelView):
@@ -16,6 +26,14 @@ class MTWordModelView(ModelView):
         flash("Unauthorized.", "danger")
         return redirect(url_for('homepage.index'))
 
+    def after_model_change(self, form, model, is_created):
+        if isinstance(model, User):
+            User.invalidate_cache(model.id)
+
+    def after_model_delete(self, model):
+        if isinstance(model, User):
+            User.invalidate_cache(model.id)
+
 
 class MyAdminIndexView(AdminIndexView):
     def is_accessible(self):
@@ -28,3 +46,161 @@ class MyAdminIndexView(AdminIndexView):
         # redirect to login page if user doesn't have access
         flash("Unauthorized.", "danger")
         return redirect(url_for('homepage.index'))
+
+
+class ImportPlanView(BaseView):
+    """ Upload a reading plan and import it as sets """
+
+    def is_accessible(self):
+        if current_user.is_anonymous:
+            return False
+
+        return current_user.is_admin
+
+    def inaccessible_callback(self, name, **kwargs):
+        # redirect to login page if user doesn't have access
+        flash("Unauthorized.", "danger")
+        return redirect(url_for('homepage.index'))
+
+    @expose('/', methods=('GET', 'POST'))
+    def index(self):
+        form = ImportPlanForm()
+
+        if form.validate_on_submit():
+            user = User.query.filter_by(username=form.username.data).first()
+
+            if user is None:
+                form.username.errors = ["No user with this username"]
+                return self.render('admin/import_plan.html', form=form)
+
+            upload = form.plan.data
+            fmt = os.path.splitext(upload.filename)[1].lstrip(".").lower()
+
+            try:
+                plan_import = start_plan_import(upload.read(), fmt,
+                                                user_id=user.id,
+                                                filename=upload.filename)
+            except ValueError as e:
+                form.plan.errors = [f"Could not read the plan: {e}"]
+                return self.render('admin/import_plan.html', form=form)
+
+            return redirect(url_for('.show', plan_import_id=plan_import.id))
+
+        return self.render('admin/import_plan.html', form=form)
+
+    @expose('/<int:plan_import_id>')
+    def show(self, plan_import_id):
+        """ Progress of the import, polled until it is finished """
+
+        plan_import = PlanImport.query.get(plan_import_id) or abort(404)
+
+        return self.render('admin/plan_import.html', plan_import=plan_import)
+
+    @expose('/<int:plan_import_id>/status')
+    def status(self, plan_import_id):
+        plan_import = PlanImport.query.get(plan_import_id) or abort(404)
+
+        return jsonify(plan_import=plan_import.serialize())
+
+
+class PlanImportModelView(MTWordModelView):
+    """ Imports without the uploaded plans they keep while running """
+
+    column_exclude_list = ('plan',)
+    form_excluded_columns = ('plan',)
+
+
+class MetricsView(MyAdminIndexView):
+    """ Where request time goes, per endpoint, for every process """
+
+    @expose('/')
+    def index(self):
+        return self.render('admin/metrics.html',
+                           rows=summarize(metrics.collect()))
+
+
+class SlowQueryView(MTWordModelView):
+    """ Statements over SLOW_QUERY_THRESHOLD_MS, the costliest first """
+
+    can_create = False
+    can_edit = False
+    can_view_details = True
+
+    column_list = ('endpoint', 'statement', 'calls', 'total_ms', 'max_ms',
+                   'mean_ms', 'plan_at', 'last_seen')
+    column_details_list = ('fingerprint', 'endpoint', 'caller', 'statement',
+                           'calls', 'total_ms', 'max_ms', 'mean_ms', 'plan',
+                           'plan_ms', 'plan_at', 'first_seen', 'last_seen')
+    column_sortable_list = ('endpoint', 'calls', 'total_ms', 'max_ms',
+                            'plan_at', 'last_seen')
+    column_default_sort = ('total_ms', True)
+    column_searchable_list = ('statement', 'endpoint')
+    column_filters = ('endpoint',)
+
+    column_formatters = {
+        'statement': lambda view, context, model, name:
+            model.statement[:200],
+        'total_ms': lambda view, context, model, name: f"{model.total_ms:.0f}",
+        'max_ms': lambda view, context, model, name: f"{model.max_ms:.0f}",
+        'mean_ms': lambda view, context, model, name: f"{model.mean_ms:.0f}",
+    }
+    column_formatters_detail = {
+        'statement': lambda view, context, model, name:
+            Markup("<pre>{}</pre>").format(model.statement),
+        'plan': lambda view, context, model, name:
+            Markup("<pre>{}</pre>").format(model.plan) if model.plan else "",
+    }
+
+
+class ProfilesView(MyAdminIndexView):
+    """ Requests profiled on demand, as flame graphs and sorted stats """
+
+    @expose('/')
+    def index(self):
+        records = ProfileRecord.query.order_by(
+            ProfileRecord.id.desc()).limit(100).all()
+
+        return self.render('admin/profiles.html', records=records)
+
+    @expose('/<int:record_id>')
+    def show(self, record_id):
+        record = ProfileRecord.query.get(record_id) or abort(404)
+
+        return self.render('admin/profile.html',
+                           record=record,
+                           flame=flame_graph(record.stacks),
+                           stats=function_stats(record.stacks)[:100])
+
+    @expose('/<int:record_id>/folded')
+    def folded(self, record_id):
+        """ The samples for flamegraph.pl or speedscope """
+
+        record = ProfileRecord.query.get(record_id) or abort(404)
+
+        return Response("".join(f"{stack} {count}\n"
+                                for stack, count in record.stacks.items()),
+                        mimetype="text/plain")
+
+
+def connect_admin(app):
+    """ Add the administrative views to the app """
+
+    admin = Admin(app,
+                  name='MTWord',
+                  template_mode='bootstrap3',
+                  index_view=MyAdminIndexView())
+
+    admin.add_view(MTWordModelView(User, db.session))
+    admin.add_view(MTWordModelView(Set, db.session))
+    admin.add_view(MTWordModelView(Verse, db.session))
+    admin.add_view(PlanImportModelView(PlanImport, db.session))
+    admin.add_view(MTWordModelView(Job, db.session))
+    admin.add_view(SlowQueryView(SlowQuery, db.session,
+                                 name='Slow Queries'))
+    admin.add_view(ImportPlanView(name='Import Plan', endpoint='import_plan'))
+    admin.add_view(MetricsView(name='Metrics', endpoint='metrics_admin',
+                               url='/admin/metrics'))
+    admin.add_view(ProfilesView(name='Profiles', endpoint='profiles_admin',
+                                url='/admin/profiles'))
+
+    return admin
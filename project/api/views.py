@@ -2,7 +2,9 @@ from flask import Blueprint, jsonify, request
 
 from flask_login import login_required, current_user
 
-from ..helpers.sets import get_esv_text
+from ..helpers.sets import get_esv_text, lookup_references, stored_verses
+from ..helpers.http import conditional_response, add_cache_headers, \
+    negotiate_encoding, json_response
 from ..models import db, Set
 
 api = Blueprint('api', __name__)
@@ -16,26 +18,97 @@ def lookup_verse():
     """ Look up the verse with the reference and return JSON """
 
     reference = request.args["reference"]
-    get_verse_num = request.args["get_verse_num"]
+    get_verse_num = request.args.get("get_verse_num", "true") != "false"
+
+    release_connection()
 
     info = get_esv_text(reference, get_verse_num)
 
     return jsonify(info=info)
 
 
+# Most references that can be looked up with one request
+MAX_BATCH_REFERENCES = 200
+
+
+@api.route("/api/verses", methods=["POST"])
+@login_required
+def lookup_verses():
+    """ Look up many references at once and return JSON
+        - Accepts {"references": [...]} and returns the info of
+          every reference, in the same order
+        - Only for logged in users, like the set forms that call it,
+          since one request can look up many passages
+    """
+
+    data = request.get_json(silent=True) or {}
+    references = data.get("references")
+
+    if not isinstance(references, list) or \
+            len(references) > MAX_BATCH_REFERENCES:
+        return jsonify(
+            error=f"Send a list of at most {MAX_BATCH_REFERENCES} references"
+        ), 400
+
+    get_verse_num = data.get("get_verse_num", True) is not False
+
+    references = [str(ref) for ref in references]
+    stored = stored_verses(references)
+
+    release_connection()
+
+    infos = lookup_references(references, get_verse_num, stored)
+
+    return jsonify(infos=infos)
+
+
 ####################################################################
 # API Verse Routes
 
 
+CARD_FIELDS = ("reference", "verse")
+
+
 @api.route("/api/sets/<set_id>")
 def lookup_set(set_id):
-    """ Look up the verse with the reference and return JSON """
+    """ Look up the cards of the set and return JSON
+        - limit and offset return part of the cards
+        - fields picks the keys of each card, e.g. fields=reference
+        - The response is compressed with brotli or gzip if accepted
+    """
 
     current_set = Set.query.get_or_404(set_id)
 
-    cards = [verse.serialize() for verse in current_set.verses]
+    limit = request.args.get("limit", type=int)
+    if limit is not None:
+        limit = max(limit, 0)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    fields = [field for field in request.args.get("fields", "").split(",")
+              if field in CARD_FIELDS] or list(CARD_FIELDS)
+
+    encoding = negotiate_encoding()
+
+    version = f"set-{current_set.id}-{current_set.version}-" \
+        f"{offset}-{limit}-{'.'.join(fields)}"
 
-    return jsonify(cards=cards)
+    # Small bodies are sent uncompressed, so the client may hold either
+    # the compressed or the identity version
+    etags = [f"{version}-{encoding}"] if encoding else []
+    etags.append(f"{version}-identity")
+    etag = next((tag for tag in etags if request.if_none_match.contains(tag)),
+                etags[0])
+
+    # Answer from the set row alone when the client is up to date
+    response = conditional_response(etag, current_set.updated_at)
+
+    if response is None:
+        rows = Set.card_rows(current_set.id, fields, limit, offset)
+        cards = [dict(zip(fields, row)) for row in rows]
+        response = json_response({"cards": cards}, encoding)
+        etag = f"{version}-" \
+            f"{response.headers.get('Content-Encoding', 'identity')}"
+
+    return add_cache_headers(response, etag, current_set.updated_at)
 
 
 @api.route("/api/sets/<int:set_id>/favorite", methods=["POST"])
@@ -59,7 +132,15 @@ def toggle_favorite(set_id):
     return jsonify(message=message)
 
 
+####################################################################
+# Helper Function
 
 
+def release_connection():
+    """ End the transaction so the connection goes back to the pool
+        rather than being held while waiting on the ESV API
+        - Unlike closing the session, current_user stays attached and
+          is loaded again if it is used later in the request
+    """
 
-
+    db.session.commit()
@@ -0,0 +1,297 @@
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+from project.metrics import metrics
+
+
+class NullCache(object):
+    """ Cache that never stores anything """
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout=None):
+        return
+
+    def delete(self, key):
+        return
+
+    def clear(self):
+        return
+
+
+class MemoryCache(object):
+    """ Cache local to the process
+        - Least recently used entries are dropped past max_entries
+        - With max_entries None no entry is dropped before it expires,
+          expired ones are swept every default_timeout seconds
+    """
+
+    def __init__(self, default_timeout=300, max_entries=1000):
+        self.default_timeout = default_timeout
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._swept_at = time.time()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires and expires < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        expires = time.time() + timeout if timeout else 0
+        with self._lock:
+            self._set(key, value, expires)
+
+    def _set(self, key, value, expires):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+
+        if self.max_entries is None:
+            self._sweep()
+            return
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _sweep(self):
+        now = time.time()
+        if now - self._swept_at < self.default_timeout:
+            return
+
+        self._swept_at = now
+        for key in [key for key, (expires, value) in self._entries.items()
+                    if expires and expires < now]:
+            del self._entries[key]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def update(self, key, func, timeout=None):
+        """ Replace the entry atomically
+            - func gets the value, None when missing, and returns the
+              new value and what update returns
+        """
+
+        timeout = self.default_timeout if timeout is None else timeout
+        with self._lock:
+            expires, value = self._entries.get(key, (0, None))
+            if expires and expires < time.time():
+                value = None
+            value, result = func(value)
+            self._set(key, value, time.time() + timeout if timeout else 0)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def make_private_dir(path):
+    """ Make the directory, readable and writable by us only
+        - Entries are unpickled, so a directory others could have put
+          files in is refused rather than used
+    """
+
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or \
+            info.st_mode & 0o022:
+        raise RuntimeError(f"The cache directory {path} must belong to "
+                           f"this user and be writable by it only")
+
+    # Made before directories were private, nobody else could write to it
+    if info.st_mode & 0o077:
+        os.chmod(path, 0o700)
+
+
+class FileSystemCache(object):
+    """ Cache stored in a local directory
+        - Shared by every worker process on the same machine
+        - Writes are atomic so readers never see half written entries
+        - The directory is private to the user running the app
+        - Entries past max_entries are dropped every tenth of max_entries
+          writes, so the directory is not listed on every write
+        - With max_entries None no entry is dropped before it expires,
+          expired ones are swept every default_timeout seconds
+    """
+
+    def __init__(self, cache_dir, default_timeout=300, max_entries=10000):
+        self.cache_dir = cache_dir
+        self.default_timeout = default_timeout
+        self.max_entries = max_entries
+        self._swept_at = time.time()
+        self._writes = 0
+        make_private_dir(cache_dir)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires and expires < time.time():
+            self._remove(path)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        expires = time.time() + timeout if timeout else 0
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            self._remove(tmp)
+        self._prune()
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            self._remove(os.path.join(self.cache_dir, name))
+
+    def _prune(self):
+        """ Drop the oldest entries once there are too many """
+
+        if self.max_entries is None:
+            self._sweep()
+            return
+
+        self._writes += 1
+        if self._writes < max(self.max_entries // 10, 1):
+            return
+
+        self._writes = 0
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        if len(names) <= self.max_entries:
+            return
+        paths = [os.path.join(self.cache_dir, name) for name in names]
+        paths.sort(key=lambda path: self._mtime(path))
+        for path in paths[:len(paths) - self.max_entries]:
+            self._remove(path)
+
+    def _sweep(self):
+        """ Drop the expired entries """
+
+        now = time.time()
+        if now - self._swept_at < self.default_timeout:
+            return
+
+        self._swept_at = now
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                with open(path, 'rb') as f:
+                    expires, value = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+            if expires and expires < now:
+                self._remove(path)
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class Cache(object):
+    """ Cache configured from the app
+        - CACHE_TYPE: "filesystem" (default), "memory" or "null"
+        - CACHE_DIR, CACHE_DEFAULT_TIMEOUT, CACHE_MAX_ENTRIES
+    """
+
+    def __init__(self):
+        self.backend = NullCache()
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_TYPE', 'filesystem')
+        app.config.setdefault('CACHE_DIR', os.path.join(
+            tempfile.gettempdir(), 'mtword-cache'))
+        app.config.setdefault('CACHE_DEFAULT_TIMEOUT', 300)
+        app.config.setdefault('CACHE_MAX_ENTRIES', 10000)
+
+        self.backend = make_backend(
+            app.config['CACHE_TYPE'],
+            cache_dir=app.config['CACHE_DIR'],
+            default_timeout=app.config['CACHE_DEFAULT_TIMEOUT'],
+            max_entries=app.config['CACHE_MAX_ENTRIES'])
+
+    def get(self, key):
+        value = self.backend.get(key)
+        metrics.add_cache_lookup("cache", value is not None)
+        return value
+
+    def set(self, key, value, timeout=None):
+        return self.backend.set(key, value, timeout)
+
+    def delete(self, key):
+        return self.backend.delete(key)
+
+    def clear(self):
+        return self.backend.clear()
+
+
+def make_backend(cache_type, cache_dir=None, default_timeout=300,
+                 max_entries=1000):
+    """ Make one of the cache backends by name """
+
+    if cache_type == 'filesystem':
+        return FileSystemCache(cache_dir, default_timeout, max_entries)
+    if cache_type == 'memory':
+        return MemoryCache(default_timeout, max_entries)
+    if cache_type == 'null':
+        return NullCache()
+
+    raise ValueError(f"Unknown cache type: {cache_type}")
+
+
+cache = Cache()
+
+
+def connect_cache(app):
+    """ Connect the cache to the app """
+
+    cache.init_app(app)
@@ -0,0 +1,142 @@
+import csv
+import os
+import signal
+import threading
+
+import click
+
+from project.jobs import Worker, enqueue, requeue_dead_jobs
+from project.models import db, User, Set
+from project.helpers.plans import PLAN_BATCH_SIZE, read_plan, plan_key, \
+    import_plan
+from project.helpers.export import EXPORT_FORMATS, export_rows, export_sets
+
+
+def register_commands(app):
+    """ Add the MTWord commands to the flask CLI """
+
+    @app.cli.command("import-plan")
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--user", "username", required=True,
+                  help="Username of the owner of the new sets")
+    @click.option("--format", "fmt", type=click.Choice(["csv", "json"]),
+                  help="Format of the plan, guessed from the extension")
+    @click.option("--batch-size", default=PLAN_BATCH_SIZE, show_default=True,
+                  help="Number of sets imported together")
+    def import_plan_command(path, username, fmt, batch_size):
+        """ Import a reading plan as sets, resuming a previous import
+            of the same plan if there is one
+        """
+
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.BadParameter(f"No user named {username}",
+                                     param_hint="--user")
+
+        fmt = fmt or os.path.splitext(path)[1].lstrip(".").lower()
+        if fmt not in ("csv", "json"):
+            raise click.BadParameter(
+                f"Can not guess the format of {path}, give it with --format",
+                param_hint="PATH")
+
+        with open(path, "rb") as f:
+            key = plan_key(user.id, f.read())
+
+        def report(plan_import):
+            click.echo(f"{plan_import.entries_done} entries done, "
+                       f"{plan_import.sets_created} sets created, "
+                       f"{plan_import.entries_skipped} skipped")
+
+        with open(path, newline="", encoding="utf8") as f:
+            try:
+                plan_import = import_plan(read_plan(f, fmt),
+                                          user_id=user.id,
+                                          key=key,
+                                          filename=os.path.basename(path),
+                                          batch_size=batch_size,
+                                          progress=report)
+            except (ValueError, csv.Error) as e:
+                # The batches before the broken entry are kept
+                db.session.rollback()
+                raise click.BadParameter(f"Could not read the plan: {e}",
+                                         param_hint="PATH")
+
+        click.echo(f"Imported {plan_import.sets_created} sets "
+                   f"from {plan_import.filename}")
+
+    @app.cli.command("export-sets")
+    @click.option("--user", "username",
+                  help="Only export the sets of this user")
+    @click.option("--format", "fmt", type=click.Choice(list(EXPORT_FORMATS)),
+                  default="ndjson", show_default=True)
+    @click.option("--output", default="-", show_default=True,
+                  help="File to write to, - for stdout")
+    def export_sets_command(username, fmt, output):
+        """ Export the sets and their verses of one user or of everyone """
+
+        user_id = None
+
+        if username:
+            user = User.query.filter_by(username=username).first()
+            if user is None:
+                raise click.BadParameter(f"No user named {username}",
+                                         param_hint="--user")
+            user_id = user.id
+
+        with click.open_file(output, "w", encoding="utf8") as f:
+            for chunk in export_sets(export_rows(user_id), fmt):
+                f.write(chunk)
+
+    @app.cli.command("init-db")
+    def init_db_command():
+        """ Create the tables that do not exist yet """
+
+        db.create_all()
+
+        click.echo("Created the tables")
+
+    @app.cli.command("worker")
+    @click.option("--threads", default=1, show_default=True,
+                  help="Number of jobs run at the same time")
+    @click.option("--burst", is_flag=True,
+                  help="Stop once there are no more jobs due")
+    def worker_command(threads, burst):
+        """ Run the queued background jobs until stopped
+            - SIGTERM and SIGINT let the running jobs finish first
+        """
+
+        stop = threading.Event()
+
+        def shutdown(signum, frame):
+            click.echo("Stopping after the running jobs...")
+            stop.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        workers = [threading.Thread(target=Worker(app, stop=stop).run,
+                                    kwargs={"burst": burst},
+                                    name=f"job-worker-{i}")
+                   for i in range(threads)]
+
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            # Joining with a timeout keeps the signals handled
+            while thread.is_alive():
+                thread.join(1)
+
+    @app.cli.command("requeue-jobs")
+    def requeue_jobs_command():
+        """ Queue the dead jobs again for a new set of attempts """
+
+        click.echo(f"Queued {requeue_dead_jobs()} dead jobs again")
+
+    @app.cli.command("reindex")
+    def reindex_command():
+        """ Queue a job indexing every set again """
+
+        enqueue("search.reindex", Set.__tablename__)
+        db.session.commit()
+
+        click.echo("Queued the reindex of the sets")
@@ -0,0 +1,149 @@
+import os
+import re
+
+
+class Config(object):
+    """ Settings shared by every environment, read from the environment """
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL',
+                                             'postgresql:///mtword')
+    SQLALCHEMY_TRACK_MODIFICATIONS = True
+    SQLALCHEMY_ECHO = False
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    }
+
+    # Optional read replica used by read only requests
+    if os.environ.get('REPLICA_DATABASE_URL'):
+        SQLALCHEMY_BINDS = {
+            'replica': os.environ['REPLICA_DATABASE_URL']
+        }
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG', 10))
+
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+    # Seconds a password reset link works for
+    PASSWORD_RESET_MAX_AGE = 3600
+
+    CACHE_TYPE = os.environ.get('CACHE_TYPE', 'filesystem')
+    if os.environ.get('CACHE_DIR'):
+        CACHE_DIR = os.environ['CACHE_DIR']
+    if os.environ.get('PAGE_CACHE_TYPE'):
+        PAGE_CACHE_TYPE = os.environ['PAGE_CACHE_TYPE']
+    if os.environ.get('JOBS_LOCAL_WORKERS'):
+        JOBS_LOCAL_WORKERS = int(os.environ['JOBS_LOCAL_WORKERS'])
+
+    RECAPTCHA_PUBLIC_KEY = os.environ.get(
+        'RECAPTCHA_PUBLIC_KEY',
+        "6LeYIbsSAAAAACRPIllxA7wvXjIE411PfdB2gt2J")
+    RECAPTCHA_PRIVATE_KEY = os.environ.get(
+        'RECAPTCHA_PRIVATE_KEY',
+        "6LeYIbsSAAAAAJezaIq3Ft_hSTo0YtyeFG-JgRtu")
+    RECAPTCHA_ENABLED = True
+
+    ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL',
+                                       "http://localhost:9200")
+
+    FLASK_ADMIN_SWATCH = 'journal'
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+    # "file" or "zipkin" to record traces of requests and jobs
+    TRACING_EXPORTER = os.environ.get('TRACING_EXPORTER')
+    if os.environ.get('TRACING_FILE'):
+        TRACING_FILE = os.environ['TRACING_FILE']
+    if os.environ.get('TRACING_URL'):
+        TRACING_URL = os.environ['TRACING_URL']
+    TRACING_SAMPLE_RATE = float(os.environ.get('TRACING_SAMPLE_RATE', 1))
+
+    # Bearer token Prometheus sends to /metrics, not served without one
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+    # 0 turns the slow query log off
+    SLOW_QUERY_THRESHOLD_MS = float(
+        os.environ.get('SLOW_QUERY_THRESHOLD_MS', 200))
+    SLOW_QUERY_EXPLAIN_RATE = float(
+        os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+
+    # Processes hashing passwords for each worker, 0 hashes in the worker
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_TARGET_MS = float(
+        os.environ.get('PASSWORD_HASH_TARGET_MS', 250))
+
+    # 1 behind the Heroku router, which adds the client to X-Forwarded-For
+    RATE_LIMIT_PROXIES = int(os.environ.get('RATE_LIMIT_PROXIES', 0))
+
+    MAIL_SERVER = os.environ.get("MAIL_SERVER")
+    MAIL_PORT = os.environ.get("MAIL_PORT")
+    MAIL_USE_TLS = os.environ.get("MAIL_USE_TLS")
+    MAIL_USE_SSL = os.environ.get("MAIL_USE_SSL")
+    MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
+    MAIL_DEFAULT_SENDER = os.environ.get("MAIL_DEFAULT_SENDER")
+    MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+
+
+class ProductionConfig(Config):
+    DEBUG = False
+
+    # Production has no local Elasticsearch, only the hosted one
+    ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+
+
+class LoadTestConfig(ProductionConfig):
+    # Lets the virtual users of benchmarks/load.py register without
+    # solving the recaptcha
+    RECAPTCHA_ENABLED = False
+    # They all register and log in from the same address
+    RATE_LIMIT_ENABLED = False
+
+
+class TestingConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    CACHE_TYPE = 'null'
+    PAGE_CACHE_TYPE = 'null'
+    ELASTICSEARCH_URL = None
+    TRACING_EXPORTER = None
+    SLOW_QUERY_THRESHOLD_MS = None
+    PASSWORD_HASH_WORKERS = 0
+    PASSWORD_HASH_ROUNDS = 4
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'loadtest': LoadTestConfig,
+    'testing': TestingConfig,
+}
+
+
+def default_config():
+    """ The config matching FLASK_ENV """
+
+    return CONFIGS.get(os.environ.get('FLASK_ENV'), Config)
+
+
+def elasticsearch_hosts(url):
+    """ Hosts for the Elasticsearch client
+        - Hosted clusters (like Bonsai) give an https url with the
+          credentials in it, they are connected to over SSL with them
+    """
+
+    if not url:
+        return None
+
+    match = re.match(r'https://(.*):(.*)@(.*)', url)
+    if match is None:
+        return [url]
+
+    user, password, host = match.groups()
+
+    return [{
+        'host': host.rstrip('/'),
+        'port': 443,
+        'use_ssl': True,
+        'http_auth': (user, password),
+    }]
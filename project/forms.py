@@ -1,7 +1,19 @@
 from wtforms import SelectField, StringField, TextAreaField, PasswordField
 from wtforms.fields.html5 import EmailField
 from wtforms.validators import InputRequired, Length, Email
-from flask_wtf import FlaskForm, RecaptchaField
+from flask import current_app
+from flask_wtf import FlaskForm, Recaptcha, RecaptchaField
+from flask_wtf.file import FileField, FileRequired, FileAllowed
+
+
+class OptionalRecaptcha(Recaptcha):
+    """Recaptcha check skipped when RECAPTCHA_ENABLED is False."""
+
+    def __call__(self, form, field):
+        if not current_app.config['RECAPTCHA_ENABLED']:
+            return True
+
+        return super().__call__(form, field)
 
 
 class SetForm(FlaskForm):
@@ -23,6 +35,18 @@ class SetForm(FlaskForm):
     )
 
 
+class ImportPlanForm(FlaskForm):
+    """Form for importing a reading plan as sets."""
+
+    username = StringField("Owner username", validators=[InputRequired()])
+    plan = FileField("Plan",
+                     validators=[FileRequired(),
+                                 FileAllowed(["csv", "json"],
+                                             "CSV or JSON files only")],
+                     description="Columns or keys: name, description and \
+                         references (separated by ;)")
+
+
 class RegisterForm(FlaskForm):
     """Form for registering a user."""
 
@@ -39,7 +63,7 @@ class RegisterForm(FlaskForm):
                                  Length(min=6),
                                  ],
                              description="Password must be at least 6 characters long")
-    recaptcha = RecaptchaField()
+    recaptcha = RecaptchaField(validators=[OptionalRecaptcha()])
 
 
 class EditUserForm(FlaskForm):
@@ -0,0 +1,104 @@
+import csv
+import io
+import json
+
+from itertools import groupby
+
+from project.models import db, Set, SetVerse, Verse
+
+# Rows fetched from the server-side cursor at a time
+EXPORT_BATCH_SIZE = 1000
+
+# Size of the chunks sent to the client
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+EXPORT_COLUMNS = ("set_id", "name", "description", "user_id", "created_at",
+                  "position", "reference", "verse")
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def export_rows(user_id=None):
+    """ One row per card of every set (or the sets of one user)
+        - Ordered by set and card position
+        - Rows come from a server-side cursor, so memory does not grow
+          with the number of sets
+    """
+
+    query = db.session.query(
+        Set.id, Set.name, Set.description, Set.user_id, Set.created_at,
+        SetVerse.position, Verse.reference, Verse.verse
+    ).outerjoin(
+        SetVerse, SetVerse.set_id == Set.id
+    ).outerjoin(
+        Verse, Verse.id == SetVerse.verse_id
+    ).order_by(Set.id, SetVerse.position)
+
+    if user_id is not None:
+        query = query.filter(Set.user_id == user_id)
+
+    return query.yield_per(EXPORT_BATCH_SIZE)
+
+
+def export_sets(rows, fmt):
+    """ Turn the rows into chunks of text in the given format """
+
+    if fmt == "csv":
+        return export_csv(rows)
+    if fmt == "ndjson":
+        return export_ndjson(rows)
+
+    raise ValueError(f"Unknown export format: {fmt}")
+
+
+def export_csv(rows):
+    """ CSV with a header and one line per card """
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+
+    for row in rows:
+        writer.writerow(row)
+
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def export_ndjson(rows):
+    """ One JSON object per set with its cards in order """
+
+    chunk = []
+    size = 0
+
+    for set_id, cards in groupby(rows, key=lambda row: row[0]):
+        cards = list(cards)
+        first = cards[0]
+
+        line = json.dumps({
+            "id": set_id,
+            "name": first.name,
+            "description": first.description,
+            "user_id": first.user_id,
+            "created_at": first.created_at.isoformat()
+            if first.created_at else None,
+            "verses": [{"reference": card.reference, "verse": card.verse}
+                       for card in cards if card.reference is not None],
+        }) + "\n"
+
+        chunk.append(line)
+        size += len(line)
+
+        if size >= EXPORT_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+
+    yield "".join(chunk)
@@ -0,0 +1,56 @@
+from flask import render_template
+from markupsafe import Markup
+
+from project.cache import MemoryCache
+from project.metrics import metrics
+from project.models import sets_changed
+
+# Templates that only depend on the set they are rendered with
+SET_FRAGMENTS = (
+    'shared/_set_card.html',
+    'sets/_cards.html',
+    'sets/_verse_table.html',
+)
+
+# Rendered HTML of the fragments, least recently used ones are dropped
+fragment_cache = MemoryCache(default_timeout=0, max_entries=2000)
+
+
+def render_set_fragment(template, the_set, **context):
+    """ Render a template that only depends on the set, reusing the HTML
+        rendered for the same version of the set
+        - The template gets the set as `set`
+    """
+
+    key = f"{template}:{the_set.id}"
+    version = the_set.version
+
+    cached = fragment_cache.get(key)
+    hit = cached is not None and cached[0] == version
+    metrics.add_cache_lookup("fragments", hit)
+
+    if hit:
+        return cached[1]
+
+    html = Markup(render_template(template, set=the_set, **context))
+    fragment_cache.set(key, (version, html))
+
+    return html
+
+
+@sets_changed.connect
+def forget_set_fragments(set_ids):
+    """ Drop the fragments of sets changed by a commit """
+
+    for set_id in set_ids:
+        for template in SET_FRAGMENTS:
+            fragment_cache.delete(f"{template}:{set_id}")
+
+
+def connect_fragments(app):
+    """ Make the fragment cache available to the templates """
+
+    app.config.setdefault('FRAGMENT_CACHE_MAX_ENTRIES', 2000)
+    fragment_cache.max_entries = app.config['FRAGMENT_CACHE_MAX_ENTRIES']
+
+    app.jinja_env.globals['render_set_fragment'] = render_set_fragment
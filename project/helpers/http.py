@@ -0,0 +1,112 @@
+import gzip
+import json
+
+from datetime import timezone
+
+from flask import request, session, make_response, Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# Smaller bodies are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+
+def conditional_response(etag, last_modified):
+    """ Returns a 304 response when the client already has this version
+        of the page, otherwise None
+        - Pages with flash messages waiting are always rendered
+    """
+
+    if '_flashes' in session:
+        return None
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    elif request.if_modified_since:
+        fresh = http_time(last_modified) <= request.if_modified_since
+    else:
+        fresh = False
+
+    if fresh:
+        return make_response("", 304)
+
+    return None
+
+
+def add_cache_headers(response, etag, last_modified, private=False):
+    """ Let browsers and proxies keep the response and revalidate it
+        with If-None-Match or If-Modified-Since
+    """
+
+    response.set_etag(etag)
+    response.last_modified = http_time(last_modified)
+
+    if private:
+        response.cache_control.private = True
+        response.vary.add("Cookie")
+    else:
+        response.cache_control.public = True
+
+    response.cache_control.no_cache = True
+
+    return response
+
+
+def http_time(value):
+    """ Naive UTC datetime with the precision of HTTP dates """
+
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return value.replace(microsecond=0)
+
+
+def dumps_json(payload):
+    """ Compact JSON as bytes, with orjson when it is installed """
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+
+    return json.dumps(payload, separators=(",", ":"),
+                      ensure_ascii=False).encode("utf8")
+
+
+def negotiate_encoding():
+    """ Best compression the client accepts: "br", "gzip" or None """
+
+    accepted = request.accept_encodings
+
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+
+    return None
+
+
+def json_response(payload, encoding=None):
+    """ JSON response compressed with the given encoding """
+
+    body = dumps_json(payload)
+
+    response = Response(mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+
+    if encoding and len(body) >= MIN_COMPRESS_SIZE:
+        if encoding == "br":
+            body = brotli.compress(body, quality=5)
+        else:
+            body = gzip.compress(body, compresslevel=6)
+        response.headers["Content-Encoding"] = encoding
+
+    response.set_data(body)
+
+    return response
@@ -0,0 +1,144 @@
+import logging
+import smtplib
+import threading
+import time
+
+from flask import current_app
+from flask_mail import Mail, Message, sanitize_address
+
+from project.jobs import task, enqueue, PermanentFailure
+
+logger = logging.getLogger(__name__)
+
+# Messages sent together over one connection
+MAIL_BATCH_SIZE = 20
+
+mail = Mail()
+
+
+class SMTPPool(object):
+    """ One SMTP connection per worker thread, kept open between batches
+        - Connections idle for MAIL_IDLE_TIMEOUT seconds are closed and
+          dropped connections are opened again once
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def connection(self):
+        """ The open connection of this thread, opened when needed """
+
+        conn = getattr(self.local, 'conn', None)
+        idle = time.monotonic() - getattr(self.local, 'used_at', 0)
+
+        if conn is not None and \
+                idle > current_app.config['MAIL_IDLE_TIMEOUT']:
+            self.close()
+            conn = None
+
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            self.local.used_at = time.monotonic()
+
+        return conn
+
+    @staticmethod
+    def connect():
+        state = current_app.extensions['mail']
+        timeout = current_app.config['MAIL_TIMEOUT']
+
+        if state.use_ssl:
+            conn = smtplib.SMTP_SSL(state.server, int(state.port),
+                                    timeout=timeout)
+        else:
+            conn = smtplib.SMTP(state.server, int(state.port),
+                                timeout=timeout)
+
+        if state.use_tls:
+            conn.starttls()
+        if state.username and state.password:
+            conn.login(state.username, state.password)
+
+        return conn
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        self.local.conn = None
+
+        if conn is not None:
+            try:
+                conn.quit()
+            except (smtplib.SMTPException, OSError):
+                conn.close()
+
+    def send(self, messages):
+        """ Send the messages, returns the error of each, None if sent """
+
+        errors = []
+
+        for message in messages:
+            try:
+                self.send_one(message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # The server closed the idle connection, open a new one
+                self.close()
+                try:
+                    self.send_one(message)
+                except smtplib.SMTPRecipientsRefused as e:
+                    errors.append(PermanentFailure(repr(e)))
+                except (smtplib.SMTPException, OSError) as e:
+                    self.close()
+                    errors.append(repr(e))
+                else:
+                    errors.append(None)
+            except smtplib.SMTPRecipientsRefused as e:
+                # The address will be refused again, do not retry it
+                errors.append(PermanentFailure(repr(e)))
+            except (smtplib.SMTPException, OSError) as e:
+                self.close()
+                errors.append(repr(e))
+            else:
+                errors.append(None)
+
+        return errors
+
+    def send_one(self, message):
+        self.connection().sendmail(
+            sanitize_address(message.sender),
+            [sanitize_address(addr) for addr in message.send_to],
+            message.as_bytes(),
+            message.mail_options,
+            message.rcpt_options)
+        self.local.used_at = time.monotonic()
+
+
+smtp_pool = SMTPPool()
+
+
+def send_mail(subject, recipients, body=None, html=None):
+    """ Queue an email, it is sent by a worker once the session commits """
+
+    return enqueue("mail.send",
+                   subject=subject,
+                   recipients=list(recipients),
+                   body=body,
+                   html=html)
+
+
+@task("mail.send", batch_size=MAIL_BATCH_SIZE)
+def deliver_mail(jobs):
+    """ Send a batch of queued emails over the pooled connection """
+
+    if current_app.extensions['mail'].suppress:
+        return [None] * len(jobs)
+
+    return smtp_pool.send([Message(**kwargs) for args, kwargs in jobs])
+
+
+def connect_mail(app):
+    """ Connect the mail instance to the app """
+
+    app.config.setdefault('MAIL_TIMEOUT', 10)
+    app.config.setdefault('MAIL_IDLE_TIMEOUT', 60)
+
+    mail.init_app(app)
@@ -0,0 +1,245 @@
+import logging
+import os
+import time
+
+from flask import g, request, session
+from sqlalchemy.dialects.postgresql import insert
+from werkzeug.exceptions import HTTPException
+from werkzeug.wrappers import Response
+
+from project.cache import NullCache, make_backend
+from project.metrics import ENDPOINT_KEY, metrics
+from project.models import db, sets_changed, PagePurge
+
+logger = logging.getLogger(__name__)
+
+# Headers of a cached page that are sent again with it
+PAGE_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control')
+
+
+class PageCache(object):
+    """ Whole responses of pages seen by anonymous visitors
+        - Pages are tagged with the data they show ("set:<id>" or "sets"
+          for lists of sets), purging a tag drops every page with it
+        - Purges are also saved in the database, so pages are dropped
+          when a set changes in a job worker or on another machine,
+          after at most PAGE_CACHE_PURGE_POLL seconds
+    """
+
+    def __init__(self):
+        self.app = None
+        self.store = NullCache()
+        # Purge times of the tags, apart from the pages so they are
+        # never evicted by them
+        self.tags = NullCache()
+        self.timeout = 300
+        self.purge_poll = 2
+        self.polled_at = 0
+        self.endpoints = ()
+        self.cookie_names = ('session', 'remember_token')
+
+    def init_app(self, app):
+        app.config.setdefault('PAGE_CACHE_TYPE',
+                              'null' if app.debug else 'filesystem')
+        app.config.setdefault('PAGE_CACHE_DIR', os.path.join(
+            app.config.get('CACHE_DIR', '/tmp/mtword-cache'), 'pages'))
+        app.config.setdefault('PAGE_CACHE_TAGS_DIR', os.path.join(
+            app.config.get('CACHE_DIR', '/tmp/mtword-cache'), 'page-tags'))
+        app.config.setdefault('PAGE_CACHE_TIMEOUT', 300)
+        app.config.setdefault('PAGE_CACHE_MAX_ENTRIES', 5000)
+        app.config.setdefault('PAGE_CACHE_PURGE_POLL', 2)
+        app.config.setdefault('PAGE_CACHE_ENDPOINTS', (
+            'homepage.index', 'homepage.explore', 'sets.show_set'))
+
+        self.store = make_backend(
+            app.config['PAGE_CACHE_TYPE'],
+            cache_dir=app.config['PAGE_CACHE_DIR'],
+            default_timeout=app.config['PAGE_CACHE_TIMEOUT'],
+            max_entries=app.config['PAGE_CACHE_MAX_ENTRIES'])
+        self.tags = make_backend(
+            app.config['PAGE_CACHE_TYPE'],
+            cache_dir=app.config['PAGE_CACHE_TAGS_DIR'],
+            default_timeout=app.config['PAGE_CACHE_TIMEOUT'],
+            max_entries=None)
+        self.app = app
+        self.timeout = app.config['PAGE_CACHE_TIMEOUT']
+        self.purge_poll = app.config['PAGE_CACHE_PURGE_POLL']
+        self.endpoints = set(app.config['PAGE_CACHE_ENDPOINTS'])
+        self.cookie_names = (app.session_cookie_name,
+                             app.config.get('REMEMBER_COOKIE_NAME',
+                                            'remember_token'))
+
+        if isinstance(self.store, NullCache):
+            return
+
+        app.wsgi_app = PageCacheMiddleware(app.wsgi_app, app, self)
+        app.before_request(self.start_page)
+        app.after_request(self.save_page)
+        sets_changed.connect(self.purge_sets, weak=False)
+
+    def is_cacheable(self, environ, endpoint):
+        """ Only GETs of anonymous visitors without a session are cached """
+
+        if environ['REQUEST_METHOD'] != 'GET' or \
+                endpoint not in self.endpoints:
+            return False
+
+        cookies = environ.get('HTTP_COOKIE', '')
+
+        return not any(f"{name}=" in cookies for name in self.cookie_names)
+
+    def get(self, key):
+        """ The cached page, unless one of its tags was purged since """
+
+        entry = self.store.get(key)
+        if entry is None:
+            return None
+
+        self.poll_purges()
+
+        for tag in entry['tags']:
+            if (self.tags.get(tag) or 0) >= entry['started_at']:
+                return None
+
+        return entry
+
+    def start_page(self):
+        if self.is_cacheable(request.environ, request.endpoint):
+            g.page_cache_key = page_key(request.environ)
+            g.page_cache_started_at = time.time()
+            g.page_tags = set()
+
+    def save_page(self, response):
+        key = g.get('page_cache_key')
+
+        if key is None or response.status_code != 200 or \
+                response.direct_passthrough or session.modified or \
+                '_flashes' in session or 'Set-Cookie' in response.headers:
+            return response
+
+        self.store.set(key, {
+            'status': response.status_code,
+            'headers': [(name, value) for name, value in response.headers
+                        if name in PAGE_HEADERS],
+            'body': response.get_data(),
+            'tags': sorted(g.page_tags),
+            'started_at': g.page_cache_started_at,
+        })
+
+        return response
+
+    def purge(self, *tags):
+        """ Drop every page tagged with one of the tags, in this process
+            right away and in the others once they poll the purges
+        """
+
+        if not tags:
+            return
+
+        now = time.time()
+        for tag in tags:
+            self.mark_purged(tag, now)
+
+        table = PagePurge.__table__
+        stmt = insert(table).values([{'tag': tag, 'purged_at': now}
+                                     for tag in tags])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['tag'],
+            set_={'purged_at': stmt.excluded.purged_at})
+
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(stmt)
+                    # Older purges are past every page they could drop
+                    conn.execute(table.delete().where(
+                        table.c.purged_at < now - self.timeout * 2))
+        except Exception:
+            logger.exception("Could not save the purge of %s", tags)
+
+    def poll_purges(self):
+        """ Take in the purges made by other processes, at most every
+            PAGE_CACHE_PURGE_POLL seconds
+        """
+
+        now = time.time()
+        if now - self.polled_at < self.purge_poll:
+            return
+
+        # Purges committed while the last poll ran are read again
+        since = self.polled_at - self.purge_poll
+        self.polled_at = now
+
+        table = PagePurge.__table__
+        try:
+            with self.app.app_context():
+                with db.engine.connect() as conn:
+                    rows = conn.execute(table.select().where(
+                        table.c.purged_at > since)).fetchall()
+        except Exception:
+            logger.exception("Could not read the page cache purges")
+            return
+
+        for tag, purged_at in rows:
+            if (self.tags.get(tag) or 0) < purged_at:
+                self.mark_purged(tag, purged_at)
+
+    def mark_purged(self, tag, purged_at):
+        # Kept longer than the pages so no stale page outlives it
+        self.tags.set(tag, purged_at, self.timeout * 2)
+
+    def purge_sets(self, set_ids):
+        self.purge("sets", *(f"set:{set_id}" for set_id in set_ids))
+
+
+class PageCacheMiddleware(object):
+    """ Answer cached pages before Flask handles the request """
+
+    def __init__(self, wsgi_app, app, page_cache):
+        self.wsgi_app = wsgi_app
+        self.app = app
+        self.page_cache = page_cache
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'GET':
+            try:
+                endpoint, args = self.app.url_map.bind_to_environ(
+                    environ).match()
+            except HTTPException:
+                endpoint = None
+
+            if self.page_cache.is_cacheable(environ, endpoint):
+                entry = self.page_cache.get(page_key(environ))
+                environ[ENDPOINT_KEY] = endpoint
+                metrics.add_cache_lookup("page", entry is not None)
+
+                if entry is not None:
+                    response = Response(entry['body'],
+                                        status=entry['status'],
+                                        headers=entry['headers'])
+                    response.headers['X-Page-Cache'] = 'HIT'
+                    response.make_conditional(environ)
+                    return response(environ, start_response)
+
+        return self.wsgi_app(environ, start_response)
+
+
+def page_key(environ):
+    return f"page:{environ.get('PATH_INFO', '')}?" \
+        f"{environ.get('QUERY_STRING', '')}"
+
+
+def tag_page(*tags):
+    """ Tag the page being rendered with the data it shows """
+
+    if g.get('page_cache_key') is not None:
+        g.page_tags.update(tags)
+
+
+page_cache = PageCache()
+
+
+def connect_page_cache(app):
+    """ Connect the page cache to the app """
+
+    page_cache.init_app(app)
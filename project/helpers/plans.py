@@ -0,0 +1,269 @@
+import csv
+import hashlib
+import io
+import json
+
+from collections import namedtuple
+from itertools import chain, islice
+
+from project.models import db, Set, PlanImport, mark_sets_changed
+from project.jobs import task, enqueue
+from project.helpers.sets import resolve_references, find_or_make_verses
+
+# Number of plan entries resolved and inserted together
+PLAN_BATCH_SIZE = 50
+
+PlanEntry = namedtuple('PlanEntry', ['name', 'description', 'references'])
+
+
+def read_plan(stream, fmt):
+    """ Parse a reading plan into PlanEntry tuples, one at a time
+        - csv: a header with name, description and references columns,
+          the references are separated by ";"
+        - json: a list of objects or one object per line, each with a
+          name, description and references (list or ";" separated)
+    """
+
+    if fmt == "csv":
+        rows = csv.DictReader(stream)
+    elif fmt == "json":
+        rows = read_json_rows(stream)
+    else:
+        raise ValueError(f"Unknown plan format: {fmt}")
+
+    for row in rows:
+        references = row.get("references") or []
+        if isinstance(references, str):
+            references = references.split(";")
+
+        yield PlanEntry(
+            name=(row.get("name") or "").strip()[:50],
+            description=(row.get("description") or "").strip() or None,
+            references=[ref.strip() for ref in references if ref.strip()],
+        )
+
+
+def read_json_rows(stream):
+    """ Read a JSON list, or JSON objects one per line """
+
+    first = stream.read(1)
+    while first.isspace():
+        first = stream.read(1)
+
+    if first == "[":
+        yield from json.loads(first + stream.read())
+        return
+
+    for line in chain([first + stream.readline()], stream):
+        if line.strip():
+            yield json.loads(line)
+
+
+def plan_key(user_id, data):
+    """ Key identifying the import of this plan for this user """
+
+    digest = hashlib.sha256(f"{user_id}:".encode('utf8'))
+    digest.update(data)
+
+    return digest.hexdigest()
+
+
+def start_plan_import(data, fmt, user_id, filename=None):
+    """ Keep the uploaded plan and queue its import for the workers
+        - A plan that can not be read raises ValueError right away
+        - Uploading a plan whose import did not finish queues it again
+        - Returns the PlanImport so its progress can be followed
+    """
+
+    text = data.decode('utf8')
+    try:
+        entries_total = sum(1 for _ in read_plan(io.StringIO(text), fmt))
+    except (csv.Error, AttributeError) as e:
+        # Broken CSV, or JSON entries that are not objects
+        raise ValueError(e) from e
+
+    key = plan_key(user_id, data)
+    plan_import = PlanImport.query.filter_by(key=key).first()
+
+    if plan_import is None:
+        plan_import = PlanImport(key=key, user_id=user_id, filename=filename,
+                                 entries_done=0, sets_created=0,
+                                 entries_skipped=0)
+        db.session.add(plan_import)
+
+    if not plan_import.finished:
+        plan_import.plan = text
+        plan_import.format = fmt
+        plan_import.entries_total = entries_total
+        plan_import.error = None
+        db.session.flush()
+
+        enqueue("plans.import", plan_import.id)
+
+    db.session.commit()
+
+    return plan_import
+
+
+def fail_plan_import(plan_import_id):
+    """ Tell the admin once the import ran out of attempts """
+
+    plan_import = PlanImport.query.get(plan_import_id)
+    plan_import.error = "The import failed, upload the plan again to resume"
+
+
+@task("plans.import", max_attempts=3, on_dead=fail_plan_import)
+def run_plan_import(plan_import_id):
+    """ Import the plan kept by start_plan_import """
+
+    plan_import = PlanImport.query.get(plan_import_id)
+
+    # Already finished by an attempt that stopped before the queue knew
+    if plan_import.finished:
+        return
+
+    import_plan(read_plan(io.StringIO(plan_import.plan), plan_import.format),
+                user_id=plan_import.user_id,
+                key=plan_import.key,
+                filename=plan_import.filename)
+
+
+def import_plan(entries, user_id, key, filename=None,
+                batch_size=PLAN_BATCH_SIZE, progress=None):
+    """ Create a set for every entry of the plan, in batches
+        - Each batch dedupes its references, resolves the verses in bulk,
+          copies the sets and cards into the database and queues their
+          indexing
+        - Progress is committed with each batch, so importing the same
+          plan again resumes after the last finished batch
+        - The PlanImport row is locked during each batch, so two imports
+          of the same plan take turns instead of copying a batch twice
+        - progress is called with the PlanImport after each batch
+    """
+
+    plan_import = PlanImport.query.filter_by(key=key).first()
+
+    if plan_import is None:
+        plan_import = PlanImport(key=key, user_id=user_id, filename=filename,
+                                 entries_done=0, sets_created=0,
+                                 entries_skipped=0)
+        db.session.add(plan_import)
+        db.session.commit()
+
+    # Entries read from the plan so far
+    position = 0
+
+    while True:
+        plan_import = PlanImport.query.filter_by(key=key) \
+            .populate_existing().with_for_update().one()
+
+        if plan_import.finished:
+            db.session.commit()
+            return plan_import
+
+        # Skip what another import did while this one waited on the lock
+        skip = plan_import.entries_done - position
+        batch = list(islice(entries, skip, skip + batch_size))
+        position = plan_import.entries_done + len(batch)
+
+        if not batch:
+            break
+
+        new_sets = import_batch(batch, user_id)
+
+        plan_import.entries_done += len(batch)
+        plan_import.sets_created += len(new_sets)
+        plan_import.entries_skipped += len(batch) - len(new_sets)
+
+        if new_sets:
+            enqueue("search.index", Set.__tablename__,
+                    [new_set.id for new_set in new_sets])
+            # COPY bypasses the flush that tells the caches about new
+            # sets, so the lists of sets are purged on commit here
+            mark_sets_changed(new_set.id for new_set in new_sets)
+
+        db.session.commit()
+
+        if progress:
+            progress(plan_import)
+
+    plan_import.finished = True
+    plan_import.plan = None
+    db.session.commit()
+
+    return plan_import
+
+
+def import_batch(batch, user_id):
+    """ Insert the sets of a batch of plan entries
+        - Entries without a name or without any valid reference are skipped
+        - Returns the new sets (not attached to the session)
+    """
+
+    references = [ref for entry in batch for ref in entry.references]
+
+    cards = resolve_references(references)
+
+    verses = find_or_make_verses(
+        card for ref in dict.fromkeys(references)
+        for card in cards.get(ref, []))
+
+    new_sets = []
+    memberships = []
+
+    for entry in batch:
+        verse_ids = [verses[verse_ref].id
+                     for ref in entry.references
+                     for verse_ref, text in cards.get(ref, [])]
+
+        if entry.name and verse_ids:
+            new_sets.append(Set(name=entry.name,
+                                description=entry.description,
+                                user_id=user_id))
+            memberships.append(verse_ids)
+
+    set_ids = reserve_ids("sets_id_seq", len(new_sets))
+
+    for new_set, set_id in zip(new_sets, set_ids):
+        new_set.id = set_id
+
+    copy_rows("sets", ("id", "name", "description", "user_id"),
+              ((new_set.id, new_set.name, new_set.description, user_id)
+               for new_set in new_sets))
+
+    copy_rows("sets_verses", ("set_id", "verse_id", "position"),
+              ((new_set.id, verse_id, position)
+               for new_set, verse_ids in zip(new_sets, memberships)
+               for position, verse_id in enumerate(verse_ids)))
+
+    return new_sets
+
+
+def reserve_ids(sequence, count):
+    """ Take count ids from the sequence so rows can be copied with them """
+
+    if not count:
+        return []
+
+    result = db.session.execute(
+        db.text("SELECT nextval(:sequence) FROM generate_series(1, :count)"),
+        {"sequence": sequence, "count": count})
+
+    return [row[0] for row in result]
+
+
+def copy_rows(table, columns, rows):
+    """ Insert the rows with COPY in the session's transaction """
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+
+    if not buffer.tell():
+        return
+
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
@@ -0,0 +1,30 @@
+from project.jobs import task
+from project.models import Set
+from project.search import bulk_add_to_index, bulk_remove_from_index
+from project.tracing import traced
+
+# Models kept in the search index, by index name
+SEARCHABLE_MODELS = {
+    Set.__tablename__: Set,
+}
+
+
+@task("search.index")
+@traced("index_models")
+def index_models(index, ids):
+    """ Index the models as they are now, deleted ones are skipped """
+
+    model = SEARCHABLE_MODELS[index]
+
+    bulk_add_to_index(index, model.query.filter(model.id.in_(ids)))
+
+
+@task("search.remove")
+@traced("remove_models")
+def remove_models(index, ids):
+    bulk_remove_from_index(index, ids)
+
+
+@task("search.reindex", max_attempts=1)
+def reindex_models(index):
+    SEARCHABLE_MODELS[index].reindex()
@@ -0,0 +1,86 @@
+from project.jobs import task, enqueue
+from project.models import db, Set, SetJob
+from project.helpers.sets import ESV_BATCH_SIZE, get_all_verses, \
+    update_set_verses
+
+NO_VERSES_ERROR = \
+    "Please make sure to include at least 1 valid verse reference"
+
+
+def start_set_job(kind, user_id, form, references, set_id=None):
+    """ Save a job for the set form and queue it for the workers
+        - Returns the job so the user can follow its progress
+    """
+
+    job = SetJob(kind=kind,
+                 user_id=user_id,
+                 name=form.name.data,
+                 description=form.description.data,
+                 references=references,
+                 set_id=set_id)
+
+    db.session.add(job)
+    db.session.flush()
+
+    enqueue("sets.save", job.id)
+    db.session.commit()
+
+    return job
+
+
+def fail_set_job(job_id):
+    """ Tell the user once the job ran out of attempts """
+
+    job = SetJob.query.get(job_id)
+    job.status = "failed"
+    job.error = "Something went wrong, please try again"
+
+
+@task("sets.save", max_attempts=3, on_dead=fail_set_job)
+def run_set_job(job_id):
+    """ Resolve the verses of the job, committing the progress after
+        each batch of references, then create, edit or copy the set
+    """
+
+    job = SetJob.query.get(job_id)
+
+    # Already finished by an attempt that stopped before the queue knew
+    if job.status in ("done", "failed"):
+        return
+
+    job.status = "running"
+    db.session.commit()
+
+    verses = []
+
+    for i in range(0, len(job.references), ESV_BATCH_SIZE):
+        verses += get_all_verses(job.references[i:i + ESV_BATCH_SIZE])
+
+        job.refs_done = min(i + ESV_BATCH_SIZE, len(job.references))
+        db.session.commit()
+
+    if not verses:
+        job.status = "failed"
+        job.error = NO_VERSES_ERROR
+        db.session.commit()
+        return
+
+    if job.kind == "edit":
+        the_set = Set.query.get(job.set_id)
+        if the_set is None:
+            job.status = "failed"
+            job.error = "The set was deleted"
+            db.session.commit()
+            return
+        the_set.name = job.name
+        the_set.description = job.description
+    else:
+        the_set = Set(name=job.name,
+                      description=job.description,
+                      user_id=job.user_id)
+
+    update_set_verses(the_set, verses)
+
+    job.set_id = the_set.id
+    job.status = "done"
+    db.session.commit()
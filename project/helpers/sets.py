@@ -1,15 +1,56 @@
 import os
+import time
 
-from project.models import db, Verse
+from project.cache import cache
+from project.metrics import track
+from project.models import db, Verse, SetVerse
+from project.tracing import traced, tracer
 
 import requests
 
+from requests.adapters import HTTPAdapter
+
 API_KEY = os.environ.get('API_KEY')
 if API_KEY is None:
-    from .secret import API_KEY2
-    API_KEY = API_KEY2
+    try:
+        from .secret import API_KEY2 as API_KEY
+    except ImportError:
+        # Only the real API needs a key, not the stub in benchmarks/
+        API_KEY = None
 API_URL = os.environ.get('API_URL', "https://api.esv.org/v3/passage/text/")
 
+# Number of passages sent to the ESV API in one request
+ESV_BATCH_SIZE = 10
+
+# Seconds the text of a passage is kept in the cache
+ESV_CACHE_TIMEOUT = 24 * 60 * 60
+
+# Connections kept open to the ESV API, one per concurrent lookup
+ESV_POOL_SIZE = int(os.environ.get('ESV_POOL_SIZE', 100))
+
+# Seconds to wait on the ESV API before giving up
+ESV_TIMEOUT = float(os.environ.get('ESV_TIMEOUT', 10))
+
+# Extra tries of a request the ESV API throttled or failed to answer
+ESV_RETRIES = int(os.environ.get('ESV_RETRIES', 2))
+
+# Seconds before the first retry, doubled for every other one, unless the
+# API says how long to wait with Retry-After
+ESV_RETRY_BACKOFF = 0.5
+
+# Longest wait before a retry, longer Retry-After are not waited for
+ESV_MAX_RETRY_WAIT = 5
+
+# Answers worth trying again
+ESV_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Shared by every lookup of the process so connections are reused
+esv_session = requests.Session()
+esv_session.mount("https://", HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=ESV_POOL_SIZE))
+esv_session.mount("http://", HTTPAdapter(pool_connections=1,
+                                         pool_maxsize=ESV_POOL_SIZE))
+
 
 def split_verses(verses):
     """ With a string of multiple verses, split on verses
@@ -63,68 +104,332 @@ def split_verses_refs(ref, total=0):
     return full_refs
 
 
+@traced("get_all_verses")
 def get_all_verses(references):
     """ With a list of references, return a list of valid verse instances
-        - If verse instances does not exist, create a new one """
+        - If verse instances does not exist, create a new one
+        - Each reference is only looked up once and new verses are
+          added in bulk
+    """
 
-    verses = []
+    cards = resolve_references(references)
 
-    for ref in references:
+    verses = find_or_make_verses(
+        card for ref in references for card in cards.get(ref, []))
 
-        get_verse_num = "-" in ref or ":" not in ref
+    return [verses[verse_ref]
+            for ref in references
+            for verse_ref, text in cards.get(ref, [])]
 
-        info = get_esv_text(ref, get_verse_num)
 
-        passages = info['passages']
-        reference = info['reference']
+@traced("resolve_references")
+def resolve_references(references):
+    """ Look up the verses of the references
+        - Returns a dict of reference -> [(verse reference, text), ...]
+        - Single verses already in the database are not looked up again,
+          the rest are sent to the ESV API in batches
+    """
 
-        if passages == 'Error: Passage not found':
-            continue
+    unique = [ref for ref in dict.fromkeys(references) if ref.strip()]
 
-        if get_verse_num:
-            verse_list = split_verses(passages)
+    cards = {}
 
-            verse_ref_list = split_verses_refs(reference,
-                                               len(verse_list))
+    single = [ref for ref in unique if not needs_verse_num(ref)]
+    if single:
+        for verse in Verse.query.filter(Verse.reference.in_(single)):
+            cards[verse.reference] = [(verse.reference, verse.verse)]
 
-            for i in range(len(verse_list)):
-                verse = find_or_make_verse(
-                    verse_ref_list[i], verse_list[i])
-                verses.append(verse)
+    for get_verse_num in (True, False):
+        refs = [ref for ref in unique
+                if ref not in cards and needs_verse_num(ref) == get_verse_num]
 
-            continue
+        for i in range(0, len(refs), ESV_BATCH_SIZE):
+            batch = refs[i:i + ESV_BATCH_SIZE]
+            infos = get_esv_texts(batch, get_verse_num)
 
-        verse = find_or_make_verse(
-            reference, passages)
+            for ref, info in zip(batch, infos):
+                cards[ref] = split_passage(info, get_verse_num)
 
-        verses.append(verse)
+    return cards
 
-    return verses
 
+def needs_verse_num(ref):
+    """ Whether the reference can cover more than one verse
 
-def find_or_make_verse(reference, passages):
-    """ Returns a verse instance from the given reference
-        - If a verse cannot be found, a new verse is made
+        >>> needs_verse_num("Romans 8:1-3")
+        True
+
+        >>> needs_verse_num("John 3:16")
+        False
     """
-    
-    verse = Verse.query.filter_by(reference=reference).first()
 
-    if not verse:
-        verse = Verse(
-            reference=reference,
-            verse=passages
-        )
-        db.session.add(verse)
-        db.session.commit()
+    return "-" in ref or ":" not in ref
+
+
+def split_passage(info, get_verse_num):
+    """ Split the text returned by the API into one card per verse
+        - Returns a list of (verse reference, text)
+    """
+
+    passages = info['passages']
+    reference = info['reference']
+
+    if passages == 'Error: Passage not found':
+        return []
+
+    if not get_verse_num:
+        return [(reference, passages)]
+
+    verse_list = split_verses(passages)
+
+    verse_ref_list = split_verses_refs(reference,
+                                       len(verse_list))
+
+    return list(zip(verse_ref_list, verse_list))
+
+
+@traced("update_set_verses")
+def update_set_verses(the_set, verses):
+    """ Make the cards of the set match the given ordered list of verses
+        - Only the inserts, deletes and position updates that are needed
+          are sent to the database, in bulk
+        - The caller is responsible for committing the session
+    """
 
-    return verse
+    if the_set.id is None:
+        db.session.add(the_set)
+        db.session.flush()
+
+    rows = db.session.query(
+        SetVerse.id, SetVerse.verse_id, SetVerse.position
+    ).filter_by(set_id=the_set.id).all()
+
+    inserts, updates, deletes = diff_set_verses(
+        rows, [verse.id for verse in verses])
+
+    if deletes:
+        SetVerse.query.filter(SetVerse.id.in_(deletes)).delete(
+            synchronize_session=False)
+    if updates:
+        db.session.bulk_update_mappings(SetVerse, updates)
+    if inserts:
+        for insert in inserts:
+            insert["set_id"] = the_set.id
+        db.session.bulk_insert_mappings(SetVerse, inserts)
+
+    # The relationship was changed behind the ORM's back
+    db.session.expire(the_set, ["verses"])
+
+    changed = bool(inserts or updates or deletes)
+
+    if changed:
+        the_set.updated_at = db.func.now()
+
+    return changed
+
+
+def diff_set_verses(rows, verse_ids):
+    """ Compare the current rows of a set with the new ordered verse ids
+        - rows is a list of (id, verse_id, position) tuples
+        - Returns (inserts, updates, deletes) where rows that are not
+          needed anymore are reused before new rows are inserted
+
+        >>> diff_set_verses([(1, 10, 0), (2, 20, 1)], [10, 30])
+        ([], [{'id': 2, 'verse_id': 30, 'position': 1}], [])
+    """
+
+    # Rows that already hold the right verse at the right position
+    slots = {}
+    for row_id, verse_id, position in rows:
+        slots.setdefault((verse_id, position), []).append(row_id)
+
+    pending = []
+    for position, verse_id in enumerate(verse_ids):
+        if slots.get((verse_id, position)):
+            slots[(verse_id, position)].pop()
+        else:
+            pending.append((position, verse_id))
+
+    spare = {}
+    for (verse_id, position), row_ids in slots.items():
+        spare.setdefault(verse_id, []).extend(row_ids)
+
+    # Verses that only moved keep their row and get a new position
+    updates = []
+    missing = []
+    for position, verse_id in pending:
+        if spare.get(verse_id):
+            updates.append({"id": spare[verse_id].pop(),
+                            "verse_id": verse_id,
+                            "position": position})
+        else:
+            missing.append((position, verse_id))
+
+    # Left over rows are recycled for the new verses
+    leftovers = sorted(row_id
+                       for row_ids in spare.values()
+                       for row_id in row_ids)
+    inserts = []
+    for position, verse_id in missing:
+        if leftovers:
+            updates.append({"id": leftovers.pop(0),
+                            "verse_id": verse_id,
+                            "position": position})
+        else:
+            inserts.append({"verse_id": verse_id, "position": position})
+
+    return inserts, updates, leftovers
+
+
+@traced("find_or_make_verses")
+def find_or_make_verses(cards):
+    """ Returns a dict of reference -> verse instance for the given
+        (reference, text) pairs
+        - Verses that cannot be found are made in bulk
+        - The caller is responsible for committing the session
+    """
+
+    texts = dict(cards)
+
+    verses = {}
+
+    if texts:
+        for verse in Verse.query.filter(Verse.reference.in_(list(texts))):
+            verses.setdefault(verse.reference, verse)
+
+    new_verses = [Verse(reference=reference, verse=text)
+                  for reference, text in texts.items()
+                  if reference not in verses]
+
+    if new_verses:
+        db.session.add_all(new_verses)
+        db.session.flush()
+
+        for verse in new_verses:
+            verses[verse.reference] = verse
+
+    return verses
 
 
 def get_esv_text(passage, get_verse_num=True):
-    """ Get the esv text from the API """
+    """ Get the esv text from the API (or the cache) """
+
+    return get_esv_texts([passage], get_verse_num)[0]
+
+
+@traced("get_esv_texts")
+def get_esv_texts(passages, get_verse_num=True):
+    """ Get the esv text of several passages
+        - Returns a list in the same shape as get_esv_text, in order
+        - Passages in the cache are not requested again, the others
+          are requested together
+    """
+
+    infos = {passage: cache.get(esv_cache_key(passage, get_verse_num))
+             for passage in passages}
+
+    missing = [passage for passage in dict.fromkeys(passages)
+               if infos[passage] is None]
+
+    if missing:
+        for passage, info in zip(missing,
+                                 fetch_esv_texts(missing, get_verse_num)):
+            infos[passage] = info
+            if info['passages'] != 'Error: Passage not found':
+                cache.set(esv_cache_key(passage, get_verse_num), info,
+                          timeout=ESV_CACHE_TIMEOUT)
+
+    return [infos[passage] for passage in passages]
+
+
+def esv_cache_key(passage, get_verse_num):
+    return f"esv:{int(bool(get_verse_num))}:{passage}"
+
+
+def fetch_esv_text(passage, get_verse_num=True):
+    """ Get the esv text of one passage from the API """
+
+    data = request_esv(passage, get_verse_num)
+
+    passages = data['passages']
+    meta = data.get('passage_meta', [])
+
+    # The canonical reference, like batched lookups, so a passage is
+    # saved under the same reference however it was looked up
+    reference = meta[0]['canonical'] if passages and meta \
+        else data["query"]
+
+    return {
+        'passages': passages[0].strip()
+        if passages else 'Error: Passage not found',
+        'reference': reference
+    }
+
+
+def fetch_esv_texts(passages, get_verse_num=True):
+    """ Get the esv text of several passages with one API request """
+
+    if len(passages) == 1:
+        return [fetch_esv_text(passages[0], get_verse_num)]
+
+    data = request_esv(";".join(passages), get_verse_num)
+
+    texts = data['passages']
+    meta = data.get('passage_meta', [])
+
+    # Passages that are not found are left out of the response, so the
+    # texts can't be matched with the references anymore
+    if len(texts) != len(passages) or len(meta) != len(passages):
+        return [fetch_esv_text(passage, get_verse_num)
+                for passage in passages]
+
+    return [{'passages': text.strip(), 'reference': info['canonical']}
+            for text, info in zip(texts, meta)]
+
+
+def stored_verses(references):
+    """ The text of the single verses of the references already in the
+        database
+        - Returns a dict of reference -> {'passages', 'reference'}
+    """
+
+    single = [ref for ref in dict.fromkeys(references)
+              if ref.strip() and not needs_verse_num(ref)]
+    if not single:
+        return {}
+
+    return {verse.reference: {'passages': verse.verse,
+                              'reference': verse.reference}
+            for verse in Verse.query.filter(Verse.reference.in_(single))}
+
+
+@traced("lookup_references")
+def lookup_references(references, get_verse_num=True, stored=None):
+    """ Look up the text of every reference for the set editor
+        - Returns a list of {'passages', 'reference'} in the same order
+        - stored is what stored_verses returned for the references, the
+          rest comes from the cache or the API in batches
+    """
+
+    infos = dict(stored or {})
+
+    rest = [ref for ref in dict.fromkeys(references)
+            if ref.strip() and ref not in infos]
+    for i in range(0, len(rest), ESV_BATCH_SIZE):
+        batch = rest[i:i + ESV_BATCH_SIZE]
+        infos.update(zip(batch, get_esv_texts(batch, get_verse_num)))
+
+    return [infos.get(ref, {'passages': 'Error: Passage not found',
+                            'reference': ref})
+            for ref in references]
+
+
+@traced("request_esv")
+def request_esv(query, get_verse_num=True):
+    """ Make the request to the ESV API and return the JSON """
 
     params = {
-        'q': passage,
+        'q': query,
         'include-headings': False,
         'include-footnotes': False,
         'include-verse-numbers': get_verse_num,
@@ -139,15 +444,35 @@ def get_esv_text(passage, get_verse_num=True):
 
     headers = {
         'Authorization': f'Token {API_KEY}'
-    }
+    } if API_KEY else {}
 
-    response = requests.get(API_URL, params=params, headers=headers)
+    for attempt in range(ESV_RETRIES + 1):
+        with track("esv"):
+            response = esv_session.get(API_URL, params=params,
+                                       headers={**headers,
+                                                **tracer.headers()},
+                                       timeout=ESV_TIMEOUT)
 
-    passages = response.json()['passages']
-    reference = response.json()["query"]
+        if response.status_code not in ESV_RETRY_STATUSES:
+            break
 
-    return {
-        'passages': passages[0].strip()
-        if passages else 'Error: Passage not found',
-        'reference': reference
-    }
+        wait = esv_retry_wait(response, attempt)
+        if attempt == ESV_RETRIES or wait > ESV_MAX_RETRY_WAIT:
+            break
+
+        time.sleep(wait)
+
+    response.raise_for_status()
+
+    return response.json()
+
+
+def esv_retry_wait(response, attempt):
+    """ Seconds to wait before trying a failed request again
+        - Retry-After when the API sent one, else an exponential backoff
+    """
+
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return ESV_RETRY_BACKOFF * 2 ** attempt
@@ -0,0 +1,363 @@
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+
+from collections import namedtuple
+from itertools import count
+from datetime import timedelta
+
+from sqlalchemy import text
+
+from project.models import db, Job
+from project.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+Task = namedtuple('Task', ['name', 'func', 'max_attempts', 'on_dead',
+                           'batch_size'])
+
+# Every task a worker can run, by name
+tasks = {}
+
+
+class PermanentFailure(str):
+    """ Error a batch task returns for a job that would fail the same
+        way every time, so it is not retried
+    """
+
+# Numbers the workers of this process
+worker_numbers = count()
+
+CLAIM_QUERY = text("""
+    UPDATE jobs
+    SET status = 'running', attempts = attempts + 1,
+        locked_by = :worker, locked_at = now()
+    WHERE id = (
+        SELECT id FROM jobs
+        WHERE status = 'queued' AND run_at <= now()
+        ORDER BY run_at, id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED)
+    RETURNING id, task, args, kwargs, attempts, max_attempts,
+              trace_parent
+""")
+
+# More due jobs of the same task, to run along with a claimed one
+CLAIM_BATCH_QUERY = text("""
+    UPDATE jobs
+    SET status = 'running', attempts = attempts + 1,
+        locked_by = :worker, locked_at = now()
+    WHERE id IN (
+        SELECT id FROM jobs
+        WHERE status = 'queued' AND run_at <= now() AND task = :task
+        ORDER BY run_at, id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED)
+    RETURNING id, task, args, kwargs, attempts, max_attempts,
+              trace_parent
+""")
+
+FINISH_QUERY = text("""
+    UPDATE jobs
+    SET status = 'done', finished_at = now(), locked_by = NULL
+    WHERE id = :id
+""")
+
+RETRY_QUERY = text("""
+    UPDATE jobs
+    SET status = 'queued', locked_by = NULL, last_error = :error,
+        run_at = now() + :delay * interval '1 second'
+    WHERE id = :id
+""")
+
+DEAD_QUERY = text("""
+    UPDATE jobs
+    SET status = 'dead', finished_at = now(), locked_by = NULL,
+        last_error = :error
+    WHERE id = :id
+""")
+
+# Jobs of workers that died while running them
+RECOVER_QUERY = text("""
+    UPDATE jobs
+    SET status = CASE WHEN attempts < max_attempts
+                      THEN 'queued' ELSE 'dead' END,
+        locked_by = NULL,
+        last_error = 'Worker ' || locked_by || ' stopped running the job'
+    WHERE status = 'running'
+      AND locked_at < now() - :timeout * interval '1 second'
+""")
+
+PRUNE_QUERY = text("""
+    DELETE FROM jobs
+    WHERE status = 'done'
+      AND finished_at < now() - :keep * interval '1 second'
+""")
+
+
+def task(name, max_attempts=5, on_dead=None, batch_size=1):
+    """ Register the function as a task run by the workers
+        - on_dead is called with the arguments of the job once its
+          last attempt failed
+        - With a batch_size, the function gets a list of (args, kwargs)
+          for up to batch_size jobs and returns the error of each job,
+          None for the ones that succeeded and a PermanentFailure for
+          the ones not worth retrying
+    """
+
+    def register(func):
+        tasks[name] = Task(name, func, max_attempts, on_dead, batch_size)
+        return func
+
+    return register
+
+
+def enqueue(name, *args, delay=0, max_attempts=None, **kwargs):
+    """ Add a job for the task to the session
+        - The job is queued when the session commits, along with the
+          changes it is about
+        - delay: seconds to wait before running it
+    """
+
+    if name not in tasks:
+        raise ValueError(f"Unknown task: {name}")
+
+    job = Job(task=name,
+              args=list(args),
+              kwargs=kwargs,
+              max_attempts=max_attempts or tasks[name].max_attempts,
+              run_at=db.func.now() + timedelta(seconds=delay),
+              trace_parent=tracer.traceparent())
+
+    db.session.add(job)
+
+    return job
+
+
+def retry_delay(attempts):
+    """ Seconds to wait before the next attempt, doubling each time """
+
+    return min(10 * 2 ** (attempts - 1), 3600)
+
+
+def claim_job(worker):
+    """ Lock the next job that is due, None if there is none
+        - SKIP LOCKED lets workers claim jobs without waiting on
+          each other
+    """
+
+    row = db.session.execute(CLAIM_QUERY, {"worker": worker}).first()
+    db.session.commit()
+
+    return row
+
+
+def claim_batch(worker, row):
+    """ The claimed job with more due jobs of its batch task """
+
+    rows = db.session.execute(CLAIM_BATCH_QUERY, {
+        "worker": worker,
+        "task": row.task,
+        "limit": tasks[row.task].batch_size - 1,
+    }).fetchall()
+    db.session.commit()
+
+    return [row] + rows
+
+
+def run_job(row):
+    """ Run a claimed job, then mark it done, retry it later or
+        move it to the dead jobs once it used all of its attempts
+        - The job continues the trace of the request that queued it
+    """
+
+    try:
+        with tracer.start_trace(f"job {row.task}", parent=row.trace_parent,
+                                **{'job.id': row.id,
+                                   'job.attempt': row.attempts}):
+            tasks[row.task].func(*row.args, **row.kwargs)
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        fail_job(row, traceback.format_exc())
+    else:
+        finish_job(row)
+
+
+def run_batch(rows):
+    """ Run claimed jobs of a batch task with one call """
+
+    try:
+        # One trace for the batch, it continues the trace of its first job
+        with tracer.start_trace(
+                f"job {rows[0].task}", parent=rows[0].trace_parent,
+                **{'job.ids': ",".join(str(row.id) for row in rows)}):
+            errors = tasks[rows[0].task].func(
+                [(row.args, row.kwargs) for row in rows])
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        errors = [traceback.format_exc()] * len(rows)
+
+    for row, error in zip(rows, errors):
+        if error is None:
+            finish_job(row)
+        else:
+            fail_job(row, str(error),
+                     permanent=isinstance(error, PermanentFailure))
+
+
+def finish_job(row):
+    db.session.execute(FINISH_QUERY, {"id": row.id})
+    db.session.commit()
+
+
+def fail_job(row, error, permanent=False):
+    """ Retry the job later, or move it to the dead jobs once it used
+        all of its attempts or its failure is permanent
+    """
+
+    if row.task in tasks and row.attempts < row.max_attempts and \
+            not permanent:
+        logger.warning("Job %s (%s) failed, retrying", row.id, row.task)
+        db.session.execute(RETRY_QUERY, {
+            "id": row.id,
+            "error": error,
+            "delay": retry_delay(row.attempts),
+        })
+        db.session.commit()
+    else:
+        logger.error("Job %s (%s) is dead:\n%s", row.id, row.task, error)
+        db.session.execute(DEAD_QUERY, {"id": row.id, "error": error})
+        db.session.commit()
+        mark_dead(row)
+
+
+def mark_dead(row):
+    """ Let the task clean up after its last failed attempt """
+
+    current = tasks.get(row.task)
+    if current is None or current.on_dead is None:
+        return
+
+    try:
+        current.on_dead(*row.args, **row.kwargs)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        logger.exception("Could not clean up dead job %s", row.id)
+
+
+def recover_jobs(app):
+    """ Queue again the jobs of stopped workers and drop old done jobs """
+
+    db.session.execute(RECOVER_QUERY,
+                       {"timeout": app.config['JOBS_LOCK_TIMEOUT']})
+    db.session.execute(PRUNE_QUERY,
+                       {"keep": app.config['JOBS_KEEP_DONE']})
+    db.session.commit()
+
+
+def requeue_dead_jobs():
+    """ Give the dead jobs a new set of attempts, returns their number """
+
+    result = Job.query.filter_by(status="dead").update({
+        "status": "queued",
+        "attempts": 0,
+        "run_at": db.func.now(),
+        "finished_at": None,
+    }, synchronize_session=False)
+    db.session.commit()
+
+    return result
+
+
+class Worker(object):
+    """ Runs the queued jobs one at a time until it is stopped
+        - Several workers, in threads or processes, share the queue
+    """
+
+    def __init__(self, app, name=None, stop=None):
+        self.app = app
+        self.name = name or \
+            f"{socket.gethostname()}:{os.getpid()}:{next(worker_numbers)}"
+        self.stop = stop or threading.Event()
+
+    def run(self, burst=False):
+        """ Work until stopped, or until the queue is empty for a burst """
+
+        poll_interval = self.app.config['JOBS_POLL_INTERVAL']
+        recover_interval = self.app.config['JOBS_RECOVER_INTERVAL']
+        recovered_at = None
+
+        while not self.stop.is_set():
+            with self.app.app_context():
+                try:
+                    now = time.monotonic()
+                    if recovered_at is None or \
+                            now - recovered_at >= recover_interval:
+                        recover_jobs(self.app)
+                        recovered_at = now
+
+                    ran = self.run_next()
+                except Exception:
+                    logger.exception("Worker %s could not reach the queue",
+                                     self.name)
+                    db.session.rollback()
+                    ran = False
+                finally:
+                    db.session.remove()
+
+            if not ran:
+                if burst:
+                    return
+                self.stop.wait(poll_interval)
+
+    def run_next(self):
+        """ Run the next due job, False if there was none """
+
+        row = claim_job(self.name)
+        if row is None:
+            return False
+
+        current = tasks.get(row.task)
+
+        if current is not None and current.batch_size > 1:
+            run_batch(claim_batch(self.name, row))
+        else:
+            run_job(row)
+        return True
+
+
+def start_local_workers(app, number):
+    """ Run workers in threads of the web process, so small deployments
+        do not need a worker process
+    """
+
+    for i in range(number):
+        worker = Worker(app)
+        thread = threading.Thread(target=worker.run,
+                                  name=f"job-worker-{i}",
+                                  daemon=True)
+        thread.start()
+
+
+def connect_jobs(app):
+    """ Configure the job queue
+        - JOBS_LOCAL_WORKERS: worker threads started in the web process
+          by its first request, 0 to leave the jobs to `flask worker`
+    """
+
+    app.config.setdefault('JOBS_POLL_INTERVAL', 1)
+    app.config.setdefault('JOBS_RECOVER_INTERVAL', 60)
+    app.config.setdefault('JOBS_LOCK_TIMEOUT', 600)
+    app.config.setdefault('JOBS_KEEP_DONE', 24 * 3600)
+    app.config.setdefault('JOBS_LOCAL_WORKERS', 2 if app.debug else 0)
+
+    if app.config['JOBS_LOCAL_WORKERS']:
+        @app.before_first_request
+        def start_workers():
+            start_local_workers(app, app.config['JOBS_LOCAL_WORKERS'])
@@ -1,23 +1,26 @@
 
+import math
+
 from flask import Blueprint, render_template, flash, redirect, url_for, \
-    request, abort
+    request, abort, make_response, current_app
 
 from flask_login import login_user, logout_user, current_user
 
-from flask_mail import Message, Mail
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from markupsafe import escape
 
 from ..forms import RegisterForm, LoginForm, RequestResetPasswordForm, \
     ResetPasswordForm
 from ..models import db, User
+from ..helpers.mail import send_mail
+from ..rate_limit import rate_limiter
 
-from secrets import token_urlsafe
+from hmac import compare_digest
 
 from urllib.parse import urlparse, urljoin
 
 login = Blueprint('login', __name__, template_folder="templates")
 
-mail = Mail()
-
 ####################################################################
 # Login/Registration Routes
 
@@ -35,13 +38,21 @@ def handle_registration():
     email = form.email.data
     username = form.username.data
 
-    # If there is a user with this email already
-    if User.query.filter_by(email=email).first():
-        form.email.errors = ["This email is already being used"]
+    if form.is_submitted():
+        wait = rate_limiter.take(('register_ip', rate_limiter.client_ip()))
+        if wait:
+            return too_many_attempts('login_register/register.html', form,
+                                     wait)
+
+        username_taken, email_taken = User.taken(username, email)
 
-    # Check if there is a user with this username already
-    if User.query.filter_by(username=username).first():
-        form.username.errors = ["This username is already being used"]
+        # If there is a user with this email already
+        if email_taken:
+            form.email.errors = ["This email is already being used"]
+
+        # Check if there is a user with this username already
+        if username_taken:
+            form.username.errors = ["This username is already being used"]
 
     if form.email.errors or form.username.errors:
         return render_template('login_register/register.html', form=form)
@@ -84,14 +95,30 @@ def handle_login():
         name = form.username.data
         pwd = form.password.data
 
+        # Checked before the password, which is the costly part
+        # - Every attempt counts against the address
+        # - Only failures count against the username from that address,
+        #   so others cannot lock the user out
+        ip = rate_limiter.client_ip()
+        failures = ('login_failures', f"{ip}:{name.lower()}")
+        wait = max(rate_limiter.take(('login_ip', ip)),
+                   rate_limiter.take(failures, cost=0))
+        if wait:
+            return too_many_attempts('login_register/login.html', form, wait)
+
         user = User.authenticate(name, pwd)
 
         if not user:
+            rate_limiter.take(failures)
+
             form.username.errors = ["Wrong username or password"]
             form.password.errors = ["Wrong username or password"]
 
             return render_template('login_register/login.html', form=form)
 
+        # Saves the password if it was hashed again
+        db.session.commit()
+
         login_user(user)
 
         flash('Logged in successfully.', "success")
@@ -107,6 +134,17 @@ def handle_login():
     return render_template('login_register/login.html', form=form)
 
 
+def too_many_attempts(template, form, wait):
+    """ The form again with a 429, telling when to try again """
+
+    flash("Too many attempts, please try again later.", "danger")
+
+    response = make_response(render_template(template, form=form), 429)
+    response.headers['Retry-After'] = str(math.ceil(wait))
+
+    return response
+
+
 @login.route("/logout")
 def logout():
     """ Logs out the user from the webpage """
@@ -121,73 +159,93 @@ def logout():
 ####################################################################
 # Reset Password Routes
 
-# @login.route("/reset/pw", methods=["GET", "POST"])
-# def request_reset_pw():
+@login.route("/reset/pw", methods=["GET", "POST"])
+def request_reset_pw():
+    """ Send the user a link to reset their password
+        - The email is queued, so the page does not wait on the
+          mail server
+    """
 
-#     form = RequestResetPasswordForm()
-#     email = form.email.data
+    form = RequestResetPasswordForm()
+    email = form.email.data
 
-#     if form.validate_on_submit():
-#         user = User.query.filter_by(email=email).first()
+    if form.validate_on_submit():
+        user = User.query.filter_by(email=email).first()
 
-#         if not user:
-#             form.email.errors = ["No user found with this email"]
-#             return render_template("request_reset_pw.html", form=form)
+        # The page is the same whether or not the email is used, so it
+        # does not tell who has an account
+        if user:
+            token = reset_serializer().dumps(user.id)
 
-#         token = token_urlsafe(16)
+            user.password_reset_token = token
 
-#         user.password_reset_token = token
+            reset_url = url_for("login.reset_pw", token=token,
+                                _external=True)
 
-#         db.session.commit()
+            send_mail("Your password token",
+                      recipients=[email],
+                      html=f"""<p>
+                                Hello! Your username is {escape(user.username)}
+                                <hr>
+                                <a href="{reset_url}">
+                                    Click here to change your password
+                                </a>
+                            </p>""")
 
-#         msg = Message("Your password token",
-#                       recipients=[email])
-#         msg.html = f"""<p>
-#                             Hello! Your username is {user.username}
-#                             <hr>
-#                             <a href="http://localhost:5000/reset/pw/{token}">
-#                                 Click here to change your password
-#                             </a>
-#                        </p>"""
+            db.session.commit()
 
-#         mail.send(msg)
+        flash("If this email belongs to an account, "
+              "a link to reset its password has been sent!")
 
-#         flash("Email has been sent!")
+        return redirect("/")
 
-#         return redirect("/")
+    return render_template("login_register/request_reset_pw.html", form=form)
 
-#     return render_template("login_register/request_reset_pw.html", form=form)
 
+@login.route("/reset/pw/<token>", methods=["GET", "POST"])
+def reset_pw(token):
 
-# @login.route("/reset/pw/<token>", methods=["GET", "POST"])
-# def reset_pw(token):
+    form = ResetPasswordForm()
 
-#     form = ResetPasswordForm()
-#     user = User.query.filter_by(password_reset_token=token).first()
+    try:
+        user_id = reset_serializer().loads(
+            token, max_age=current_app.config['PASSWORD_RESET_MAX_AGE'])
+    except BadSignature:
+        abort(404)
 
-#     if not user:
-#         abort(404)
+    # Only the last link sent works, and only until it is used
+    user = User.query.get(user_id)
+    if not user or not user.password_reset_token or \
+            not compare_digest(user.password_reset_token, token):
+        abort(404)
 
-#     if form.validate_on_submit():
-#         password = form.password.data
+    if form.validate_on_submit():
+        password = form.password.data
 
-#         user.update_password(password)
+        user.update_password(password)
 
-#         user.password_reset_token = None
+        user.password_reset_token = None
 
-#         db.session.commit()
+        db.session.commit()
 
-#         flash("Your password has been updated!", "success")
+        flash("Your password has been updated!", "success")
 
-#         return redirect(url_for("handle_login"))
+        return redirect(url_for("login.handle_login"))
 
-#     return render_template("login_register/reset_pw.html", form=form)
+    return render_template("login_register/reset_pw.html", form=form)
 
 
 ####################################################################
 # Helper Function
 
 
+def reset_serializer():
+    """ Signs the user id of reset links with the time they were sent """
+
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'],
+                                  salt="password-reset")
+
+
 def is_safe_url(target):
     """ Helper function to determine
         whether the next url is safe
@@ -201,8 +259,3 @@ def is_safe_url(target):
         ref_url.netloc == test_url.netloc and \
         'delete' not in ref_url.path
 
-
-def connect_mail(app):
-    """ Connect the mail instance to the app """
-
-    mail.init_app(app)
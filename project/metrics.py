@@ -0,0 +1,407 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from hmac import compare_digest
+
+from flask import Response, abort, current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.wsgi import ClosingIterator
+
+from project.tracing import tracer
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0, float('inf'))
+
+# Endpoint used for work done outside of a request, like jobs
+BACKGROUND = "background"
+
+# WSGI environ key where the endpoint of the request is kept
+ENDPOINT_KEY = "mtword.endpoint"
+
+
+class RequestStats(object):
+    """ Dependency calls and cache lookups of the current request """
+
+    __slots__ = ('deps', 'cache')
+
+    def __init__(self):
+        self.deps = {}
+        self.cache = {}
+
+
+class Metrics(object):
+    """ Counters of this process, per endpoint
+        - Each request is timed in a WSGI middleware and its dependency
+          times are gathered in a thread local, then merged under a lock
+          once at the end of the request
+        - Every process writes its counters to METRICS_DIR now and then,
+          /metrics adds up the counters of all of them
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.directory = None
+        self.flush_interval = 5
+        self.flushed_at = 0
+        self.retention = 24 * 3600
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_DIR', os.path.join(
+            tempfile.gettempdir(), 'mtword-metrics'))
+        app.config.setdefault('METRICS_FLUSH_INTERVAL', 5)
+        app.config.setdefault('METRICS_RETENTION', 24 * 3600)
+        app.config.setdefault('METRICS_TOKEN', None)
+
+        if not app.config['METRICS_ENABLED']:
+            return
+
+        self.directory = app.config['METRICS_DIR']
+        self.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+        self.retention = app.config['METRICS_RETENTION']
+        os.makedirs(self.directory, exist_ok=True)
+
+        app.wsgi_app = MetricsMiddleware(app.wsgi_app, self)
+        app.before_request(remember_endpoint)
+        app.add_url_rule('/metrics', 'metrics', self.export_view)
+
+        event.listen(Engine, 'before_cursor_execute', start_query)
+        event.listen(Engine, 'after_cursor_execute', end_query)
+
+    # Recording
+
+    def start_request(self):
+        self.local.stats = RequestStats()
+
+    def end_request(self, endpoint, elapsed):
+        stats = self.local.stats
+        self.local.stats = None
+
+        with self.lock:
+            entry = self.entry(endpoint)
+            entry['count'] += 1
+            entry['sum'] += elapsed
+            entry['buckets'][bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+            merge_counts(entry['deps'], stats.deps)
+            merge_counts(entry['cache'], stats.cache)
+
+        self.maybe_flush()
+
+    def entry(self, endpoint):
+        entry = self.endpoints.get(endpoint)
+        if entry is None:
+            entry = self.endpoints[endpoint] = {
+                'count': 0,
+                'sum': 0.0,
+                'buckets': [0] * len(LATENCY_BUCKETS),
+                'deps': {},
+                'cache': {},
+            }
+        return entry
+
+    def add(self, kind, name, first, second):
+        """ Add to the counters of the request, or of the background
+            work when there is no request
+        """
+
+        stats = getattr(self.local, 'stats', None)
+
+        if stats is not None:
+            counts = getattr(stats, kind).setdefault(name, [0, 0])
+            counts[0] += first
+            counts[1] += second
+            return
+
+        with self.lock:
+            counts = self.entry(BACKGROUND)[kind].setdefault(name, [0, 0])
+            counts[0] += first
+            counts[1] += second
+
+        self.maybe_flush()
+
+    def add_dependency(self, name, elapsed):
+        self.add('deps', name, 1, elapsed)
+
+    def add_cache_lookup(self, name, hit):
+        self.add('cache', name, 1 if hit else 0, 0 if hit else 1)
+
+    # Sharing between processes
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.endpoints))
+
+    def maybe_flush(self):
+        if time.monotonic() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """ Write the counters of this process for the other ones """
+
+        self.flushed_at = time.monotonic()
+
+        if self.directory is None:
+            return
+
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp, os.path.join(self.directory,
+                                         f"{os.getpid()}.json"))
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def collect(self):
+        """ Counters of every process, added up per endpoint """
+
+        if self.directory is None:
+            return self.snapshot()
+
+        self.flush()
+
+        totals = {}
+        now = time.time()
+
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) > self.retention:
+                    os.remove(path)
+                    continue
+                with open(path) as f:
+                    endpoints = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            for endpoint, entry in endpoints.items():
+                total = totals.setdefault(endpoint, {
+                    'count': 0,
+                    'sum': 0.0,
+                    'buckets': [0] * len(LATENCY_BUCKETS),
+                    'deps': {},
+                    'cache': {},
+                })
+                total['count'] += entry['count']
+                total['sum'] += entry['sum']
+                total['buckets'] = [a + b for a, b in
+                                    zip(total['buckets'], entry['buckets'])]
+                merge_counts(total['deps'], entry['deps'])
+                merge_counts(total['cache'], entry['cache'])
+
+        return totals
+
+    # Exporting
+
+    def export_view(self):
+        """ The counters in the Prometheus text format
+            - The scraper has to send METRICS_TOKEN as a bearer token,
+              without one set the counters are not served at all
+        """
+
+        token = current_app.config['METRICS_TOKEN']
+        if not token:
+            abort(404)
+        if not compare_digest(request.headers.get('Authorization', ''),
+                              f"Bearer {token}"):
+            abort(401)
+
+        return Response(to_prometheus(self.collect()),
+                        mimetype='text/plain; version=0.0.4')
+
+
+class MetricsMiddleware(object):
+    """ Time every request, including pages answered by the page cache
+        - The request ends when the server closes the body, so streamed
+          responses are timed until their last chunk is sent
+    """
+
+    def __init__(self, wsgi_app, metrics):
+        self.wsgi_app = wsgi_app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        self.metrics.start_request()
+        start = time.perf_counter()
+
+        def end_request():
+            self.metrics.end_request(environ.get(ENDPOINT_KEY) or "none",
+                                     time.perf_counter() - start)
+
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except BaseException:
+            end_request()
+            raise
+
+        return ClosingIterator(body, end_request)
+
+
+def merge_counts(into, counts):
+    for name, (first, second) in counts.items():
+        total = into.setdefault(name, [0, 0])
+        total[0] += first
+        total[1] += second
+
+
+def remember_endpoint():
+    request.environ[ENDPOINT_KEY] = request.endpoint
+
+
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info['metrics_query_start'] = time.perf_counter()
+
+
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop('metrics_query_start', None)
+    if start is not None:
+        metrics.add_dependency("sql", time.perf_counter() - start)
+
+
+@contextmanager
+def track(dependency):
+    """ Time a call to a dependency, like the ESV API
+        - The call is also a span of the current trace
+    """
+
+    start = time.perf_counter()
+    try:
+        with tracer.span(dependency, "CLIENT"):
+            yield
+    finally:
+        metrics.add_dependency(dependency, time.perf_counter() - start)
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def to_prometheus(totals):
+    """ Format the counters for Prometheus """
+
+    lines = [
+        "# HELP mtword_request_duration_seconds Time to answer requests",
+        "# TYPE mtword_request_duration_seconds histogram",
+    ]
+    for endpoint, entry in sorted(totals.items()):
+        if not entry['count']:
+            continue
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, entry['buckets']):
+            cumulative += count
+            le = "+Inf" if bound == float('inf') else repr(bound)
+            lines.append(f'mtword_request_duration_seconds_bucket'
+                         f'{{endpoint="{label(endpoint)}",le="{le}"}} '
+                         f'{cumulative}')
+        lines.append(f'mtword_request_duration_seconds_sum'
+                     f'{{endpoint="{label(endpoint)}"}} {entry["sum"]}')
+        lines.append(f'mtword_request_duration_seconds_count'
+                     f'{{endpoint="{label(endpoint)}"}} {entry["count"]}')
+
+    lines += [
+        "# HELP mtword_dependency_calls_total Calls to SQL, "
+        "Elasticsearch and the ESV API",
+        "# TYPE mtword_dependency_calls_total counter",
+    ]
+    for endpoint, entry in sorted(totals.items()):
+        for dep, (calls, seconds) in sorted(entry['deps'].items()):
+            lines.append(f'mtword_dependency_calls_total'
+                         f'{{endpoint="{label(endpoint)}",'
+                         f'dependency="{dep}"}} {calls}')
+
+    lines += [
+        "# HELP mtword_dependency_seconds_total Time spent in the calls",
+        "# TYPE mtword_dependency_seconds_total counter",
+    ]
+    for endpoint, entry in sorted(totals.items()):
+        for dep, (calls, seconds) in sorted(entry['deps'].items()):
+            lines.append(f'mtword_dependency_seconds_total'
+                         f'{{endpoint="{label(endpoint)}",'
+                         f'dependency="{dep}"}} {seconds}')
+
+    lines += [
+        "# HELP mtword_cache_lookups_total Cache lookups by result",
+        "# TYPE mtword_cache_lookups_total counter",
+    ]
+    for endpoint, entry in sorted(totals.items()):
+        for cache_name, (hits, misses) in sorted(entry['cache'].items()):
+            for result, count in (("hit", hits), ("miss", misses)):
+                lines.append(f'mtword_cache_lookups_total'
+                             f'{{endpoint="{label(endpoint)}",'
+                             f'cache="{cache_name}",result="{result}"}} '
+                             f'{count}')
+
+    return "\n".join(lines) + "\n"
+
+
+def summarize(totals):
+    """ One row per endpoint for the admin page, slowest first """
+
+    rows = []
+
+    for endpoint, entry in totals.items():
+        count = entry['count']
+        if not count:
+            continue
+
+        row = {
+            'endpoint': endpoint,
+            'count': count,
+            'mean_ms': entry['sum'] / count * 1000,
+            'p50_ms': bucket_percentile(entry['buckets'], 0.5) * 1000,
+            'p95_ms': bucket_percentile(entry['buckets'], 0.95) * 1000,
+        }
+
+        for dep in ('sql', 'elasticsearch', 'esv'):
+            calls, seconds = entry['deps'].get(dep, (0, 0))
+            row[f'{dep}_calls'] = calls / count
+            row[f'{dep}_ms'] = seconds / count * 1000
+
+        hits = sum(h for h, m in entry['cache'].values())
+        lookups = hits + sum(m for h, m in entry['cache'].values())
+        row['cache_hit_rate'] = hits / lookups if lookups else None
+
+        rows.append(row)
+
+    return sorted(rows, key=lambda row: row['mean_ms'] * row['count'],
+                  reverse=True)
+
+
+def bucket_percentile(buckets, fraction):
+    """ Upper bound of the bucket holding the percentile """
+
+    target = sum(buckets) * fraction
+    seen = 0
+
+    for bound, count in zip(LATENCY_BUCKETS, buckets):
+        seen += count
+        if seen >= target:
+            return bound if bound != float('inf') else LATENCY_BUCKETS[-2]
+
+    return 0
+
+
+metrics = Metrics()
+
+
+def connect_metrics(app):
+    """ Record the metrics of every request and serve them on /metrics
+        - Connected after the page cache, so its middleware also times
+          the pages answered from it
+    """
+
+    metrics.init_app(app)
@@ -1,19 +1,31 @@
 
-from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
-
 from flask_login import UserMixin
 
-from project.search import add_to_index, remove_from_index, query_index
+from blinker import Namespace
+from itertools import chain
+from sqlalchemy.orm import make_transient_to_detached
+
+from project.cache import cache
+from project.passwords import passwords
+from project.replica import RoutingSQLAlchemy
+from project.search import bulk_add_to_index, query_index
+from project.tracing import tracer
+
+db = RoutingSQLAlchemy()
 
-db = SQLAlchemy()
+# Seconds a logged in user is kept in the user cache
+USER_CACHE_TIMEOUT = 60
 
-bcrypt = Bcrypt()
+model_signals = Namespace()
+
+# Sent with the ids of the sets changed by a commit
+sets_changed = model_signals.signal('sets-changed')
 
 
 class SearchableMixin(object):
     @classmethod
     def search(cls, expression, page, per_page):
+        page = max(page, 1)
         ids, total = query_index(cls.__tablename__, expression, page, per_page)
         if total == 0:
             return cls.query.filter_by(id=0), 0
@@ -24,34 +36,59 @@ class SearchableMixin(object):
             db.case(when, value=cls.id)), total
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def search_db(cls, expression, page, per_page):
+        """ Same results shape as search, with ILIKE on the database
+            - Used when Elasticsearch is not available
+            - Pages before the first one give the first one
+        """
+
+        page = max(page, 1)
+
+        escaped = expression.replace("\\", "\\\\") \
+            .replace("%", "\\%").replace("_", "\\_")
+        pattern = f"%{escaped}%"
+
+        query = cls.query.filter(db.or_(*(
+            getattr(cls, field).ilike(pattern, escape="\\")
+            for field in cls.__searchable__)))
+
+        total = query.count()
+
+        return query.order_by(cls.id).offset(
+            (page - 1) * per_page).limit(per_page), total
 
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+    def queue_index_changes(cls, session, flush_context):
+        """ Queue the search index updates of the flushed models
+            - The jobs are inserted in the same transaction, so the index
+              is only updated once the changes are committed
+        """
+
+        changes = {}
+
+        for obj in chain(session.new, session.dirty):
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
+                changes.setdefault(("search.index", obj.__tablename__),
+                                   set()).add(obj.id)
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+                changes.setdefault(("search.remove", obj.__tablename__),
+                                   set()).add(obj.id)
+
+        if changes:
+            trace_parent = tracer.traceparent()
+            session.connection().execute(Job.__table__.insert(), [
+                {"task": task, "args": [index, sorted(ids)], "kwargs": {},
+                 "trace_parent": trace_parent}
+                for (task, index), ids in changes.items()])
 
     @classmethod
     def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+        bulk_add_to_index(cls.__tablename__, cls.query.yield_per(500))
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
-db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_flush',
+                SearchableMixin.queue_index_changes)
 
 
 class User(UserMixin, db.Model):
@@ -67,7 +104,8 @@ class User(UserMixin, db.Model):
     last_name = db.Column(db.String(50),
                           nullable=False)
     email = db.Column(db.Text,
-                      nullable=False)
+                      nullable=False,
+                      index=True)
     username = db.Column(db.String(30),
                          nullable=False,
                          unique=True)
@@ -93,17 +131,53 @@ class User(UserMixin, db.Model):
 
     def update_password(self, pwd):
         """ Update the user's password """
-        self.password = bcrypt.generate_password_hash(pwd).decode('utf8')
+        self.password = passwords.generate(pwd)
 
     @property
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
 
+    @classmethod
+    def get_cached(cls, user_id):
+        """ Get the user by id, using the user cache when possible
+            - A cached user is attached to the session without a query
+        """
+
+        data = cache.get(f"user:{user_id}")
+
+        if data is None:
+            user = cls.query.get(user_id)
+            if user:
+                cache.set(f"user:{user_id}",
+                          user.cache_data(),
+                          timeout=USER_CACHE_TIMEOUT)
+            return user
+
+        user = cls(**data)
+        make_transient_to_detached(user)
+
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def invalidate_cache(user_id):
+        """ Remove the user from the user cache """
+
+        cache.delete(f"user:{user_id}")
+
+    def cache_data(self):
+        """ Column values of the user kept in the user cache
+            - Secrets are left out and loaded from the database if needed
+        """
+
+        return {attr.key: getattr(self, attr.key)
+                for attr in db.inspect(self).mapper.column_attrs
+                if attr.key not in ('password', 'password_reset_token')}
+
     @classmethod
     def register(cls, username, pwd, email, f_name, l_name):
         """Register user w/hashed password & return user."""
 
-        hashed = bcrypt.generate_password_hash(pwd).decode('utf8')
+        hashed = passwords.generate(pwd)
 
         # return instance of user w/username and hashed pwd along with
         # email, first_name and last_name
@@ -113,6 +187,19 @@ class User(UserMixin, db.Model):
                    first_name=f_name,
                    last_name=l_name)
 
+    @classmethod
+    def taken(cls, username, email):
+        """ Whether the username and the email are used, in one query
+            on the indexes of both columns
+        """
+
+        rows = db.session.query(cls.username == username,
+                                cls.email == email).filter(
+            db.or_(cls.username == username, cls.email == email)).all()
+
+        return (any(username_taken for username_taken, _ in rows),
+                any(email_taken for _, email_taken in rows))
+
     @classmethod
     def authenticate(cls, username, pwd):
         """Validate that user exists & password is correct.
@@ -122,13 +209,43 @@ class User(UserMixin, db.Model):
 
         u = User.query.filter_by(username=username).first()
 
-        if u and bcrypt.check_password_hash(u.password, pwd):
+        if u and passwords.check(u.password, pwd):
+            # Hashes made with a lower cost are made again, the caller
+            # commits the new one
+            if passwords.needs_rehash(u.password):
+                u.update_password(pwd)
+
             # return user instance
             return u
         else:
             return False
 
 
+def mark_user_changed(mapper, connection, user):
+    """ Drop the changed user from the user cache right away and
+        again once the change is committed
+    """
+
+    User.invalidate_cache(user.id)
+    db.session.info.setdefault('changed_users', set()).add(user.id)
+
+    # The name of the owner is shown with every set
+    state = db.inspect(user)
+    if state.attrs.first_name.history.has_changes() or \
+            state.attrs.last_name.history.has_changes():
+        touch_sets(connection, Set.user_id == user.id)
+
+
+def invalidate_changed_users(session):
+    for user_id in session.info.pop('changed_users', ()):
+        User.invalidate_cache(user_id)
+
+
+db.event.listen(User, 'after_update', mark_user_changed)
+db.event.listen(User, 'after_delete', mark_user_changed)
+db.event.listen(db.session, 'after_commit', invalidate_changed_users)
+
+
 class Set(SearchableMixin, db.Model):
     """Set containing various bible verses."""
 
@@ -145,9 +262,15 @@ class Set(SearchableMixin, db.Model):
                         db.ForeignKey('users.id'))
     created_at = db.Column(db.DateTime(timezone=True),
                            server_default=db.func.now())
+    # Bumped whenever the set or any of its cards change
+    updated_at = db.Column(db.DateTime(timezone=True),
+                           nullable=False,
+                           server_default=db.func.now(),
+                           onupdate=db.func.now())
 
     verses = db.relationship('Verse',
                              secondary='sets_verses',
+                             order_by='SetVerse.position',
                              backref='sets',
                              cascade="all, delete")
 
@@ -155,6 +278,31 @@ class Set(SearchableMixin, db.Model):
         return f"<Set {self.name} by {self.user.first_name} \
             {self.user.last_name}>"
 
+    @property
+    def version(self):
+        """ Number that changes whenever the set or its cards change """
+        return int(self.updated_at.timestamp() * 1000000)
+
+    @classmethod
+    def card_rows(cls, set_id, fields=("reference", "verse"),
+                  limit=None, offset=0):
+        """ Tuples of the verse fields of the cards of a set, in order,
+            without loading any ORM instances
+        """
+
+        query = db.session.query(
+            *[getattr(Verse, field) for field in fields]
+        ).join(
+            SetVerse, SetVerse.verse_id == Verse.id
+        ).filter(
+            SetVerse.set_id == set_id
+        ).order_by(SetVerse.position).offset(offset)
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        return query.all()
+
 
 class Favorite(db.Model):
     """ User's favorited sets """
@@ -182,6 +330,14 @@ class SetVerse(db.Model):
                        db.ForeignKey('sets.id'))
     verse_id = db.Column(db.Integer,
                          db.ForeignKey('verses.id'))
+    position = db.Column(db.Integer,
+                         nullable=False,
+                         default=0,
+                         server_default='0')
+
+    __table_args__ = (
+        db.Index('ix_sets_verses_set_id_position', 'set_id', 'position'),
+    )
 
 
 class Verse(db.Model):
@@ -208,6 +364,300 @@ class Verse(db.Model):
         return hash(self.reference)
 
 
+def mark_sets_of_verse_changed(mapper, connection, verse):
+    """ Bump the sets that show the edited verse """
+
+    touch_sets(connection, Set.id.in_(
+        db.select([SetVerse.set_id]).where(SetVerse.verse_id == verse.id)))
+
+
+def touch_sets(connection, condition):
+    """ Bump the version of the matching sets from inside a flush """
+
+    result = connection.execute(
+        Set.__table__.update()
+        .where(condition)
+        .values(updated_at=db.func.now())
+        .returning(Set.id))
+
+    mark_sets_changed(row[0] for row in result)
+
+
+def mark_sets_changed(set_ids):
+    db.session.info.setdefault('changed_sets', set()).update(set_ids)
+
+
+def collect_changed_sets(session, flush_context):
+    mark_sets_changed(
+        obj.id for obj in chain(session.new, session.dirty, session.deleted)
+        if isinstance(obj, Set))
+
+
+def announce_changed_sets(session):
+    set_ids = session.info.pop('changed_sets', None)
+    if set_ids:
+        sets_changed.send(frozenset(set_ids))
+
+
+def forget_changed_sets(session, previous_transaction):
+    session.info.pop('changed_sets', None)
+
+
+db.event.listen(Verse, 'after_update', mark_sets_of_verse_changed)
+db.event.listen(db.session, 'after_flush', collect_changed_sets)
+db.event.listen(db.session, 'after_commit', announce_changed_sets)
+db.event.listen(db.session, 'after_soft_rollback', forget_changed_sets)
+
+
+class SetJob(db.Model):
+    """Creation, edit or copy of a set done in the background."""
+
+    __tablename__ = "set_jobs"
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.id'),
+                        nullable=False)
+    # "create", "edit" or "copy"
+    kind = db.Column(db.String(10),
+                     nullable=False)
+    # "queued", "running", "done" or "failed"
+    status = db.Column(db.String(10),
+                       nullable=False,
+                       default="queued")
+    name = db.Column(db.String(50),
+                     nullable=False)
+    description = db.Column(db.Text)
+    references = db.Column(db.JSON,
+                           nullable=False)
+    # Set being edited, or the new set once it is made
+    set_id = db.Column(db.Integer,
+                       db.ForeignKey('sets.id', ondelete='SET NULL'))
+    refs_done = db.Column(db.Integer,
+                          nullable=False,
+                          default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime(timezone=True),
+                           server_default=db.func.now())
+
+    def __repr__(self):
+        return f"<SetJob {self.kind} {self.name} {self.status}>"
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "set_id": self.set_id,
+            "refs_done": self.refs_done,
+            "refs_total": len(self.references),
+            "error": self.error,
+        }
+
+
+class Job(db.Model):
+    """Background job waiting in the queue, running or dead."""
+
+    __tablename__ = "jobs"
+
+    id = db.Column(db.BigInteger,
+                   primary_key=True,
+                   autoincrement=True)
+    task = db.Column(db.String(100),
+                     nullable=False)
+    args = db.Column(db.JSON,
+                     nullable=False,
+                     default=list)
+    kwargs = db.Column(db.JSON,
+                       nullable=False,
+                       default=dict)
+    # "queued", "running", "done" or "dead"
+    status = db.Column(db.String(10),
+                       nullable=False,
+                       default="queued")
+    attempts = db.Column(db.Integer,
+                         nullable=False,
+                         default=0)
+    max_attempts = db.Column(db.Integer,
+                             nullable=False,
+                             default=5)
+    run_at = db.Column(db.DateTime(timezone=True),
+                       nullable=False,
+                       server_default=db.func.now())
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime(timezone=True))
+    last_error = db.Column(db.Text)
+    # W3C traceparent of the span that queued the job
+    trace_parent = db.Column(db.String(55))
+    created_at = db.Column(db.DateTime(timezone=True),
+                           server_default=db.func.now())
+    finished_at = db.Column(db.DateTime(timezone=True))
+
+    # Workers only look at the queued jobs
+    __table_args__ = (
+        db.Index('ix_jobs_queued_run_at', 'run_at', 'id',
+                 postgresql_where=db.text("status = 'queued'")),
+    )
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.task} {self.status}>"
+
+
+class PlanImport(db.Model):
+    """Progress of a reading plan import, used to resume it."""
+
+    __tablename__ = "plan_imports"
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+    key = db.Column(db.String(64),
+                    nullable=False,
+                    unique=True)
+    filename = db.Column(db.Text)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.id'))
+    # The uploaded plan, kept for the job until the import finishes
+    plan = db.Column(db.Text)
+    format = db.Column(db.String(10))
+    entries_total = db.Column(db.Integer)
+    entries_done = db.Column(db.Integer,
+                             nullable=False,
+                             default=0)
+    sets_created = db.Column(db.Integer,
+                             nullable=False,
+                             default=0)
+    entries_skipped = db.Column(db.Integer,
+                                nullable=False,
+                                default=0)
+    finished = db.Column(db.Boolean,
+                         nullable=False,
+                         default=False)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime(timezone=True),
+                           server_default=db.func.now())
+
+    user = db.relationship('User')
+
+    def __repr__(self):
+        return f"<PlanImport {self.filename} {self.entries_done} done>"
+
+    def serialize(self):
+        return {
+            "id": self.id,
+            "finished": self.finished,
+            "entries_done": self.entries_done,
+            "entries_total": self.entries_total,
+            "sets_created": self.sets_created,
+            "entries_skipped": self.entries_skipped,
+            "error": self.error,
+        }
+
+
+class ProfileRecord(db.Model):
+    """Stack samples of a request an admin asked to profile."""
+
+    __tablename__ = "profile_records"
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+    method = db.Column(db.String(10),
+                       nullable=False)
+    path = db.Column(db.Text,
+                     nullable=False)
+    endpoint = db.Column(db.String(100))
+    status = db.Column(db.Integer)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('users.id', ondelete='SET NULL'))
+    duration_ms = db.Column(db.Float,
+                            nullable=False)
+    interval_ms = db.Column(db.Float,
+                            nullable=False)
+    sample_count = db.Column(db.Integer,
+                             nullable=False)
+    # Folded stacks, "outer;inner;innermost" -> number of samples
+    stacks = db.Column(db.JSON,
+                       nullable=False,
+                       default=dict)
+    created_at = db.Column(db.DateTime(timezone=True),
+                           server_default=db.func.now())
+
+    user = db.relationship('User')
+
+    def __repr__(self):
+        return f"<ProfileRecord {self.method} {self.path} " \
+            f"{self.duration_ms:.0f}ms>"
+
+
+class PagePurge(db.Model):
+    """When the cached pages with a tag were last purged, so every
+    process drops them, not only the one that changed the data."""
+
+    __tablename__ = "page_purges"
+
+    tag = db.Column(db.String(50),
+                    primary_key=True)
+    # Seconds since the epoch, like the times of the cached pages
+    purged_at = db.Column(db.Float,
+                          nullable=False,
+                          index=True)
+
+    def __repr__(self):
+        return f"<PagePurge {self.tag} {self.purged_at}>"
+
+
+class SlowQuery(db.Model):
+    """SQL statements that went over the slow query threshold, added up
+    per normalized statement and per view."""
+
+    __tablename__ = "slow_queries"
+
+    id = db.Column(db.Integer,
+                   primary_key=True,
+                   autoincrement=True)
+    fingerprint = db.Column(db.String(16),
+                            nullable=False)
+    # The view, or "background" for jobs and commands
+    endpoint = db.Column(db.String(100),
+                         nullable=False)
+    statement = db.Column(db.Text,
+                          nullable=False)
+    # Where in our code the statement was issued, last time
+    caller = db.Column(db.Text)
+    calls = db.Column(db.Integer,
+                      nullable=False,
+                      default=0)
+    total_ms = db.Column(db.Float,
+                         nullable=False,
+                         default=0)
+    max_ms = db.Column(db.Float,
+                       nullable=False,
+                       default=0)
+    plan = db.Column(db.Text)
+    plan_ms = db.Column(db.Float)
+    plan_at = db.Column(db.DateTime(timezone=True))
+    first_seen = db.Column(db.DateTime(timezone=True),
+                           server_default=db.func.now())
+    last_seen = db.Column(db.DateTime(timezone=True),
+                          server_default=db.func.now())
+
+    __table_args__ = (
+        db.UniqueConstraint('fingerprint', 'endpoint',
+                            name='uq_slow_queries_fingerprint_endpoint'),
+    )
+
+    @property
+    def mean_ms(self):
+        return self.total_ms / self.calls if self.calls else 0
+
+    def __repr__(self):
+        return f"<SlowQuery {self.fingerprint} {self.endpoint} " \
+            f"{self.calls} calls>"
+
+
 def connect_db(app):
     """Connect to database."""
 
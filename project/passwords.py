@@ -0,0 +1,169 @@
+import logging
+import math
+import multiprocessing
+import os
+import re
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+logger = logging.getLogger(__name__)
+
+# The cost of "$2b$12$..." hashes
+COST_RE = re.compile(r"^\$2[abxy]?\$(\d\d)\$")
+
+# A fresh process that has not inherited the worker's threads, gevent
+# hub or database connections
+START_METHOD = 'forkserver' \
+    if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def hash_password(pwd, rounds):
+    return bcrypt.hashpw(pwd.encode('utf8'),
+                         bcrypt.gensalt(rounds)).decode('utf8')
+
+
+def check_password(hashed, pwd):
+    try:
+        return bcrypt.checkpw(pwd.encode('utf8'), hashed.encode('utf8'))
+    except ValueError:
+        # Not a bcrypt hash, like the "!" of users no one can log in as
+        return False
+
+
+def hash_cost(hashed):
+    """ The bcrypt cost of the hash, None if it is not a bcrypt hash """
+
+    match = COST_RE.match(hashed or "")
+    return int(match.group(1)) if match else None
+
+
+def calibrate(target_ms, min_rounds, max_rounds):
+    """ The highest bcrypt cost hashing in about target_ms here
+        - Every round more doubles the time, so one hash at min_rounds
+          tells how many rounds fit
+    """
+
+    start = time.perf_counter()
+    hash_password("calibration", min_rounds)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    extra = math.floor(math.log2(max(target_ms, 0.001) /
+                                 max(elapsed_ms, 0.001)))
+
+    return max(min_rounds, min(max_rounds, min_rounds + extra))
+
+
+class PasswordHasher(object):
+    """ bcrypt run in a pool of processes, so logging in uses the other
+        cores and does not hold the GIL, or the gevent hub, while other
+        requests are served
+        - At most PASSWORD_HASH_MAX_PENDING hashes wait for the pool,
+          the next ones wait for a slot
+        - The cost is calibrated to PASSWORD_HASH_TARGET_MS, within
+          PASSWORD_HASH_MIN_ROUNDS and PASSWORD_HASH_MAX_ROUNDS, unless
+          PASSWORD_HASH_ROUNDS fixes it
+        - Hashes with a lower cost are redone when their user logs in
+        - Without workers, hashes are made on the calling thread
+    """
+
+    def __init__(self):
+        self.workers = 0
+        self.rounds = None
+        self.target_ms = 250
+        self.min_rounds = 12
+        self.max_rounds = 16
+        self.executor = None
+        self.executor_pid = None
+        self.slots = None
+        self.lock = threading.Lock()
+        self.calibration_lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        app.config.setdefault('PASSWORD_HASH_MAX_PENDING', 64)
+        app.config.setdefault('PASSWORD_HASH_ROUNDS', None)
+        app.config.setdefault('PASSWORD_HASH_TARGET_MS', 250)
+        app.config.setdefault('PASSWORD_HASH_MIN_ROUNDS', 12)
+        app.config.setdefault('PASSWORD_HASH_MAX_ROUNDS', 16)
+
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.rounds = app.config['PASSWORD_HASH_ROUNDS']
+        self.target_ms = app.config['PASSWORD_HASH_TARGET_MS']
+        self.min_rounds = app.config['PASSWORD_HASH_MIN_ROUNDS']
+        self.max_rounds = app.config['PASSWORD_HASH_MAX_ROUNDS']
+        self.slots = threading.BoundedSemaphore(
+            app.config['PASSWORD_HASH_MAX_PENDING'])
+
+    # Running
+
+    def get_executor(self):
+        """ The pool of this process, made on first use since gunicorn
+            workers fork after the app is loaded
+        """
+
+        with self.lock:
+            if self.executor is None or self.executor_pid != os.getpid():
+                self.executor = ProcessPoolExecutor(
+                    self.workers,
+                    mp_context=multiprocessing.get_context(START_METHOD))
+                self.executor_pid = os.getpid()
+
+            return self.executor
+
+    def run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+
+        with self.slots:
+            executor = self.get_executor()
+            try:
+                return executor.submit(func, *args).result()
+            except BrokenProcessPool:
+                logger.exception("The password hashing pool broke")
+                with self.lock:
+                    if self.executor is executor:
+                        self.executor = None
+                return func(*args)
+
+    # Hashing
+
+    def current_rounds(self):
+        if self.rounds is None:
+            with self.calibration_lock:
+                if self.rounds is None:
+                    self.rounds = self.run(calibrate, self.target_ms,
+                                           self.min_rounds, self.max_rounds)
+                    logger.info("Hashing passwords with a bcrypt cost of %s",
+                                self.rounds)
+
+        return self.rounds
+
+    def generate(self, pwd):
+        """ A new hash of the password """
+
+        return self.run(hash_password, pwd, self.current_rounds())
+
+    def check(self, hashed, pwd):
+        """ Whether the password matches the hash """
+
+        return self.run(check_password, hashed, pwd)
+
+    def needs_rehash(self, hashed):
+        """ Whether the hash is weaker than the ones made now """
+
+        cost = hash_cost(hashed)
+        return cost is not None and cost < self.current_rounds()
+
+
+passwords = PasswordHasher()
+
+
+def connect_passwords(app):
+    """ Hash passwords off the request thread, see PasswordHasher """
+
+    passwords.init_app(app)
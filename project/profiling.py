@@ -0,0 +1,284 @@
+import logging
+import os
+import sys
+import time
+
+from collections import Counter
+
+from flask import current_app, g, request, url_for
+from flask_login import current_user
+
+from project.models import db, ProfileRecord
+
+logger = logging.getLogger(__name__)
+
+# Profile samples deeper than this are cut at the innermost frames
+MAX_DEPTH = 100
+
+
+def original(module, name):
+    """ The function before gevent patched it, so the sampler keeps
+        running in a real thread next to the worker's greenlets
+    """
+
+    try:
+        from gevent import monkey
+    except ImportError:
+        return getattr(__import__(module), name)
+
+    return monkey.get_original(module, name)
+
+
+def current_greenlet():
+    """ The greenlet of the request when gevent patched threads, None
+        when each request has a thread of its own
+    """
+
+    try:
+        from gevent import getcurrent, monkey
+    except ImportError:
+        return None
+
+    if not monkey.is_module_patched('threading'):
+        return None
+
+    return getcurrent()
+
+
+def frame_name(code):
+    """ "function (path/of/module.py:line)" with the path made short """
+
+    filename = code.co_filename
+    for marker in ("site-packages" + os.sep, os.getcwd() + os.sep):
+        if marker in filename:
+            filename = filename.split(marker, 1)[1]
+            break
+
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def fold(frame):
+    """ The stack of the frame as "outer;...;inner" """
+
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+class Sampler(object):
+    """ Sample the stack of a thread from another thread
+        - Unlike cProfile nothing runs on the profiled thread, so the
+          request is barely slowed down
+        - With gevent every greenlet shares the thread, so the request's
+          greenlet is sampled where it waits while others run, and from
+          the thread while it runs itself
+    """
+
+    def __init__(self, interval=0.005, max_samples=20000):
+        self.interval = interval
+        self.max_samples = max_samples
+        self.stacks = Counter()
+        self.running = False
+        self.thread_id = None
+        self.greenlet = None
+        self.started = None
+        self.duration = None
+        # Held by the sampling thread until it is done
+        self.sampling = original('_thread', 'allocate_lock')()
+
+    def start(self):
+        self.thread_id = original('_thread', 'get_ident')()
+        self.greenlet = current_greenlet()
+        self.running = True
+        self.started = time.perf_counter()
+        self.sampling.acquire()
+        original('_thread', 'start_new_thread')(self.run, ())
+
+    def run(self):
+        sleep = original('time', 'sleep')
+        samples = 0
+
+        try:
+            while self.running and samples < self.max_samples:
+                frame = self.frame()
+                if frame is not None:
+                    self.stacks[fold(frame)] += 1
+                    samples += 1
+                del frame
+                sleep(self.interval)
+        finally:
+            self.sampling.release()
+
+    def frame(self):
+        """ The innermost frame of the profiled request """
+
+        # A greenlet that is switched out keeps the frame it waits in
+        if self.greenlet is not None and \
+                self.greenlet.gr_frame is not None:
+            return self.greenlet.gr_frame
+
+        return sys._current_frames().get(self.thread_id)
+
+    def stop(self):
+        """ Stop sampling and return the folded stacks """
+
+        self.running = False
+        self.duration = time.perf_counter() - self.started
+
+        # Waits for the last sample, at most one interval
+        with self.sampling:
+            return dict(self.stacks)
+
+
+def wants_profile():
+    """ Whether an admin asked to profile this request """
+
+    config = current_app.config
+
+    asked = request.headers.get(config['PROFILE_HEADER']) or \
+        request.args.get(config['PROFILE_PARAM'])
+    if not asked:
+        return False
+
+    return current_user.is_authenticated and current_user.is_admin
+
+
+def flame_graph(stacks):
+    """ Tree of the folded stacks for the flame graph
+        - Every node is {"name", "value", "children"} with value the
+          number of samples in the frame or in the frames it called
+    """
+
+    root = {"name": "all", "value": 0, "children": {}}
+
+    for stack, count in stacks.items():
+        root["value"] += count
+        node = root
+        for name in stack.split(";"):
+            node = node["children"].setdefault(
+                name, {"name": name, "value": 0, "children": {}})
+            node["value"] += count
+
+    def ordered(node):
+        return dict(node, children=sorted(
+            (ordered(child) for child in node["children"].values()),
+            key=lambda child: -child["value"]))
+
+    return ordered(root)
+
+
+def function_stats(stacks):
+    """ Rows of samples per function, like sorted pstats output
+        - self: samples in the function itself
+        - total: samples in it or in the functions it called
+    """
+
+    own = Counter()
+    total = Counter()
+
+    for stack, count in stacks.items():
+        names = stack.split(";")
+        own[names[-1]] += count
+        for name in set(names):
+            total[name] += count
+
+    samples = sum(stacks.values()) or 1
+
+    return [{"name": name,
+             "self": own[name],
+             "total": total[name],
+             "self_pct": own[name] / samples * 100,
+             "total_pct": total[name] / samples * 100}
+            for name in sorted(total, key=lambda name: (-own[name],
+                                                        -total[name]))]
+
+
+class Profiling(object):
+    """ Sample the requests admins ask for and keep the results
+        - Send the PROFILE_HEADER header, or the PROFILE_PARAM query
+          argument, with any request while logged in as an admin
+        - The samples are saved with the request and linked from the
+          X-Profile-Url response header
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILING_ENABLED', True)
+        app.config.setdefault('PROFILE_HEADER', 'X-Profile')
+        app.config.setdefault('PROFILE_PARAM', '_profile')
+        app.config.setdefault('PROFILE_INTERVAL', 0.005)
+        app.config.setdefault('PROFILE_KEEP', 200)
+
+        if not app.config['PROFILING_ENABLED']:
+            return
+
+        @app.before_request
+        def start_profile():
+            if wants_profile():
+                g.profile_sampler = Sampler(app.config['PROFILE_INTERVAL'])
+                g.profile_sampler.start()
+
+        @app.after_request
+        def save_profile(response):
+            sampler = g.pop('profile_sampler', None)
+            if sampler is None:
+                return response
+
+            stacks = sampler.stop()
+            record_id = self.save(sampler, stacks, response.status_code)
+            if record_id is not None:
+                response.headers['X-Profile-Url'] = url_for(
+                    'profiles_admin.show', record_id=record_id,
+                    _external=True)
+
+            return response
+
+        @app.teardown_request
+        def stop_profile(exc):
+            # The request failed before its response was made
+            sampler = g.pop('profile_sampler', None)
+            if sampler is not None:
+                sampler.stop()
+
+    def save(self, sampler, stacks, status):
+        """ Store the samples apart from the request's transaction, and
+            drop the oldest records past PROFILE_KEEP
+        """
+
+        keep = current_app.config['PROFILE_KEEP']
+
+        try:
+            with db.engine.begin() as conn:
+                record_id = conn.execute(
+                    ProfileRecord.__table__.insert().returning(
+                        ProfileRecord.id), {
+                        "method": request.method,
+                        "path": request.full_path.rstrip("?"),
+                        "endpoint": request.endpoint,
+                        "status": status,
+                        "user_id": current_user.id,
+                        "duration_ms": sampler.duration * 1000,
+                        "interval_ms": sampler.interval * 1000,
+                        "sample_count": sum(stacks.values()),
+                        "stacks": stacks,
+                    }).scalar()
+
+                conn.execute(ProfileRecord.__table__.delete().where(
+                    ProfileRecord.id <= record_id - keep))
+        except Exception:
+            logger.exception("Could not save the profile of %s",
+                             request.path)
+            return None
+
+        return record_id
+
+
+profiling = Profiling()
+
+
+def connect_profiling(app):
+    """ Let admins profile any request, see Profiling """
+
+    profiling.init_app(app)
@@ -0,0 +1,106 @@
+import time
+
+from flask import request
+
+from project.cache import MemoryCache
+
+
+def take_token(bucket, capacity, period, now, cost=1):
+    """ Take cost tokens from the bucket
+        - The bucket is (tokens, time of the last take), None for a
+          full one, and gets capacity tokens back every period seconds
+        - A cost of 0 only checks that there is a token left
+        - Returns the new bucket and the seconds to wait for a token,
+          0 when the attempt can go on
+    """
+
+    rate = capacity / period
+    tokens, updated = bucket or (capacity, now)
+    tokens = min(capacity, tokens + (now - updated) * rate)
+
+    if tokens >= 1:
+        return (tokens - cost, now), 0
+
+    return (tokens, now), (1 - tokens) / rate
+
+
+class RateLimiter(object):
+    """ Token buckets kept in a store of their own in each process
+        - Updates never touch the disk or the app cache, so a burst of
+          attempts costs little and evicts nothing else
+        - Every worker keeps its own buckets, an address gets the
+          attempts of RATE_LIMITS once per worker
+        - RATE_LIMITS: name -> (attempts, seconds to get them all back)
+        - RATE_LIMIT_MAX_BUCKETS: buckets kept, least recently used
+          ones are dropped past it
+        - RATE_LIMIT_PROXIES: proxies in front of the app, whose
+          X-Forwarded-For entries are trusted to find the client
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.limits = {}
+        self.proxies = 0
+        self.store = MemoryCache()
+
+    def init_app(self, app):
+        app.config.setdefault('RATE_LIMIT_ENABLED', True)
+        app.config.setdefault('RATE_LIMIT_PROXIES', 0)
+        app.config.setdefault('RATE_LIMIT_MAX_BUCKETS', 100000)
+        app.config.setdefault('RATE_LIMITS', {
+            'login_ip': (30, 300),
+            'login_failures': (10, 600),
+            'register_ip': (5, 3600),
+        })
+
+        self.enabled = app.config['RATE_LIMIT_ENABLED']
+        self.limits = app.config['RATE_LIMITS']
+        self.proxies = app.config['RATE_LIMIT_PROXIES']
+        self.store = MemoryCache(
+            max_entries=app.config['RATE_LIMIT_MAX_BUCKETS'])
+
+    def client_ip(self):
+        """ The address of the client, past the trusted proxies """
+
+        forwarded = [ip.strip() for ip in
+                     request.headers.get('X-Forwarded-For', "").split(",")
+                     if ip.strip()]
+
+        if self.proxies and len(forwarded) >= self.proxies:
+            return forwarded[-self.proxies]
+
+        return request.remote_addr
+
+    def take(self, *buckets, cost=1):
+        """ Take cost tokens from each (limit name, key) bucket
+            - Returns the seconds to wait when one of them is empty, 0
+              when the attempt can go on
+        """
+
+        if not self.enabled:
+            return 0
+
+        now = time.time()
+        wait = 0
+
+        for name, key in buckets:
+            if not key:
+                continue
+
+            capacity, period = self.limits[name]
+            wait = max(wait, self.store.update(
+                f"{name}:{key}",
+                lambda bucket: take_token(bucket, capacity, period, now,
+                                          cost),
+                timeout=period))
+
+        return wait
+
+
+rate_limiter = RateLimiter()
+
+
+def connect_rate_limits(app):
+    """ Limit how often logins and registrations can be tried """
+
+    rate_limiter.init_app(app)
@@ -0,0 +1,137 @@
+import logging
+import time
+
+from flask import g, request, session, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm, text
+from sqlalchemy.sql.selectable import GenerativeSelect
+
+logger = logging.getLogger(__name__)
+
+REPLICA_BIND = 'replica'
+
+# Last known state of the replica in this process
+replica_state = {
+    'lag': None,
+    'checked_at': 0,
+    'healthy': False,
+}
+
+LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(
+            EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+class RoutingSession(SignallingSession):
+    """ Session that sends SELECTs to the replica when the current
+        request is allowed to read from it
+        - Flushes, bulk writes and raw SQL always go to the primary
+    """
+
+    def __init__(self, db, **options):
+        self._db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, GenerativeSelect) and not self._flushing:
+            if reads_from_replica():
+                return self._db.get_engine(self.app, bind=REPLICA_BIND)
+        elif has_request_context():
+            # Anything that can write pins the rest of the request
+            # to the primary so it can read its own writes
+            g.db_role = 'primary'
+            g.db_wrote = True
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy using the replica aware session """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def reads_from_replica():
+    """ Whether queries of the current request should use the replica """
+
+    if not has_request_context() or g.get('db_role') != 'replica':
+        return False
+
+    if not replica_is_fresh():
+        g.db_role = 'primary'
+        return False
+
+    return True
+
+
+def replica_is_fresh():
+    """ Check the replication lag, at most once per interval
+        - The replica is skipped when it lags more than REPLICA_MAX_LAG
+          seconds behind or when it cannot be reached
+    """
+
+    from flask import current_app
+
+    now = time.monotonic()
+    interval = current_app.config['REPLICA_LAG_CHECK_INTERVAL']
+
+    if now - replica_state['checked_at'] >= interval:
+        replica_state['checked_at'] = now
+        try:
+            engine = current_app.extensions['sqlalchemy'].db.get_engine(
+                current_app, bind=REPLICA_BIND)
+            with engine.connect() as conn:
+                lag = float(conn.execute(LAG_QUERY).scalar() or 0)
+        except Exception:
+            logger.exception("Could not check the replica lag")
+            replica_state['lag'] = None
+            replica_state['healthy'] = False
+        else:
+            replica_state['lag'] = lag
+            replica_state['healthy'] = \
+                lag <= current_app.config['REPLICA_MAX_LAG']
+            if not replica_state['healthy']:
+                logger.warning("Replica is %.1fs behind, using the primary",
+                               lag)
+
+    return replica_state['healthy']
+
+
+def connect_replica(app):
+    """ Route read only requests to the replica when one is configured
+        - GET and HEAD requests and the blueprints listed in
+          REPLICA_READ_ONLY_BLUEPRINTS read from the replica
+        - After a write, the user reads from the primary for
+          REPLICA_STICKY_SECONDS so they see their own changes
+    """
+
+    app.config.setdefault('REPLICA_MAX_LAG', 10)
+    app.config.setdefault('REPLICA_LAG_CHECK_INTERVAL', 5)
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 15)
+    app.config.setdefault('REPLICA_READ_ONLY_BLUEPRINTS', ())
+
+    if REPLICA_BIND not in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        return
+
+    @app.before_request
+    def choose_database():
+        g.db_role = 'primary'
+
+        read_only = request.method in ('GET', 'HEAD') or \
+            request.blueprint in app.config['REPLICA_READ_ONLY_BLUEPRINTS']
+
+        if read_only and session.get('_primary_until', 0) < time.time():
+            g.db_role = 'replica'
+
+    @app.after_request
+    def remember_write(response):
+        if g.get('db_wrote') and request.method not in ('GET', 'HEAD'):
+            session['_primary_until'] = \
+                time.time() + app.config['REPLICA_STICKY_SECONDS']
+        return response
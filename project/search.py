@@ -1,11 +1,48 @@
-current_app = None
+import threading
+
+from flask import current_app
+
+from project.config import elasticsearch_hosts
+from project.metrics import track
+from project.tracing import tracer
+
+
+class LazyElasticsearch(object):
+    """ Elasticsearch client made on first use
+        - Importing the client and opening its connection pool waits
+          until a worker process needs it, after any fork
+        - False when no Elasticsearch url is configured
+    """
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.client = None
+        self.lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.hosts)
+
+    def __getattr__(self, name):
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    from elasticsearch import Elasticsearch
+                    self.client = Elasticsearch(self.hosts)
+        return getattr(self.client, name)
 
 
 def connect_app_to_search(app):
+    """ Give the app its (lazy) Elasticsearch client """
+
+    app.elasticsearch = LazyElasticsearch(
+        elasticsearch_hosts(app.config.get('ELASTICSEARCH_URL')))
+
 
-    global current_app
-    current_app = app
-    return
+def bulk(client, actions, **kwargs):
+    """ elasticsearch.helpers.bulk, imported on first use """
+
+    from elasticsearch.helpers import bulk
+    return bulk(client, actions, **kwargs)
 
 
 def add_to_index(index, model):
@@ -15,23 +52,60 @@ def add_to_index(index, model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    with track("elasticsearch"):
+        current_app.elasticsearch.index(index=index, id=model.id,
+                                        body=payload,
+                                        headers=tracer.headers())
+
+
+def bulk_add_to_index(index, models):
+    """ Index many models with one bulk request """
+    if not current_app.elasticsearch:
+        return
+    actions = ({
+        '_index': index,
+        '_id': model.id,
+        '_source': {field: getattr(model, field)
+                    for field in model.__searchable__}
+    } for model in models)
+    with track("elasticsearch"):
+        bulk(current_app.elasticsearch, actions, headers=tracer.headers())
 
 
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    with track("elasticsearch"):
+        current_app.elasticsearch.delete(index=index, id=model.id,
+                                         headers=tracer.headers())
+
+
+def bulk_remove_from_index(index, ids):
+    """ Remove many documents with one bulk request """
+    if not current_app.elasticsearch:
+        return
+    actions = ({
+        '_op_type': 'delete',
+        '_index': index,
+        '_id': doc_id,
+    } for doc_id in ids)
+    # Documents that were never indexed are already gone
+    with track("elasticsearch"):
+        bulk(current_app.elasticsearch, actions, raise_on_error=False,
+             headers=tracer.headers())
 
 
 def query_index(index, query, page, per_page):
     if not current_app.elasticsearch:
         return [], 0
 
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
+    with track("elasticsearch"):
+        search = current_app.elasticsearch.search(
+            index=index,
+            body={'query': {'multi_match': {'query': query,
+                                            'fields': ['*']}},
+                  'from': (page - 1) * per_page, 'size': per_page},
+            headers=tracer.headers())
 
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
     return ids, search['hits']['total']['value']
@@ -1,16 +1,24 @@
 
 from flask import Blueprint, render_template, request, url_for, \
-    flash, redirect, abort
+    flash, redirect, abort, make_response, jsonify, g
 
 from flask_login import login_required, current_user
 
-from ..helpers.sets import get_all_verses
+from ..helpers.set_jobs import start_set_job
+from ..helpers.http import conditional_response, add_cache_headers
+from ..helpers.page_cache import tag_page
 
-from ..models import db, Set
+from ..models import db, Set, SetJob, Favorite
 from ..forms import SetForm
 
 sets = Blueprint('sets', __name__, template_folder="templates")
 
+JOB_MESSAGES = {
+    "create": "Created new set!",
+    "edit": "Updated your set!",
+    "copy": "Copied the set!",
+}
+
 ####################################################################
 # Set Routes
 
@@ -19,44 +27,18 @@ sets = Blueprint('sets', __name__, template_folder="templates")
 @login_required
 def create_new_set():
     """ Creates a new set
-        - Validates that there is at least 1 valid verse reference
+        - The verses are resolved by a background job, the user waits
+          for it on the job page
     """
 
     form = SetForm()
 
     if form.validate_on_submit():
 
-        # Get all the verse instances with the references
-        verses = get_all_verses(request.form.getlist('refs'))
-
-        # If there are no valid references
-        if not verses:
-            form.name.errors = [
-                "Please make sure to include at least 1 valid verse reference"
-            ]
-            return render_template("sets/add_edit_set.html",
-                                   form=form,
-                                   title="Add a new set",
-                                   verb="Create")
-
-        name = form.name.data
-
-        description = form.description.data
-
-        new_set = Set(name=name,
-                      description=description,
-                      user_id=current_user.id)
-
-        db.session.add(new_set)
-        db.session.commit()
-
-        new_set.verses += verses
-
-        db.session.commit()
-
-        flash("Created new set!", "success")
+        job = start_set_job("create", current_user.id, form,
+                            request.form.getlist('refs'))
 
-        return redirect(url_for("sets.show_set", set_id=new_set.id))
+        return redirect(url_for("sets.show_set_job", job_id=job.id))
 
     return render_template("sets/add_edit_set.html",
                            form=form,
@@ -80,31 +62,10 @@ def edit_set(set_id):
 
     if form.validate_on_submit():
 
-        # Get all the verse instances with the references
-        verses = get_all_verses(request.form.getlist('refs'))
-
-        if not verses:
-            form.name.errors = [
-                "Please make sure to include at least 1 valid verse reference"
-            ]
-            return render_template("sets/add_edit_set.html",
-                                   form=form,
-                                   title="Edit your set",
-                                   verb="Edit",
-                                   verses=current_set.verses)
+        job = start_set_job("edit", current_user.id, form,
+                            request.form.getlist('refs'), set_id=set_id)
 
-        edited_set = Set.query.get(set_id)
-
-        edited_set.name = form.name.data
-        edited_set.description = form.description.data
-
-        edited_set.verses = verses
-
-        db.session.commit()
-
-        flash("Updated your set!", "info")
-
-        return redirect(url_for("sets.show_set", set_id=set_id))
+        return redirect(url_for("sets.show_set_job", job_id=job.id))
 
     form = SetForm(obj=current_set)
     return render_template("sets/add_edit_set.html",
@@ -130,35 +91,10 @@ def copy_set(set_id):
 
     if form.validate_on_submit():
 
-        # Get all the verse instances with the references
-        verses = get_all_verses(request.form.getlist('refs'))
-
-        if not verses:
-            form.name.errors = [
-                "Please make sure to include at least 1 valid verse reference"
-            ]
-            return render_template("sets/add_edit_set.html",
-                                   form=form,
-                                   title="Copy someone else's set",
-                                   verb="Copy",
-                                   verses=current_set.verses)
-
-        copied_set = Set(
-            name=form.name.data,
-            description=form.description.data,
-            user_id=current_user.id,
-        )
-
-        db.session.add(copied_set)
-        db.session.commit()
-
-        copied_set.verses = verses
-
-        db.session.commit()
-
-        flash("Copied the set!", "info")
+        job = start_set_job("copy", current_user.id, form,
+                            request.form.getlist('refs'))
 
-        return redirect(url_for("sets.show_set", set_id=copied_set.id))
+        return redirect(url_for("sets.show_set_job", job_id=job.id))
 
     form = SetForm(obj=current_set)
     return render_template("sets/add_edit_set.html",
@@ -168,6 +104,47 @@ def copy_set(set_id):
                            verses=current_set.verses)
 
 
+@sets.route("/sets/jobs/<int:job_id>")
+@login_required
+def show_set_job(job_id):
+    """ Show the progress of a set job until the set is saved
+        - Once the job is done, go to the set with its message
+    """
+
+    job = get_own_job(job_id)
+
+    if job.status == "done":
+        flash(JOB_MESSAGES[job.kind], "success")
+        return redirect(url_for("sets.show_set", set_id=job.set_id))
+
+    return render_template("sets/set_job.html", job=job)
+
+
+@sets.route("/sets/jobs/<int:job_id>/status")
+@login_required
+def set_job_status(job_id):
+    """ Progress of a set job, polled by the job page """
+
+    job = get_own_job(job_id)
+
+    return jsonify(job=job.serialize())
+
+
+def get_own_job(job_id):
+    """ The job of the current user, read from the primary since the
+        job keeps changing while the replica may lag behind
+    """
+
+    g.db_role = 'primary'
+
+    job = SetJob.query.get_or_404(job_id)
+
+    if job.user_id != current_user.id:
+        abort(404)
+
+    return job
+
+
 @sets.route("/sets/<int:set_id>")
 def show_set(set_id):
     """ Display the set with:
@@ -177,18 +154,36 @@ def show_set(set_id):
 
     current_set = Set.query.get_or_404(set_id)
 
-    headers = ("Reference", "Verse")
-    verses = current_set.verses
+    tag_page(f"set:{current_set.id}")
+
+    if current_user.is_authenticated:
+        viewer_id = current_user.id
+        is_favorite = db.session.query(
+            Favorite.query.filter_by(user_id=current_user.id,
+                                     set_id=set_id).exists()
+        ).scalar()
+    else:
+        viewer_id = 0
+        is_favorite = False
+
+    # The page changes with the set, the viewer and their favorite
+    etag = f"set-{current_set.id}-{current_set.version}-" \
+        f"{viewer_id}-{int(is_favorite)}"
+
+    response = conditional_response(etag, current_set.updated_at)
+
+    if response is None:
+        headers = ("Reference", "Verse")
 
-    is_favorite = current_set in current_user.favorite_sets \
-        if current_user.is_authenticated \
-        else False
+        # The cards are rendered from the fragment cache when possible,
+        # so the verses are only loaded when they are needed
+        response = make_response(render_template("sets/show_set.html",
+                                                 set=current_set,
+                                                 headers=headers,
+                                                 is_favorite=is_favorite,))
 
-    return render_template("sets/show_set.html",
-                           set=current_set,
-                           headers=headers,
-                           verses=verses,
-                           is_favorite=is_favorite,)
+    return add_cache_headers(response, etag, current_set.updated_at,
+                             private=current_user.is_authenticated)
 
 
 @sets.route("/sets/<int:set_id>/cards")
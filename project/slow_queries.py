@@ -0,0 +1,289 @@
+import hashlib
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+
+from datetime import datetime, timezone
+
+from flask import has_request_context, request
+from sqlalchemy import event, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Engine
+
+from project.models import db, SlowQuery
+
+logger = logging.getLogger(__name__)
+
+# Where the calling code is looked for, and this file, which is skipped
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+THIS_FILE = os.path.abspath(__file__)
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+PLACEHOLDER_RE = re.compile(r"%\(\w+\)s|%s")
+NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+# "IN (?, ?, ?)" and "VALUES (?, ?), (?, ?)" of any length
+LIST_RE = re.compile(r"\(\?(?:, \?)+\)")
+REPEATED_LIST_RE = re.compile(r"\(\?, \.\.\.\)(?:, \(\?, \.\.\.\))+")
+# The "CASE sets.id WHEN ? THEN ? ..." of SearchableMixin.search
+CASE_RE = re.compile(r"(?:WHEN \? THEN \? ?){2,}", re.IGNORECASE)
+
+
+def normalize(statement):
+    """ The statement with its values taken out, so the same query with
+        other values, or another number of them, looks the same
+
+        >>> normalize("SELECT * FROM sets WHERE id IN (%(id_1)s, %(id_2)s)")
+        'SELECT * FROM sets WHERE id IN (?, ...)'
+    """
+
+    statement = " ".join(statement.split())
+    statement = STRING_RE.sub("?", statement)
+    statement = PLACEHOLDER_RE.sub("?", statement)
+    statement = NUMBER_RE.sub("?", statement)
+    statement = LIST_RE.sub("(?, ...)", statement)
+    statement = REPEATED_LIST_RE.sub("(?, ...), ...", statement)
+    statement = CASE_RE.sub("WHEN ? THEN ? ... ", statement)
+
+    return statement
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16]
+
+
+def find_caller():
+    """ "file:line in function" of the innermost frame of our code
+        that led to the statement
+    """
+
+    frame = sys._getframe(1)
+
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(PROJECT_DIR) and filename != THIS_FILE:
+            path = os.path.relpath(filename, os.path.dirname(PROJECT_DIR))
+            return f"{path}:{frame.f_lineno} in {frame.f_code.co_name}"
+        frame = frame.f_back
+
+    return None
+
+
+def can_explain(statement, executemany):
+    """ Only plain reads are run again with EXPLAIN ANALYZE, which
+        executes the statement
+    """
+
+    upper = statement.lstrip().upper()
+
+    return not executemany and upper.startswith("SELECT") and \
+        "FOR UPDATE" not in upper and "FOR SHARE" not in upper
+
+
+class SlowQueryLog(object):
+    """ Statements slower than SLOW_QUERY_THRESHOLD_MS, added up per
+        fingerprint and view in the slow_queries table
+        - The statement only goes on a queue when it is slow, a
+          background thread adds them up and saves them every
+          SLOW_QUERY_FLUSH_INTERVAL seconds
+        - Some of them, at most once per SLOW_QUERY_EXPLAIN_INTERVAL
+          for each fingerprint, are run again with EXPLAIN (ANALYZE,
+          BUFFERS) in a side transaction that is rolled back
+    """
+
+    def __init__(self):
+        self.app = None
+        self.threshold = None
+        self.pending = queue.Queue(10000)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.rng = random.Random()
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_QUERY_THRESHOLD_MS', 200)
+        app.config.setdefault('SLOW_QUERY_EXPLAIN_RATE', 0.1)
+        app.config.setdefault('SLOW_QUERY_EXPLAIN_INTERVAL', 600)
+        app.config.setdefault('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', 5000)
+        app.config.setdefault('SLOW_QUERY_FLUSH_INTERVAL', 10)
+
+        if not app.config['SLOW_QUERY_THRESHOLD_MS']:
+            return
+
+        self.app = app
+        self.threshold = app.config['SLOW_QUERY_THRESHOLD_MS']
+
+        event.listen(Engine, 'before_cursor_execute', start_statement)
+        event.listen(Engine, 'after_cursor_execute', end_statement)
+
+    def add(self, engine, statement, parameters, executemany, elapsed_ms):
+        """ Queue a slow statement, from the thread that ran it """
+
+        item = {
+            'engine': engine,
+            'statement': statement,
+            'parameters': parameters
+            if can_explain(statement, executemany) else None,
+            'endpoint': (request.endpoint or "none")
+            if has_request_context() else "background",
+            'caller': find_caller(),
+            'elapsed_ms': elapsed_ms,
+        }
+
+        try:
+            self.pending.put_nowait(item)
+        except queue.Full:
+            return
+
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run,
+                                                   name="slow-query-log",
+                                                   daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        config = self.app.config
+        flush_interval = config['SLOW_QUERY_FLUSH_INTERVAL']
+        explained_at = {}
+        rows = {}
+        flushed_at = time.monotonic()
+
+        while True:
+            try:
+                item = self.pending.get(timeout=flush_interval)
+            except queue.Empty:
+                item = None
+
+            if item is not None:
+                self.aggregate(rows, item, explained_at)
+
+            if rows and time.monotonic() - flushed_at >= flush_interval:
+                self.save(list(rows.values()))
+                rows = {}
+                flushed_at = time.monotonic()
+
+    def aggregate(self, rows, item, explained_at):
+        config = self.app.config
+        normalized = normalize(item['statement'])
+        key = (fingerprint(normalized), item['endpoint'][:100])
+
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = {
+                'fingerprint': key[0],
+                'endpoint': key[1],
+                'statement': normalized,
+                'calls': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'plan': None,
+                'plan_ms': None,
+                'plan_at': None,
+            }
+
+        row['calls'] += 1
+        row['total_ms'] += item['elapsed_ms']
+        row['max_ms'] = max(row['max_ms'], item['elapsed_ms'])
+        row['caller'] = item['caller']
+
+        now = time.monotonic()
+        if item['parameters'] is not None and row['plan'] is None and \
+                now - explained_at.get(key, -float('inf')) >= \
+                config['SLOW_QUERY_EXPLAIN_INTERVAL'] and \
+                self.rng.random() < config['SLOW_QUERY_EXPLAIN_RATE']:
+            explained_at[key] = now
+            row['plan'], row['plan_ms'] = self.explain(
+                item['engine'], item['statement'], item['parameters'])
+            if row['plan'] is not None:
+                row['plan_at'] = datetime.now(timezone.utc)
+
+    def explain(self, engine, statement, parameters):
+        """ (plan, ms) of the statement run again, (None, None) when
+            it could not be explained
+        """
+
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SET LOCAL statement_timeout = %s",
+                           (self.app.config['SLOW_QUERY_EXPLAIN_TIMEOUT_MS'],))
+            start = time.perf_counter()
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement,
+                           parameters)
+            plan = "\n".join(line for line, in cursor.fetchall())
+            return plan, (time.perf_counter() - start) * 1000
+        except Exception:
+            logger.warning("Could not explain %s", statement[:200],
+                           exc_info=True)
+            return None, None
+        finally:
+            connection.rollback()
+            connection.close()
+
+    def save(self, rows):
+        """ Add the rows to the ones already saved """
+
+        table = SlowQuery.__table__
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            constraint='uq_slow_queries_fingerprint_endpoint',
+            set_={
+                'statement': stmt.excluded.statement,
+                'caller': stmt.excluded.caller,
+                'calls': table.c.calls + stmt.excluded.calls,
+                'total_ms': table.c.total_ms + stmt.excluded.total_ms,
+                'max_ms': func.greatest(table.c.max_ms,
+                                        stmt.excluded.max_ms),
+                'plan': func.coalesce(stmt.excluded.plan, table.c.plan),
+                'plan_ms': func.coalesce(stmt.excluded.plan_ms,
+                                         table.c.plan_ms),
+                'plan_at': func.coalesce(stmt.excluded.plan_at,
+                                         table.c.plan_at),
+                'last_seen': func.now(),
+            })
+
+        try:
+            with self.app.app_context():
+                with db.engine.connect() as conn:
+                    # info stays with the pooled connection, so the flag
+                    # has to be taken off before it goes back
+                    conn.info['slow_query_log'] = True
+                    try:
+                        with conn.begin():
+                            conn.execute(stmt)
+                    finally:
+                        conn.info.pop('slow_query_log')
+        except Exception:
+            logger.exception("Could not save %s slow queries", len(rows))
+
+
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    conn.info['slow_query_start'] = time.perf_counter()
+
+
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop('slow_query_start', None)
+    if start is None or conn.info.get('slow_query_log'):
+        return
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if elapsed_ms >= slow_queries.threshold:
+        slow_queries.add(conn.engine, statement, parameters, executemany,
+                         elapsed_ms)
+
+
+slow_queries = SlowQueryLog()
+
+
+def connect_slow_queries(app):
+    """ Keep the statements slower than SLOW_QUERY_THRESHOLD_MS, None
+        to turn the slow query log off
+    """
+
+    slow_queries.init_app(app)
@@ -1,6 +1,9 @@
 "use strict";
 
-const VERSE_API = "/api/verse"
+const VERSES_API = "/api/verses"
+
+/** Ids of the verse fields waiting to be looked up */
+const pendingFields = new Set();
 
 /** Generator to make sure to get the 
  *  snext value for the verse field id's */
@@ -57,19 +60,45 @@ function generateVerseField(num) {
 $("#addFields").on("click", addFields)
 
 
-/** When the reference gets filled in, get the 
- *  verse from API then update the textarea field 
- *  - Also check if the reference can be formed in a 
+/** When a reference gets filled in, queue its field
+ *  - Queued fields are looked up together once typing stops */
+
+function queueVerseField(evt) {
+  const targetId = $(evt.target).attr('id').split("-")[1];
+
+  pendingFields.add(targetId);
+  refreshPendingFields();
+}
+
+$('#verseFields').on("input", ".input-ref", queueVerseField);
+
+
+/** Get the verses of every queued field with one API request
+ *  then update the textarea fields
+ *  - Also check if the references can be formed in a
  *    nicer format (display option to change) */
 
-async function refreshVerseFields(evt) {
-  const $input = $(evt.target);
-  const targetId = $input.attr('id').split("-")[1];
-  
-  const reference = $input.val();
-  
-  const info = await retrieveVerse(reference);
-  
+async function refreshVerseFields() {
+  const targetIds = [...pendingFields];
+  pendingFields.clear();
+
+  if (targetIds.length === 0) return;
+
+  const references = targetIds.map(id => $(`#ref-${id}`).val());
+
+  const infos = await retrieveVerses(references);
+
+  for (let i = 0; i < targetIds.length; i++) {
+    updateVerseField(targetIds[i], references[i], infos[i]);
+  }
+}
+
+const refreshPendingFields = _.debounce(refreshVerseFields, 500);
+
+
+/** Show the verse of one field and the suggested reference */
+
+function updateVerseField(targetId, reference, info) {
   $(`#verse-${targetId}`).val(info.passages);
 
   info.reference = info.reference.replace("–", "-");
@@ -81,24 +110,56 @@ async function refreshVerseFields(evt) {
   } else {
     $(`#ref-correct-${targetId}`).empty()
   }
-
 }
 
-/** Make API request to get the verse and return the verse text */
+/** Make API request to get the verses of many references
+ *  and return the info of each one, in order */
 
-async function retrieveVerse(reference) {
-  let resp = await axios.get(VERSE_API, {
-    params: {
-      "reference": reference, 
-      "get_verse_num": true
-    }
+async function retrieveVerses(references) {
+  let resp = await axios.post(VERSES_API, {
+    "references": references,
+    "get_verse_num": true
   });
 
-  return resp.data.info;
+  return resp.data.infos;
 }
 
 
-$('#verseFields').on("input", ".input-ref", _.debounce(refreshVerseFields, 500));
+/** When a list of references is pasted into a field,
+ *  make a field for each reference and look them all up at once */
+
+function pasteReferences(evt) {
+  const clipboard = evt.originalEvent.clipboardData || window.clipboardData;
+  const references = clipboard.getData("text")
+    .split(/\r?\n|;/)
+    .map(ref => ref.trim())
+    .filter(ref => ref);
+
+  if (references.length < 2) return;
+
+  evt.preventDefault();
+
+  const $input = $(evt.target);
+  $input.val(references[0]);
+  pendingFields.add($input.attr('id').split("-")[1]);
+
+  let $field = $input.closest(".verseField");
+
+  for (const reference of references.slice(1)) {
+    const num = generator.next().value;
+    const $newField = generateVerseField(num);
+
+    $newField.find(".input-ref").val(reference);
+    $field.after($newField);
+    $field = $newField;
+
+    pendingFields.add(String(num));
+  }
+
+  refreshPendingFields();
+}
+
+$('#verseFields').on("paste", ".input-ref", pasteReferences);
 
 
 /** Function to update the references to a friendlier
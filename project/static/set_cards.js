@@ -4,6 +4,7 @@ const BASE_URL = "/api/sets";
 const SET_ID = $("#setId").val();;
 const MAX_CARDS = 6;
 const TOTAL_SECONDS = 30;
+let allVerses = [];
 let verses = [];
 let timerInterval;
 
@@ -96,11 +97,15 @@ function checkCards(evt) {
 $gameBoard.on("change", ".matchCard", checkCards);
 
 
-/** Function to make the AJAX request when more cards are needed */
+/** Function to get more cards when they run out
+ *  - The cards are only requested once, replays reuse them
+ */
 async function getNewVerses() {
-  let resp = await axios.get(`${BASE_URL}/${SET_ID}`);
-  verses = resp.data.cards;
-  verses = _.shuffle(verses);
+  if (allVerses.length === 0) {
+    let resp = await axios.get(`${BASE_URL}/${SET_ID}`);
+    allVerses = resp.data.cards;
+  }
+  verses = _.shuffle(allVerses);
 }
 
 /** Make up to 12 cards on the DOM with up to 6 verses */
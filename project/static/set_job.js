@@ -0,0 +1,58 @@
+"use strict";
+
+// How often the job status is checked, in ms
+const POLL_INTERVAL = 750;
+
+const $status = $("#job-status");
+const $progress = $("#job-progress");
+const $error = $("#job-error");
+const $back = $("#job-back");
+
+
+/** Check the job until it is done, then go to the set
+ *  - The job page is loaded again, it sends the user on to the set
+ *    with its message */
+
+async function pollJob() {
+  let job;
+
+  try {
+    let resp = await axios.get(JOB_STATUS_URL);
+    job = resp.data.job;
+  } catch (err) {
+    setTimeout(pollJob, POLL_INTERVAL * 4);
+    return;
+  }
+
+  showProgress(job);
+
+  if (job.status === "done") {
+    window.location.reload();
+  } else if (job.status !== "failed") {
+    setTimeout(pollJob, POLL_INTERVAL);
+  }
+}
+
+$(document).ready(pollJob);
+
+
+/** Show how many references were resolved, or why the job failed */
+
+function showProgress(job) {
+  let percent = job.refs_total ? (100 * job.refs_done / job.refs_total) : 0;
+
+  $progress.css("width", `${percent}%`);
+
+  if (job.status === "queued") {
+    $status.text("Waiting for a free worker...");
+  } else if (job.status === "running") {
+    $status.text(`Looked up ${job.refs_done} of ${job.refs_total} references`);
+  } else if (job.status === "done") {
+    $status.text("Saving your set...");
+  } else {
+    $status.text("Your set could not be saved");
+    $progress.removeClass("progress-bar-animated bg-info").addClass("bg-danger");
+    $error.text(job.error).removeClass("d-none");
+    $back.removeClass("d-none");
+  }
+}
@@ -0,0 +1,414 @@
+import json
+import logging
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.wsgi import ClosingIterator
+
+logger = logging.getLogger(__name__)
+
+# Longest SQL statement kept on a span
+MAX_STATEMENT_LENGTH = 500
+
+
+class Span(object):
+    """ One timed stage of a trace """
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind',
+                 'tags', 'timestamp', 'start', 'duration')
+
+    def __init__(self, trace_id, parent_id, name, kind=None, tags=None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.tags = {key: str(value) for key, value in (tags or {}).items()}
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+
+    def to_dict(self, service):
+        """ The span in the Zipkin v2 JSON format """
+
+        data = {
+            'traceId': self.trace_id,
+            'id': self.span_id,
+            'name': self.name,
+            'timestamp': int(self.timestamp * 1000000),
+            'duration': max(int(self.duration * 1000000), 1),
+            'localEndpoint': {'serviceName': service},
+            'tags': self.tags,
+        }
+        if self.parent_id:
+            data['parentId'] = self.parent_id
+        if self.kind:
+            data['kind'] = self.kind
+        return data
+
+
+class Trace(object):
+    """ Spans of the trace being recorded by the current thread """
+
+    __slots__ = ('trace_id', 'stack', 'finished')
+
+    def __init__(self, trace_id):
+        self.trace_id = trace_id
+        self.stack = []
+        self.finished = []
+
+
+class FileExporter(object):
+    """ Append the spans to a file, one JSON object per line """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        lines = "".join(json.dumps(span) + "\n" for span in spans)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(lines)
+
+
+class ZipkinExporter(object):
+    """ Send the spans to a collector speaking the Zipkin v2 API, like
+        Zipkin, Jaeger or the OpenTelemetry collector
+        - Spans are sent by a background thread so requests never wait
+          on the collector, they are dropped when it falls behind
+    """
+
+    def __init__(self, url, max_queue=1000, timeout=5):
+        self.url = url
+        self.timeout = timeout
+        self.pending = queue.Queue(max_queue)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        try:
+            self.pending.put_nowait(spans)
+        except queue.Full:
+            return
+
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.send_forever,
+                                                   name="trace-exporter",
+                                                   daemon=True)
+                    self.thread.start()
+
+    def send_forever(self):
+        import requests
+
+        http = requests.Session()
+
+        while True:
+            spans = self.pending.get()
+            try:
+                while len(spans) < 1000:
+                    spans = spans + self.pending.get_nowait()
+            except queue.Empty:
+                pass
+
+            try:
+                http.post(self.url, json=spans, timeout=self.timeout)
+            except requests.RequestException:
+                logger.warning("Could not send %s spans to %s",
+                               len(spans), self.url)
+
+
+EXPORTERS = {
+    'file': lambda config: FileExporter(config['TRACING_FILE']),
+    'zipkin': lambda config: ZipkinExporter(config['TRACING_URL']),
+}
+
+
+class Tracer(object):
+    """ Traces of requests and jobs, split in spans for their stages,
+        SQL statements and calls to the ESV API and Elasticsearch
+        - The spans of a trace are kept in a thread local and exported
+          together once its root span ends
+        - The trace is carried to other services and to the jobs queued
+          by the request with a W3C traceparent
+    """
+
+    def __init__(self):
+        self.exporter = None
+        self.service = "mtword"
+        self.sample_rate = 1.0
+        self.local = threading.local()
+
+    def init_app(self, app):
+        app.config.setdefault('TRACING_EXPORTER', None)
+        app.config.setdefault('TRACING_FILE', os.path.join(
+            tempfile.gettempdir(), 'mtword-traces.jsonl'))
+        app.config.setdefault('TRACING_URL',
+                              "http://localhost:9411/api/v2/spans")
+        app.config.setdefault('TRACING_SAMPLE_RATE', 1.0)
+        app.config.setdefault('TRACING_SERVICE', "mtword")
+
+        exporter = app.config['TRACING_EXPORTER']
+        if not exporter:
+            return
+
+        # Any object with an export(spans) method can be given instead
+        if isinstance(exporter, str):
+            exporter = EXPORTERS[exporter](app.config)
+
+        self.exporter = exporter
+        self.service = app.config['TRACING_SERVICE']
+        self.sample_rate = app.config['TRACING_SAMPLE_RATE']
+
+        app.wsgi_app = TracingMiddleware(app.wsgi_app, self)
+        app.before_request(name_request_span)
+
+        event.listen(Engine, 'before_cursor_execute', start_sql_span)
+        event.listen(Engine, 'after_cursor_execute', end_sql_span)
+        event.listen(Engine, 'handle_error', fail_sql_span)
+
+    # Recording
+
+    @property
+    def trace(self):
+        return getattr(self.local, 'trace', None)
+
+    @contextmanager
+    def start_trace(self, name, parent=None, kind=None, trusted=True,
+                    **tags):
+        """ Record a trace with a root span, continuing the trace of the
+            parent traceparent when there is one
+            - Inside a trace, this is only a child span
+            - Nothing is recorded without an exporter or for a trace left
+              out by sampling
+            - Only a trusted parent, like the request that queued a job,
+              decides the sampling, for others TRACING_SAMPLE_RATE does
+        """
+
+        if self.exporter is None:
+            yield None
+            return
+
+        if self.trace is not None:
+            with self.span(name, kind, **tags) as span:
+                yield span
+            return
+
+        trace_id, parent_id, sampled = parse_traceparent(parent)
+        if trace_id is None or not trusted:
+            sampled = random.random() < self.sample_rate
+        if trace_id is None:
+            trace_id = os.urandom(16).hex()
+
+        if not sampled:
+            yield None
+            return
+
+        trace = self.local.trace = Trace(trace_id)
+        root = self.start_span(name, kind, tags, parent_id)
+        try:
+            yield root
+        except Exception as e:
+            root.tags['error'] = type(e).__name__
+            raise
+        finally:
+            self.end_span(root)
+            self.local.trace = None
+            self.export(trace.finished)
+
+    @contextmanager
+    def span(self, name, kind=None, **tags):
+        """ Time a stage as a child of the current span, if any """
+
+        if self.trace is None:
+            yield None
+            return
+
+        current = self.start_span(name, kind, tags)
+        try:
+            yield current
+        except Exception as e:
+            current.tags['error'] = type(e).__name__
+            raise
+        finally:
+            self.end_span(current)
+
+    def start_span(self, name, kind=None, tags=None, parent_id=None):
+        trace = self.trace
+
+        if trace.stack:
+            parent_id = trace.stack[-1].span_id
+
+        span = Span(trace.trace_id, parent_id, name, kind, tags)
+        trace.stack.append(span)
+
+        return span
+
+    def end_span(self, span):
+        trace = self.trace
+        span.finish()
+
+        if span in trace.stack:
+            trace.stack.remove(span)
+        trace.finished.append(span)
+
+    def current_span(self):
+        trace = self.trace
+        return trace.stack[-1] if trace and trace.stack else None
+
+    def traceparent(self):
+        """ The traceparent of the current span, None outside a trace """
+
+        span = self.current_span()
+        if span is None:
+            return None
+        return f"00-{span.trace_id}-{span.span_id}-01"
+
+    def headers(self):
+        """ Headers carrying the current span to the service called in
+            it, empty outside a trace
+        """
+
+        traceparent = self.traceparent()
+        return {'traceparent': traceparent} if traceparent else {}
+
+    # Exporting
+
+    def export(self, spans):
+        try:
+            self.exporter.export([span.to_dict(self.service)
+                                  for span in spans])
+        except Exception:
+            logger.exception("Could not export the spans of a trace")
+
+
+class TracingMiddleware(object):
+    """ Record a trace for every request, continuing the trace of the
+        caller when it sends a traceparent header
+        - The caller cannot ask for its trace to be sampled, any client
+          could otherwise have every request traced
+        - The root span ends when the server closes the body, so it
+          covers streamed responses until their last chunk
+    """
+
+    def __init__(self, wsgi_app, tracer):
+        self.wsgi_app = wsgi_app
+        self.tracer = tracer
+
+    def __call__(self, environ, start_response):
+        with ExitStack() as stack:
+            root = stack.enter_context(self.tracer.start_trace(
+                f"{environ.get('REQUEST_METHOD')} {environ.get('PATH_INFO')}",
+                parent=environ.get('HTTP_TRACEPARENT'),
+                kind="SERVER",
+                trusted=False,
+                **{'http.method': environ.get('REQUEST_METHOD'),
+                   'http.path': environ.get('PATH_INFO')}))
+
+            def record_status(status, headers, exc_info=None):
+                if root is not None:
+                    root.tags['http.status_code'] = status.split(" ", 1)[0]
+                return start_response(status, headers, exc_info)
+
+            body = self.wsgi_app(environ, record_status)
+            end_trace = stack.pop_all()
+
+        return ClosingIterator(body, end_trace.close)
+
+
+def parse_traceparent(value):
+    """ (trace id, parent span id, sampled) of a W3C traceparent,
+        (None, None, None) when it is missing or malformed
+
+        >>> parse_traceparent("00-4bf92f3577b34da6a3ce929d0e0e4736-"
+        ...                   "00f067aa0ba902b7-01")
+        ('4bf92f3577b34da6a3ce929d0e0e4736', '00f067aa0ba902b7', True)
+    """
+
+    parts = (value or "").strip().split("-")
+
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None, None
+
+    try:
+        flags = int(parts[3], 16)
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None, None, None
+
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None, None, None
+
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def name_request_span():
+    """ Name the request span after its endpoint rather than its path """
+
+    span = tracer.current_span()
+    if span is not None and request.endpoint:
+        span.name = f"{request.method} {request.endpoint}"
+
+
+def start_sql_span(conn, cursor, statement, parameters, context,
+                   executemany):
+    if tracer.trace is None:
+        return
+
+    conn.info['tracing_span'] = tracer.start_span(
+        "sql", "CLIENT", {'db.statement': statement[:MAX_STATEMENT_LENGTH]})
+
+
+def end_sql_span(conn, cursor, statement, parameters, context, executemany):
+    span = conn.info.pop('tracing_span', None)
+    if span is not None and tracer.trace is not None:
+        tracer.end_span(span)
+
+
+def fail_sql_span(context):
+    span = context.connection.info.pop('tracing_span', None)
+    if span is not None and tracer.trace is not None:
+        span.tags['error'] = type(context.original_exception).__name__
+        tracer.end_span(span)
+
+
+def traced(name):
+    """ Decorator recording every call of the function as a span """
+
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+tracer = Tracer()
+
+
+def connect_tracing(app):
+    """ Trace requests and jobs when TRACING_EXPORTER is set
+        - "file" appends the spans to TRACING_FILE as JSON lines
+        - "zipkin" sends them to the collector at TRACING_URL
+        - TRACING_SAMPLE_RATE: share of the traces that are recorded
+    """
+
+    tracer.init_app(app)
@@ -1,10 +1,11 @@
 from flask import Blueprint, render_template, request, abort, flash, \
-    url_for, redirect
+    url_for, redirect, Response, stream_with_context
 
 from flask_login import current_user, login_required
 
-from ..models import User, Set, db
+from ..models import User, Set, Favorite, db
 from ..forms import EditUserForm
+from ..helpers.export import EXPORT_FORMATS, export_rows, export_sets
 
 users = Blueprint('users', __name__, template_folder="templates")
 
@@ -37,9 +38,9 @@ def show_user_favorites(user_id):
 
     page = request.args.get("page", 1, type=int)
 
-    favorited_sets_id = set([fav_set.id for fav_set in user.favorite_sets])
-
-    sets = Set.query.filter(Set.id.in_(favorited_sets_id)).paginate(page, 10)
+    sets = Set.query.join(Favorite, Favorite.set_id == Set.id).filter(
+        Favorite.user_id == user.id).options(
+        db.joinedload(Set.user)).order_by(Favorite.id).paginate(page, 10)
 
     return render_template("users/user_favorites.html",
                            user=user,
@@ -49,6 +50,34 @@ def show_user_favorites(user_id):
                            )
 
 
+@users.route("/users/<int:user_id>/export")
+@login_required
+def export_user_sets(user_id):
+    """ Stream the user's sets and their verses as NDJSON or CSV
+        - Only the user themself or an admin can export
+    """
+
+    if current_user.id != user_id and not current_user.is_admin:
+        abort(404)
+
+    user = User.query.get_or_404(user_id)
+
+    fmt = request.args.get("format", "ndjson")
+
+    if fmt not in EXPORT_FORMATS:
+        abort(400)
+
+    chunks = export_sets(export_rows(user.id), fmt)
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={
+            "Content-Disposition":
+                f"attachment; filename={user.username}-sets.{fmt}"
+        })
+
+
 @users.route("/users/<int:user_id>/edit", methods=["GET", "POST"])
 @login_required
 def edit_user_profile(user_id):
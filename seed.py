@@ -1,9 +1,14 @@
+from project import create_app
 from project.models import db, User, Set, Verse
+from project.helpers.sets import update_set_verses
 
 from flask_bcrypt import Bcrypt
 
 bcrypt = Bcrypt()
 
+app = create_app()
+app.app_context().push()
+
 db.drop_all()
 db.create_all()
 
@@ -47,8 +52,7 @@ new_set = Set(
 db.session.add(new_set)
 db.session.commit()
 
-new_set.verses.append(verse1)
-new_set.verses.append(verse2)
+update_set_verses(new_set, [verse1, verse2])
 db.session.commit()
 
 Set.reindex()